@@ -0,0 +1,91 @@
+import sys
+import time
+import hashlib
+import argparse
+import tempfile
+
+import pandas as pd
+
+sys.path.insert(0, __file__.rsplit('/benchmarks/', 1)[0])
+from etl.dtypes import compact, use_arrow_strings
+from etl.interval_join import assign_drivers
+from etl.payments import PAYMENTS_COLUMNS, PAYMENTS_DTYPES, iter_payments, list_payment_files
+from etl.rides import ride_lifecycle
+from etl.waybills import WAYBILL_COLUMNS, list_waybill_files, parse_waybill_files, read_waybills
+from benchmarks.synthetic import generate, write_payment_files, write_waybill_files
+
+
+def size_mb(df: pd.DataFrame) -> float:
+    return (df.memory_usage(deep=True, index=True).sum()) / 2**20
+
+
+# Кадры в том виде, в каком их раньше отдавали read_sql / XSLT / read_csv - строки в object
+def legacy_frames(movement: pd.DataFrame, rides: pd.DataFrame, waybills_dir: str, payments_dir: str) -> dict:
+    waybills = pd.DataFrame(parse_waybill_files(list_waybill_files(waybills_dir)), columns=WAYBILL_COLUMNS)
+    for column in ['issuedt', 'start', 'stop']:
+        waybills[column] = pd.to_datetime(waybills[column])
+    payments = pd.concat([
+        pd.read_csv(path, sep='\t', names=PAYMENTS_COLUMNS, dtype=PAYMENTS_DTYPES)
+        for path in list_payment_files(payments_dir)
+    ], ignore_index=True)
+    payments['transaction_id'] = [
+        hashlib.md5((dt + card).encode('utf-8')).hexdigest()
+        for dt, card in zip(payments['transaction_dt'], payments['card_num'])
+    ]
+    payments['transaction_dt'] = pd.to_datetime(payments['transaction_dt'], format='%d.%m.%Y %H:%M:%S')
+    return {
+        'movement': movement.astype({'car_plate_num': object, 'event': object}),
+        'rides': rides,
+        'waybills': waybills,
+        'payments': payments.set_index('transaction_id')
+    }
+
+
+def compact_frames(movement: pd.DataFrame, rides: pd.DataFrame, waybills_dir: str, payments_dir: str) -> dict:
+    return {
+        'movement': compact(movement, 'movement'),
+        'rides': compact(rides, 'rides'),
+        'waybills': read_waybills(waybills_dir),
+        'payments': pd.concat(iter_payments(payments_dir))
+    }
+
+
+# Трансформация fact_rides как в dwh_etl.py (без загрузки)
+def transform(frames: dict) -> pd.DataFrame:
+    fact_rides = ride_lifecycle(frames['movement']).merge(frames['rides'], how='left', left_on='ride', right_on='ride_id')
+    waybills = frames['waybills'].rename(columns={'car': 'car_plate_num', 'start': 'work_start_dt', 'stop': 'work_end_dt'})
+    waybills['driver_pers_num'] = waybills['license']
+    matched, _ = assign_drivers(fact_rides, waybills, ride_dt_col='dt')
+    return matched
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Memory report: object strings vs compact dtypes')
+    args.add_argument('--rides', type=int, default=1_000_000, help='payments are generated for ~30% of rides')
+    args.add_argument('--waybills', type=int, default=20_000)
+    opts = args.parse_args()
+    use_arrow_strings()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # За сутки на машину приходится 4 путевых листа
+        data = generate(rides=opts.rides, cars=max(1, opts.waybills // 4), sources=['rides', 'movement', 'waybills', 'payments'])
+        write_waybill_files(tmp + '/waybills', data.pop('waybills'))
+        write_payment_files(tmp + '/payments', data.pop('payments'))
+        movement, rides = data['movement'].set_index('movement_id'), data['rides']
+
+        report = []
+        for label, build in [('object', legacy_frames), ('compact', compact_frames)]:
+            frames = build(movement, rides, tmp + '/waybills', tmp + '/payments')
+            t0 = time.perf_counter()
+            fact_rides = transform(frames)
+            frames['fact_rides (transform)'] = fact_rides
+            report.append((label, {name: size_mb(df) for name, df in frames.items()}, time.perf_counter() - t0))
+
+    names = list(report[0][1])
+    print('{:<24} {:>12} {:>12} {:>8}'.format('frame, MB', 'object', 'compact', 'ratio'))
+    for name in names:
+        before, after = report[0][1][name], report[1][1][name]
+        print('{:<24} {:>12.1f} {:>12.1f} {:>7.1f}x'.format(name, before, after, before / after))
+    total_before, total_after = sum(report[0][1].values()), sum(report[1][1].values())
+    print('{:<24} {:>12.1f} {:>12.1f} {:>7.1f}x'.format('total', total_before, total_after, total_before / total_after))
+    print('transform seconds: object {:.2f}, compact {:.2f}'.format(report[0][2], report[1][2]))
@@ -0,0 +1,78 @@
+import sys
+import time
+import argparse
+
+import pandas as pd
+
+sys.path.insert(0, __file__.rsplit('/benchmarks/', 1)[0])
+from etl.interval_join import assign_drivers
+from benchmarks.synthetic import generate
+
+
+# Путевые листы синтетического набора в колонках fact_waybills. С overlap у каждой третьей смены машины
+# есть короткий лист (1 час) внутри нее, начавшийся позже - заказы после его конца покрывает только
+# более ранняя длинная смена
+def make_waybills(cars: int, days: int, overlap: bool = False) -> pd.DataFrame:
+    waybills = generate(cars=cars, days=days, sources=['waybills'])['waybills']
+    waybills = pd.DataFrame({
+        'driver_pers_num': waybills['license'],
+        'car_plate_num': waybills['car'],
+        'work_start_dt': waybills['start'],
+        'work_end_dt': waybills['stop']
+    })
+    if overlap:
+        inner = waybills[waybills.groupby('car_plate_num').cumcount() % 3 == 0].copy()
+        inner['work_start_dt'] += pd.Timedelta(hours=2)
+        inner['work_end_dt'] = inner['work_start_dt'] + pd.Timedelta(hours=1)
+        waybills = pd.concat([waybills, inner], ignore_index=True)
+    return waybills
+
+
+# Поездки синтетического набора (те же машины): время начала по статусу BEGIN
+def make_rides(n: int, cars: int, days: int) -> pd.DataFrame:
+    movement = generate(rides=n, cars=cars, days=days, sources=['movement'])['movement']
+    begin = movement[movement['event'] == 'BEGIN']
+    return pd.DataFrame({
+        'ride': begin['ride'].to_numpy(),
+        'car_plate_num': begin['car_plate_num'].to_numpy(),
+        'dt_begin': begin['dt'].to_numpy()
+    })
+
+
+# Старая реализация (полный перебор путевых листов на каждую поездку) для сравнения на малых объемах
+def loop_assign(rides: pd.DataFrame, waybills: pd.DataFrame) -> int:
+    found = 0
+    for idx in rides.index:
+        match = waybills[
+            (rides.loc[idx, 'car_plate_num'] == waybills['car_plate_num']) &
+            (rides.loc[idx, 'dt_begin'] >= waybills['work_start_dt']) &
+            (rides.loc[idx, 'dt_begin'] <= waybills['work_end_dt'])
+        ]['driver_pers_num'].values
+        found += len(match) > 0
+    return found
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Interval join benchmark: rides -> waybills')
+    args.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000, 10_000_000])
+    args.add_argument('--cars', type=int, default=2_000)
+    args.add_argument('--days', type=int, default=20, help='three 8-hour shifts per car and day')
+    args.add_argument('--loop-limit', type=int, default=1_000, help='run the old loop only up to this size')
+    args.add_argument('--no-overlap', action='store_true', help='only non-overlapping shifts')
+    opts = args.parse_args()
+
+    waybills = make_waybills(opts.cars, opts.days, overlap=not opts.no_overlap)
+    print('waybills: {}'.format(len(waybills)))
+    print('{:>12} {:>12} {:>12} {:>12}'.format('rides', 'asof, s', 'unmatched', 'loop, s'))
+    for size in opts.sizes:
+        rides = make_rides(size, opts.cars, opts.days)
+        t0 = time.perf_counter()
+        matched, unmatched = assign_drivers(rides, waybills)
+        asof_time = time.perf_counter() - t0
+        loop_time = ''
+        if size <= opts.loop_limit:
+            t0 = time.perf_counter()
+            found = loop_assign(rides, waybills)
+            loop_time = '{:.2f}'.format(time.perf_counter() - t0)
+            assert found == len(matched)
+        print('{:>12} {:>12.2f} {:>12} {:>12}'.format(len(rides), asof_time, len(unmatched), loop_time))
@@ -0,0 +1,83 @@
+import os
+import sys
+import time
+import argparse
+import hashlib
+
+import pandas as pd
+import pangres
+
+from sqlalchemy import create_engine
+
+sys.path.insert(0, __file__.rsplit('/benchmarks/', 1)[0])
+from etl.loader import copy_upsert, copy_append
+from benchmarks.synthetic import generate
+
+SCHEMA = 'bench'
+
+
+# Платежи синтетического набора в формате fact_payments (завершенных поездок с оплатой ~30%, берем с запасом)
+def make_payments(n: int, seed: int = 0) -> pd.DataFrame:
+    payments = generate(rides=n * 4, seed=seed, sources=['payments'])['payments'].head(n)
+    dt = payments['transaction_dt'].dt.strftime('%d.%m.%Y %H:%M:%S')
+    cards = payments['card_num'].str.replace(' ', '', regex=False)
+    return pd.DataFrame({
+        'transaction_id': [hashlib.md5((d + c).encode()).hexdigest() for d, c in zip(dt, cards)],
+        'transaction_dt': payments['transaction_dt'],
+        'card_num': cards,
+        'transaction_amt': payments['transaction_amt']
+    }).drop_duplicates('transaction_id').set_index('transaction_id')
+
+
+def reset_table(engine):
+    engine.execute('CREATE SCHEMA IF NOT EXISTS {}'.format(SCHEMA))
+    engine.execute('DROP TABLE IF EXISTS {}.fact_payments'.format(SCHEMA))
+    engine.execute(
+        '''
+        CREATE TABLE {}.fact_payments (
+            transaction_id varchar(32) PRIMARY KEY,
+            transaction_dt timestamp,
+            card_num varchar(16),
+            transaction_amt numeric(10, 2)
+        )
+        '''.format(SCHEMA)
+    )
+
+
+def timed(name: str, rows: int, func):
+    start = time.perf_counter()
+    func()
+    duration = time.perf_counter() - start
+    print('{:<28} {:>10} rows {:>8.2f} s {:>12.0f} rows/s'.format(name, rows, duration, rows / duration))
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Fact load benchmark: pangres upsert vs COPY (needs BENCH_DB_URI)')
+    args.add_argument('--rows', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    opts = args.parse_args()
+
+    engine = create_engine(os.environ['BENCH_DB_URI'])
+    for rows in opts.rows:
+        payments = make_payments(rows)
+        # Вторая половина пересекается с первой загрузкой, чтобы проверить пропуск существующих строк
+        overlap = pd.concat([payments.iloc[len(payments) // 2:], make_payments(len(payments) // 2, seed=1)])
+        overlap = overlap[~overlap.index.duplicated()]
+
+        reset_table(engine)
+        timed('pangres.upsert', len(payments), lambda: pangres.upsert(
+            con=engine, df=payments, table_name='fact_payments', if_row_exists='ignore', schema=SCHEMA
+        ))
+        timed('pangres.upsert (overlap)', len(overlap), lambda: pangres.upsert(
+            con=engine, df=overlap, table_name='fact_payments', if_row_exists='ignore', schema=SCHEMA
+        ))
+
+        reset_table(engine)
+        timed('copy_upsert', len(payments), lambda: copy_upsert(engine, payments, 'fact_payments', schema=SCHEMA))
+        timed('copy_upsert (overlap)', len(overlap), lambda: copy_upsert(engine, overlap, 'fact_payments', schema=SCHEMA))
+
+        reset_table(engine)
+        timed('to_sql append', len(payments), lambda: payments.to_sql(
+            'fact_payments', con=engine, schema=SCHEMA, if_exists='append'
+        ))
+        reset_table(engine)
+        timed('copy_append', len(payments), lambda: copy_append(engine, payments, 'fact_payments', schema=SCHEMA))
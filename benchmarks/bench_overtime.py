@@ -0,0 +1,79 @@
+import sys
+import time
+import argparse
+import datetime
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, __file__.rsplit('/benchmarks/', 1)[0])
+from etl.overtime import OVERTIME_LIMIT, OVERTIME_WINDOW, overtime_violations
+
+
+# Случайные интервалы работы водителей для сверки с перебором: смены от 1 до 10 часов с паузами
+# от -2 (пересечение) до 20 часов. У synthetic.generate смены ровные по 8 часов и таких случаев не дают
+def random_shifts(drivers: int, shifts: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    n = drivers * shifts
+    duration = rng.integers(3600, 10 * 3600, n)
+    gap = rng.integers(-2 * 3600, 20 * 3600, n)
+    start = (np.r_[0, np.cumsum(duration + gap)[:-1]]).reshape(drivers, shifts)
+    start = start - start[:, :1] + rng.integers(0, 86400, (drivers, 1))
+    start = start.ravel()
+    return pd.DataFrame({
+        'driver_pers_num': np.repeat(['D{:06d}'.format(i) for i in range(drivers)], shifts),
+        'work_start_dt': pd.Timestamp('2022-11-01') + pd.to_timedelta(start, unit='s'),
+        'work_end_dt': pd.Timestamp('2022-11-01') + pd.to_timedelta(start + duration, unit='s')
+    }).sample(frac=1, random_state=seed)
+
+
+# Эталон перебором: окна начинаются в моменты начала работы, не покрытые более ранним путевым листом,
+# наработка - длина объединения путевых листов внутри окна
+def brute_force(waybills: pd.DataFrame) -> pd.DataFrame:
+    rows = []
+    for driver, group in waybills.groupby('driver_pers_num'):
+        intervals = list(zip(group['work_start_dt'], group['work_end_dt']))
+        for s, _ in intervals:
+            if any(a < s <= e for a, e in intervals):
+                continue
+            w_end = s + OVERTIME_WINDOW
+            clipped = sorted((max(a, s), min(e, w_end)) for a, e in intervals if e > s and a < w_end)
+            worked = datetime.timedelta(0)
+            cur_a, cur_e = None, None
+            for a, e in clipped:
+                if cur_e is None or a > cur_e:
+                    if cur_e is not None:
+                        worked += cur_e - cur_a
+                    cur_a, cur_e = a, e
+                else:
+                    cur_e = max(cur_e, e)
+            if cur_e is not None:
+                worked += cur_e - cur_a
+            if worked > OVERTIME_LIMIT:
+                rows.append((driver, pd.Timedelta(worked), s))
+    return pd.DataFrame(rows, columns=['personnel_num', 'total_work_time', 'period_start']).drop_duplicates()
+
+
+def normalize(df: pd.DataFrame) -> pd.DataFrame:
+    return df.sort_values(['personnel_num', 'period_start']).reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Overtime engine: brute-force check and scaling benchmark')
+    args.add_argument('--checks', type=int, default=200, help='randomized sets compared with brute force')
+    args.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000, 10_000_000])
+    opts = args.parse_args()
+
+    for seed in range(opts.checks):
+        waybills = random_shifts(drivers=3, shifts=15, seed=seed)
+        expected = normalize(brute_force(waybills))
+        actual = normalize(overtime_violations(waybills))
+        pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
+    print('{} randomized sets match brute force'.format(opts.checks))
+
+    print('{:>12} {:>12} {:>12}'.format('waybills', 'seconds', 'violations'))
+    for size in opts.sizes:
+        waybills = random_shifts(drivers=max(1, size // 500), shifts=min(size, 500))
+        t0 = time.perf_counter()
+        violations = overtime_violations(waybills)
+        print('{:>12} {:>12.2f} {:>12}'.format(len(waybills), time.perf_counter() - t0, len(violations)))
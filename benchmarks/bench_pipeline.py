@@ -0,0 +1,293 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+import datetime
+import tempfile
+import subprocess
+
+import pandas as pd
+
+from sqlalchemy import create_engine
+from sqlalchemy.sql import text
+
+sys.path.insert(0, __file__.rsplit('/benchmarks/', 1)[0])
+from etl.clients import known_client_cards, new_client_cards
+from etl.drivers_cache import DriversCache
+from etl.dtypes import compact, use_arrow_strings
+from etl.extract import read_sql_chunked
+from etl.facts import build_fact_rides, build_fact_waybills
+from etl.loader import copy_upsert
+from etl.marts import EPOCH_DT, clients_touched_since, date_range, mart_jobs, mart_plan_checks
+from etl.metrics import StageMetrics
+from etl.payments import iter_payments, load_payments
+from etl.rollup import refresh_agg_driver_day
+from etl.scheduler import SUCCESS, run_jobs
+from etl.schema import FACT_PARTITIONS, check_plans, ensure_partitions, maintain_schema, migrate_schema
+from etl.scd2 import DIM_CARS, DIM_CLIENTS, DIM_DRIVERS, OPEN_END_DT, merge_scd2
+from etl.waybills import WaybillStreamParser
+from benchmarks.synthetic import generate, personnel_nums, write_payment_files, write_waybill_files
+
+ROOT = __file__.rsplit('/benchmarks/', 1)[0]
+HISTORY_FILE = os.path.join(ROOT, 'benchmarks', 'history.jsonl')
+
+
+# Прогон всего батча на синтетических данных: извлечение (FTP или локальные файлы, БД источника),
+# трансформация фактов, загрузка фактов и измерений и построение витрин.
+# Этапы с БД выполняются только при заданном BENCH_DB_URI (отдельная база, схемы main и dwh_kazan пересоздаются)
+
+
+def git_commit() -> str:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT, capture_output=True, text=True).stdout
+    except OSError:
+        return 'unknown'
+    return commit + ('-dirty' if dirty.strip() else '')
+
+
+def strip_plates(chunk: pd.DataFrame) -> pd.DataFrame:
+    chunk['car_plate_num'] = chunk['car_plate_num'].str.strip()
+    return chunk
+
+
+# Исходные файлы: через локальный FTP-стенд (как в dwh_etl) или копированием, если FTP не нужен
+def extract_files(metrics: StageMetrics, remote: str, local: str, opts) -> tuple:
+    for dir in ['waybills', 'payments']:
+        os.makedirs(os.path.join(local, dir), exist_ok=True)
+
+    if opts.no_ftp:
+        with metrics.stage('extract_waybills') as stat, WaybillStreamParser(files_per_task=opts.files_per_task) as parser:
+            names = sorted(os.listdir(os.path.join(remote, 'waybills')))
+            for name in names:
+                parser.add(shutil.copy(os.path.join(remote, 'waybills', name), os.path.join(local, 'waybills', name)))
+            waybills = parser.result()
+            stat['rows_in'], stat['rows_out'] = len(names), len(waybills)
+        with metrics.stage('extract_payments') as stat:
+            shutil.copytree(os.path.join(remote, 'payments'), os.path.join(local, 'payments'), dirs_exist_ok=True)
+            payments = list(iter_payments(os.path.join(local, 'payments'), chunk_size=opts.payments_chunk_size))
+            stat['rows_out'] = sum(len(chunk) for chunk in payments)
+        return waybills, payments
+
+    from benchmarks.stand import FtpStand
+    with FtpStand(remote, port=0) as ftp:
+        downloader = ftp.downloader(local, workers=opts.ftp_workers)
+        with metrics.stage('extract_waybills') as stat, WaybillStreamParser(files_per_task=opts.files_per_task) as parser:
+            names = downloader.get_delta_items('waybills', EPOCH_DT, skip_known=False, on_file=parser.add)
+            waybills = parser.result()
+            stat['rows_in'], stat['rows_out'] = len(names), len(waybills)
+            stat['bytes'] = downloader.dir_bytes.get('waybills', 0)
+        with metrics.stage('extract_payments') as stat:
+            stat['rows_in'] = len(downloader.get_delta_items('payments', EPOCH_DT))
+            payments = list(iter_payments(os.path.join(local, 'payments'), chunk_size=opts.payments_chunk_size))
+            stat['rows_out'] = sum(len(chunk) for chunk in payments)
+            stat['bytes'] = downloader.dir_bytes.get('payments', 0)
+    return waybills, payments
+
+
+# Таблицы источника: из БД стенда или (без БД) прямо из сгенерированного набора
+def extract_source(metrics: StageMetrics, data: dict, engine, cache_path: str, opts) -> tuple:
+    if engine is None:
+        with metrics.stage('extract_rides') as stat:
+            rides = compact(data['rides'].copy(), 'rides')
+            stat['rows_out'] = len(rides)
+        with metrics.stage('extract_movement') as stat:
+            movement = compact(data['movement'].set_index('movement_id'), 'movement')
+            stat['rows_out'] = len(movement)
+        drivers = pd.DataFrame({
+            'personnel_num': personnel_nums(data['drivers']),
+            'driver_license': data['drivers']['driver_license']
+        })
+        return rides, movement, drivers, None
+
+    with metrics.stage('extract_rides') as stat:
+        rides = read_sql_chunked(
+            engine, 'SELECT * FROM main.rides WHERE dt > %(dt)s', name='main.rides',
+            params={'dt': EPOCH_DT}, chunksize=opts.source_chunk_size, source='rides'
+        )
+        stat['rows_out'] = len(rides)
+    with metrics.stage('extract_movement') as stat:
+        movement = read_sql_chunked(
+            engine, 'SELECT * FROM main.movement WHERE dt > %(dt)s', name='main.movement',
+            params={'dt': EPOCH_DT}, chunksize=opts.source_chunk_size, transform=strip_plates,
+            source='movement', index_col='movement_id'
+        )
+        stat['rows_out'] = len(movement)
+    drivers_cache = DriversCache(cache_path)
+    with metrics.stage('extract_drivers') as stat:
+        stat['rows_out'] = drivers_cache.refresh(engine, chunksize=opts.source_chunk_size)
+    return rides, movement, drivers_cache.license_lookup(), drivers_cache
+
+
+# Версии измерений в формате, который готовит dwh_etl
+def dim_updates(engine, data: dict, rides: pd.DataFrame, drivers_cache: DriversCache) -> dict:
+    car_pool = data['car_pool']
+    cars = pd.DataFrame({
+        'plate_num': car_pool['plate_num'],
+        'start_dt': car_pool['update_dt'],
+        'model_name': car_pool['model'],
+        'revision_dt': car_pool['revision_dt'],
+        'end_dt': OPEN_END_DT
+    })
+    known = known_client_cards(engine, rides['client_phone'].dropna().unique().tolist())
+    return {
+        'dim_cars': (DIM_CARS, cars),
+        'dim_drivers': (DIM_DRIVERS, drivers_cache.changed_since(EPOCH_DT)),
+        'dim_clients': (DIM_CLIENTS, new_client_cards(rides, known))
+    }
+
+
+def run(scale: float, opts) -> StageMetrics:
+    start_dt = datetime.datetime.combine(opts.start_dt, datetime.time())
+    metrics = StageMetrics('bench_pipeline', datetime.datetime.now())
+    loaded_until = start_dt + datetime.timedelta(days=opts.days)
+    engine = None
+    if os.environ.get('BENCH_DB_URI'):
+        # Витрины обращаются к таблицам хранилища без схемы
+        engine = create_engine(
+            os.environ['BENCH_DB_URI'], pool_size=opts.marts_workers, connect_args={'options': '-csearch_path=dwh_kazan'}
+        )
+
+    with metrics.stage('generate') as stat:
+        data = generate(scale=scale, days=opts.days, start_dt=start_dt, seed=opts.seed)
+        stat['rows_out'] = sum(len(df) for df in data.values())
+
+    with tempfile.TemporaryDirectory() as tmp:
+        remote, local = os.path.join(tmp, 'ftp'), os.path.join(tmp, 'local')
+        with metrics.stage('write_files') as stat:
+            stat['rows_out'] = len(write_waybill_files(os.path.join(remote, 'waybills'), data['waybills']))
+            stat['rows_out'] += len(write_payment_files(os.path.join(remote, 'payments'), data['payments']))
+
+        if engine is not None:
+            from benchmarks.stand import create_dwh, create_source
+            with metrics.stage('prepare_db') as stat:
+                create_source(engine, data)
+                create_dwh(engine)
+                migrate_schema(engine)
+            # Партиции фактовых таблиц на весь период набора, как их держит dwh_etl
+            with metrics.stage('load_schema') as stat:
+                stat['rows_out'] = len(maintain_schema(engine, loaded_until.date()))
+                with engine.begin() as conn:
+                    for table in FACT_PARTITIONS:
+                        stat['rows_out'] += len(ensure_partitions(conn, table, start_dt.date(), loaded_until.date()))
+
+        waybills, payments = extract_files(metrics, remote, local, opts)
+        rides, movement, drivers, drivers_cache = extract_source(metrics, data, engine, os.path.join(tmp, 'drivers.sqlite'), opts)
+
+        with metrics.stage('transform_fact_waybills', rows_in=len(waybills)) as stat:
+            fact_waybills = build_fact_waybills(waybills, drivers)
+            stat['rows_out'] = len(fact_waybills)
+        with metrics.stage('transform_fact_rides', rows_in=len(movement)) as stat:
+            fact_rides, _ = build_fact_rides(movement, rides, fact_waybills)
+            stat['rows_out'] = len(fact_rides)
+
+        if engine is None:
+            return metrics
+
+        for table, df in [('fact_rides', fact_rides), ('fact_waybills', fact_waybills)]:
+            with metrics.stage('load_' + table, rows_in=len(df)) as stat:
+                stat['rows_out'], _ = copy_upsert(engine, df, table)
+        with metrics.stage('load_agg_driver_day') as stat:
+            stat['rows_out'], _ = refresh_agg_driver_day(engine, start_dt.date(), loaded_until.date())
+        with metrics.stage('load_fact_payments') as stat:
+            stat['rows_in'], stat['rows_out'] = 0, 0
+            for chunk in payments:
+                stat['rows_in'] += len(chunk)
+                stat['rows_out'] += load_payments(engine, chunk)[0]
+        for table, (dim, updates) in dim_updates(engine, data, rides, drivers_cache).items():
+            with metrics.stage('load_' + table, rows_in=len(updates)) as stat:
+                _, stat['rows_out'] = merge_scd2(engine, dim, updates)
+
+    # Витрины за все полные дни набора, затем историчная витрина по всем клиентам
+    engine.execute(
+        text("INSERT INTO dwh_kazan.work_batchdate (loaded_until, status) VALUES(:dt, :st)"),
+        {'dt': loaded_until, 'st': 'Success'}
+    )
+    days = date_range(start_dt.date(), loaded_until.date() - datetime.timedelta(days=1))
+    # Ошибка витрины не прерывает прогон: run_jobs пишет статус Failure в замер задачи
+    with metrics.stage('data_marts'):
+        status = run_jobs(mart_jobs(engine, days, clients_touched_since(engine, EPOCH_DT)), workers=opts.marts_workers, metrics=metrics)
+    for name, job_status in sorted(status.items()):
+        if job_status != SUCCESS:
+            print('job {}: {}'.format(name, job_status))
+
+    # Запросы витрин за день не должны читать партиции других месяцев
+    with engine.connect() as conn:
+        for problem in check_plans(conn, mart_plan_checks(days[-1])):
+            print('plan check failed: ' + problem)
+    return metrics
+
+
+# История замеров: одна строка на этап, с коммитом и масштабом, чтобы сравнивать запуски между коммитами
+def save_history(path: str, commit: str, scale: float, days: int, metrics: StageMetrics):
+    with open(path, 'a') as file:
+        for record in metrics.records:
+            file.write(json.dumps({
+                'commit': commit,
+                'run_dt': metrics.batch_start_dt.isoformat(timespec='seconds'),
+                'scale': scale,
+                'days': days,
+                'stage': record['stage'],
+                'duration_sec': record['duration_sec'],
+                'rows_out': record['rows_out'],
+                'peak_rss_mb': record['peak_rss_mb'],
+                'status': record['status']
+            }) + '\n')
+
+
+# Последний замер того же масштаба на другом коммите (упавшие этапы не сравниваем)
+def previous_run(path: str, commit: str, scale: float, days: int) -> dict:
+    if not os.path.exists(path):
+        return {}
+    history = pd.read_json(path, lines=True)
+    history = history[(history['scale'] == scale) & (history['days'] == days) & (history['commit'] != commit)]
+    if 'status' in history:
+        history = history[history['status'].fillna(SUCCESS) == SUCCESS]
+    if history.empty:
+        return {}
+    last = history[history['run_dt'] == history['run_dt'].max()]
+    return dict(zip(last['stage'], last['duration_sec']))
+
+
+def report(metrics: StageMetrics, previous: dict):
+    print('{:<26} {:>12} {:>10} {:>10} {:>8} {:>10} {:>8}'.format('stage', 'rows', 'seconds', 'previous', 'change', 'peak MB', 'status'))
+    for record in metrics.records:
+        before = previous.get(record['stage'])
+        change = '{:+.0%}'.format(record['duration_sec'] / before - 1) if before else ''
+        print('{:<26} {:>12} {:>10.2f} {:>10} {:>8} {:>10.0f} {:>8}'.format(
+            record['stage'], record['rows_out'] if record['rows_out'] is not None else '', record['duration_sec'],
+            '{:.2f}'.format(before) if before else '', change, record['peak_rss_mb'], record['status']
+        ))
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Whole pipeline benchmark on synthetic data (DB stages need BENCH_DB_URI)')
+    args.add_argument('--scale', type=float, nargs='+', default=[1, 10], help='multiples of the hackathon daily volume (1 to 1000)')
+    args.add_argument('--days', type=int, default=1)
+    args.add_argument('--start-dt', type=datetime.date.fromisoformat, default=datetime.date(2022, 11, 4))
+    args.add_argument('--seed', type=int, default=0)
+    args.add_argument('--no-ftp', action='store_true', help='read generated files directly instead of the local FTP stand')
+    args.add_argument('--ftp-workers', type=int, default=4)
+    args.add_argument('--files-per-task', type=int, default=500)
+    args.add_argument('--payments-chunk-size', type=int, default=100000)
+    args.add_argument('--source-chunk-size', type=int, default=50000)
+    args.add_argument('--marts-workers', type=int, default=4)
+    args.add_argument('--history', default=HISTORY_FILE, help='JSON lines file with timings of previous runs')
+    opts = args.parse_args()
+
+    use_arrow_strings()
+    commit = git_commit()
+    failed = []
+    for scale in opts.scale:
+        print('scale {:g}x, {} day(s), commit {}'.format(scale, opts.days, commit))
+        previous = previous_run(opts.history, commit, scale, opts.days)
+        metrics = run(scale, opts)
+        report(metrics, previous)
+        save_history(opts.history, commit, scale, opts.days, metrics)
+        failed += ['{} ({:g}x)'.format(record['stage'], scale) for record in metrics.records if record['status'] != SUCCESS]
+
+    # Замер с упавшими этапами или витринами не сравним с остальными
+    if failed:
+        print('failed: ' + ', '.join(failed))
+        sys.exit(1)
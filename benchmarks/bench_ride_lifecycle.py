@@ -0,0 +1,75 @@
+import sys
+import time
+import argparse
+import tracemalloc
+
+import pandas as pd
+
+sys.path.insert(0, __file__.rsplit('/benchmarks/', 1)[0])
+from etl.rides import ride_lifecycle
+from benchmarks.synthetic import generate
+
+
+# Прежняя сборка: pivot статусов + фильтр завершающих статусов + merge (падает на повторах статусов)
+def ride_lifecycle_pivot(movement: pd.DataFrame) -> pd.DataFrame:
+    rides_time = movement.pivot(index='ride', columns='event', values='dt')
+    rides_time['END'] = rides_time['END'].fillna(rides_time['CANCEL'])
+    rides_time = rides_time.reindex(columns=['READY', 'BEGIN', 'END'])
+    rides_time = rides_time.rename(columns={'READY':'ride_arrival_dt', 'BEGIN':'ride_start_dt', 'END':'ride_end_dt'})
+    rides_finish = movement.query("event == 'END' or event == 'CANCEL'")
+    return rides_finish[['ride', 'car_plate_num']].merge(rides_time, how='left', on='ride')
+
+
+# Время и пиковая память (по tracemalloc, только выделения внутри вызова)
+def measure(func, movement: pd.DataFrame):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    result = func(movement)
+    duration = time.perf_counter() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, duration, peak / 2**20
+
+
+def normalize(df: pd.DataFrame) -> pd.DataFrame:
+    df = df.astype({'car_plate_num': str})
+    return df.sort_values('ride').reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Ride lifecycle builder on synthetic movement streams')
+    args.add_argument('--events', type=int, nargs='+', default=[1_000_000, 10_000_000, 50_000_000])
+    args.add_argument('--duplicates', type=float, default=0.01, help='share of repeated events')
+    args.add_argument('--compare-up-to', type=int, default=10_000_000, help='run the pivot builder up to this size')
+    opts = args.parse_args()
+
+    # Без повторов результат должен совпадать с прежней сборкой (порядок строк перемешан)
+    movement = generate(rides=100_000, sources=['movement'])['movement'].sample(frac=1, random_state=0)
+    pd.testing.assert_frame_equal(
+        normalize(ride_lifecycle(movement)), normalize(ride_lifecycle_pivot(movement)), check_dtype=False
+    )
+    print('lifecycle matches pivot builder on a stream without duplicates')
+
+    print('{:>12} {:>12} {:>10} {:>12} {:>10} {:>12} {:>12}'.format(
+        'events', 'movement MB', 'seconds', 'peak MB', 'pivot s', 'pivot MB', 'rides'
+    ))
+    for events in opts.events:
+        # В среднем ~2.9 статуса на поездку
+        rides = int(events / 2.9)
+        movement = generate(rides=rides, cars=max(1, rides // 50), sources=['movement'])['movement']
+        movement_mb = movement.memory_usage(deep=True).sum() / 2**20
+        result, duration, peak = measure(ride_lifecycle, movement)
+        pivot_duration, pivot_peak = float('nan'), float('nan')
+        if len(movement) <= opts.compare_up_to:
+            _, pivot_duration, pivot_peak = measure(ride_lifecycle_pivot, movement)
+        print('{:>12} {:>12.0f} {:>10.2f} {:>12.0f} {:>10.2f} {:>12.0f} {:>12}'.format(
+            len(movement), movement_mb, duration, peak, pivot_duration, pivot_peak, len(result)
+        ))
+        del movement, result
+
+    # Поток с повторами и перемешанными статусами: pivot падает, новая сборка детерминирована
+    movement = generate(rides=100_000, sources=['movement'], duplicate_share=opts.duplicates)['movement']
+    first = ride_lifecycle(movement)
+    second = ride_lifecycle(movement.sample(frac=1, random_state=1))
+    pd.testing.assert_frame_equal(normalize(first), normalize(second))
+    print('{:.0%} duplicated events: same result for any row order'.format(opts.duplicates))
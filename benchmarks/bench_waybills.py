@@ -0,0 +1,62 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import pandas as pd
+
+sys.path.insert(0, __file__.rsplit('/benchmarks/', 1)[0])
+from etl.waybills import WaybillStreamParser, list_waybill_files, read_waybills
+from benchmarks.synthetic import generate, write_waybill_files
+
+XSL_FILE = os.path.join(__file__.rsplit('/benchmarks/', 1)[0], 'waybill.xsl')
+
+
+# Старая реализация: read_xml + XSLT на каждый файл и concat в цикле
+def read_waybills_xsl(waybills_dir: str) -> pd.DataFrame:
+    waybills = pd.DataFrame()
+    for file in sorted(os.listdir(waybills_dir)):
+        if file.endswith('.xml'):
+            waybills = pd.concat([waybills, pd.read_xml(os.path.join(waybills_dir, file), stylesheet=XSL_FILE)], ignore_index=True)
+    return waybills
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Waybill XML ingest benchmark')
+    args.add_argument('--files', type=int, default=100_000)
+    args.add_argument('--chunk-size', type=int, default=10_000)
+    args.add_argument('--workers', type=int, default=None)
+    args.add_argument('--xsl-limit', type=int, default=2_000, help='run the old read_xml loop only up to this many files')
+    opts = args.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        t0 = time.perf_counter()
+        # За сутки на машину приходится 4 путевых листа
+        waybills = generate(cars=-(-opts.files // 4), sources=['waybills'])['waybills']
+        write_waybill_files(tmp, waybills.head(opts.files))
+        print('generated {} files in {:.1f} s'.format(opts.files, time.perf_counter() - t0))
+
+        t0 = time.perf_counter()
+        waybills = read_waybills(tmp, chunk_size=opts.chunk_size, workers=opts.workers)
+        print('streaming parser: {} rows in {:.2f} s'.format(len(waybills), time.perf_counter() - t0))
+
+        # Частями через on_frame, как extract_waybills пишет их в зону приземления
+        t0 = time.perf_counter()
+        chunks = []
+        with WaybillStreamParser(on_frame=lambda frame: chunks.append(len(frame)), workers=opts.workers, chunk_size=opts.chunk_size) as parser:
+            for path in list_waybill_files(tmp):
+                parser.add(path)
+            parser.finish()
+        print('chunked parsing: max {} rows per chunk in {:.2f} s'.format(max(chunks, default=0), time.perf_counter() - t0))
+
+        if opts.files <= opts.xsl_limit:
+            t0 = time.perf_counter()
+            old = read_waybills_xsl(tmp)
+            print('read_xml + xsl + concat: {} rows in {:.2f} s'.format(len(old), time.perf_counter() - t0))
+            # Потоковый разбор отдает строки в порядке завершения задач
+            old = old.astype({'number': str}).sort_values('number', ignore_index=True)
+            waybills = waybills.astype({'number': str}).sort_values('number', ignore_index=True)
+            for column in ['number', 'car', 'license']:
+                assert (old[column].astype(str) == waybills[column]).all(), column
+            assert (pd.to_datetime(old['start']) == waybills['start']).all()
@@ -0,0 +1,234 @@
+import threading
+
+from ftplib import FTP
+
+from etl.ftp import FtpDownloader
+from etl.loader import copy_append
+
+
+# Локальный стенд для бенчмарков: таблицы источника (схема main) и хранилища (схема dwh_kazan)
+# в отдельной БД Postgres и FTP-сервер на pyftpdlib вместо FTP организатора
+
+SOURCE_DDL = [
+    'DROP SCHEMA IF EXISTS main CASCADE',
+    'CREATE SCHEMA main',
+    '''
+    CREATE TABLE main.rides (
+        ride_id integer PRIMARY KEY,
+        dt timestamp,
+        client_phone varchar(18),
+        card_num varchar(19),
+        point_from varchar(200),
+        point_to varchar(200),
+        distance numeric(5, 2),
+        price numeric(7, 2)
+    )
+    ''',
+    '''
+    CREATE TABLE main.movement (
+        movement_id integer PRIMARY KEY,
+        car_plate_num char(9),
+        ride integer,
+        event varchar(6),
+        dt timestamp
+    )
+    ''',
+    '''
+    CREATE TABLE main.car_pool (
+        plate_num char(9) PRIMARY KEY,
+        model varchar(30),
+        revision_dt date,
+        register_dt date,
+        finished_flg char(1),
+        update_dt timestamp
+    )
+    ''',
+    '''
+    CREATE TABLE main.drivers (
+        driver_license char(12) PRIMARY KEY,
+        first_name varchar(20),
+        last_name varchar(20),
+        middle_name varchar(20),
+        driver_valid_to date,
+        card_num char(19),
+        update_dt timestamp,
+        birth_dt date
+    )
+    ''',
+    'CREATE INDEX ON main.rides (dt)',
+    'CREATE INDEX ON main.movement (dt)',
+    'CREATE INDEX ON main.drivers (update_dt)',
+    'CREATE INDEX ON main.car_pool (update_dt)'
+]
+
+DWH_DDL = [
+    'DROP SCHEMA IF EXISTS dwh_kazan CASCADE',
+    'CREATE SCHEMA dwh_kazan',
+    '''
+    CREATE TABLE dwh_kazan.fact_rides (
+        ride_id integer PRIMARY KEY,
+        point_from_txt varchar(200),
+        point_to_txt varchar(200),
+        distance_val numeric(5, 2),
+        price_amt numeric(7, 2),
+        client_phone_num varchar(18),
+        driver_pers_num varchar(32),
+        car_plate_num varchar(9),
+        ride_arrival_dt timestamp,
+        ride_start_dt timestamp,
+        ride_end_dt timestamp
+    )
+    ''',
+    '''
+    CREATE TABLE dwh_kazan.fact_waybills (
+        waybill_num varchar(20) PRIMARY KEY,
+        driver_pers_num varchar(32),
+        car_plate_num varchar(9),
+        work_start_dt timestamp,
+        work_end_dt timestamp,
+        issue_dt timestamp
+    )
+    ''',
+    '''
+    CREATE TABLE dwh_kazan.fact_payments (
+        transaction_id varchar(32) PRIMARY KEY,
+        card_num varchar(16),
+        transaction_amt numeric(7, 2),
+        transaction_dt timestamp
+    )
+    ''',
+    '''
+    CREATE TABLE dwh_kazan.dim_cars (
+        plate_num varchar(9),
+        start_dt timestamp,
+        model_name varchar(30),
+        revision_dt date,
+        deleted_flag char(1) DEFAULT 'N',
+        end_dt timestamp,
+        PRIMARY KEY (plate_num, start_dt)
+    )
+    ''',
+    '''
+    CREATE TABLE dwh_kazan.dim_drivers (
+        personnel_num varchar(32),
+        start_dt timestamp,
+        last_name varchar(20),
+        first_name varchar(20),
+        middle_name varchar(20),
+        birth_dt date,
+        card_num varchar(19),
+        driver_license_num varchar(12),
+        driver_license_dt date,
+        deleted_flag char(1) DEFAULT 'N',
+        end_dt timestamp,
+        PRIMARY KEY (personnel_num, start_dt)
+    )
+    ''',
+    '''
+    CREATE TABLE dwh_kazan.dim_clients (
+        phone_num varchar(18),
+        start_dt timestamp,
+        card_num varchar(19),
+        deleted_flag char(1) DEFAULT 'N',
+        end_dt timestamp,
+        PRIMARY KEY (phone_num, start_dt)
+    )
+    ''',
+    '''
+    CREATE TABLE dwh_kazan.rep_drivers_payments (
+        personnel_num varchar(32),
+        last_name varchar(20),
+        first_name varchar(20),
+        middle_name varchar(20),
+        card_num varchar(19),
+        amount numeric(10, 2),
+        report_dt date
+    )
+    ''',
+    '''
+    CREATE TABLE dwh_kazan.rep_drivers_violations (
+        personnel_num varchar(32),
+        ride integer,
+        speed numeric(7, 2),
+        violations_cnt integer
+    )
+    ''',
+    '''
+    CREATE TABLE dwh_kazan.rep_drivers_overtime (
+        personnel_num varchar(32),
+        total_work_time interval,
+        period_start timestamp
+    )
+    ''',
+    '''
+    CREATE TABLE dwh_kazan.rep_clients_hist (
+        client_id varchar(32),
+        phone_num varchar(18),
+        rides_cnt integer,
+        cancelled_cnt integer,
+        spent_amt numeric(12, 2),
+        debt_amt numeric(12, 2),
+        start_dt timestamp,
+        end_dt timestamp,
+        deleted_flag char(1),
+        CONSTRAINT rep_clients_hist_pk PRIMARY KEY (client_id)
+    )
+    ''',
+    '''
+    CREATE TABLE dwh_kazan.work_batchdate (
+        loaded_until timestamp,
+        status varchar(10)
+    )
+    '''
+]
+
+
+def create_source(engine, data: dict):
+    for sql in SOURCE_DDL:
+        engine.execute(sql)
+    for table in ['car_pool', 'drivers', 'rides', 'movement']:
+        copy_append(engine, data[table], table, schema='main')
+    engine.execute('ANALYZE')
+
+
+def create_dwh(engine):
+    for sql in DWH_DDL:
+        engine.execute(sql)
+
+
+# FTP-сервер в отдельном потоке, корень - директория с подкаталогами waybills и payments
+class FtpStand:
+
+    def __init__(self, root: str, port: int = 2121, user: str = 'bench', passwd: str = 'bench'):
+        # pyftpdlib нужен только FTP-стенду: create_source и create_dwh работают без него
+        from pyftpdlib.authorizers import DummyAuthorizer
+        from pyftpdlib.handlers import FTPHandler
+        from pyftpdlib.servers import FTPServer
+
+        authorizer = DummyAuthorizer()
+        authorizer.add_user(user, passwd, root, perm='elr')
+        handler = type('BenchFTPHandler', (FTPHandler,), {'authorizer': authorizer})
+        self.server = FTPServer(('127.0.0.1', port), handler)
+        self.port = self.server.address[1]
+        self.user = user
+        self.passwd = passwd
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'handle_exit': False}, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.close_all()
+
+    def downloader(self, local_root: str, workers: int = 4) -> FtpDownloader:
+        return FtpDownloader(
+            host='127.0.0.1',
+            user=self.user,
+            passwd=self.passwd,
+            local_root=local_root,
+            remote_root='',
+            workers=workers,
+            port=self.port,
+            ftp_class=FTP
+        )
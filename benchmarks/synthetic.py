@@ -0,0 +1,262 @@
+import os
+import hashlib
+import datetime
+
+import numpy as np
+import pandas as pd
+
+
+# Генерация синтетических данных в форматах источников хакатона
+
+LETTERS = 'АВЕКМНОРСТУХ'
+MODELS = ['Kia Rio', 'Hyundai Solaris', 'Volkswagen Polo']
+
+WAYBILL_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
+<waybills>
+    <waybill number="{number}" issuedt="{issuedt}">
+        <car>{car}</car>
+        <model>{model}</model>
+        <driver>
+            <name>{name}</name>
+            <license>{license}</license>
+            <validto>{validto}</validto>
+        </driver>
+        <period>
+            <start>{start}</start>
+            <stop>{stop}</stop>
+        </period>
+    </waybill>
+</waybills>
+'''
+
+
+def plate_num(rng) -> str:
+    letters = rng.choice(list(LETTERS), 3)
+    return '{}{:03d}{}{}{}'.format(letters[0], rng.integers(1, 1000), letters[1], letters[2], rng.choice(['77', '97', '99', '177', '190', '197']))
+
+
+def license_num(i: int) -> str:
+    return '{:02d} {:02d} {:06d}'.format(i // 10**8 % 100, i // 10**6 % 100, i % 10**6)
+
+
+def phone_num(i: int) -> str:
+    return '+7 (9{:02d}) {:03d}-{:02d}-{:02d}'.format(i // 10**7 % 100, i // 10**4 % 1000, i // 100 % 100, i % 100)
+
+
+def card_num(i: int) -> str:
+    return '{:04d} {:04d} {:04d} {:04d}'.format(4000 + i % 2000, i // 10**8 % 10**4, i // 10**4 % 10**4, i % 10**4)
+
+
+# -----------------------------------------------------------------------
+# Согласованный набор данных всех источников в масштабе хакатона (scale=1) и больше.
+# Объемы 1x оценены по выгрузкам из etl_draft.ipynb: ~590 заказов, ~110 путевых листов
+# и ~200 платежей за 6 часов, ~4000 водителей
+# -----------------------------------------------------------------------
+
+HACKATHON_DAY = {
+    'rides': 2400,
+    'cars': 150,
+    'drivers': 4000,
+    'payments_share': 1 / 3
+}
+
+FIRST_NAMES = ['Алан', 'Антон', 'Богдан', 'Даниэль', 'Игорь', 'Лев', 'Ратмир', 'Рослав', 'Сулейман', 'Тимур']
+LAST_NAMES = ['Апокашев', 'Аубокиров', 'Гашешенков', 'Денишевский', 'Заскалицкий', 'Памфилович', 'Салпиков', 'Щепановский']
+MIDDLE_NAMES = ['Алексеевич', 'Богданович', 'Иванович', 'Львович', 'Петрович', 'Русланович']
+STREETS = ['Артековская улица', 'Бирюлёвская улица', 'Линейный проезд', 'Новогорская улица', 'улица Свободы', 'Щёлковское шоссе']
+
+# Смена по путевому листу: машина работает круглосуточно тремя сменами
+SHIFT = datetime.timedelta(hours=8)
+
+
+def _choice(rng, values: list, size: int) -> list:
+    return [values[i] for i in rng.integers(0, len(values), size)]
+
+
+SOURCES = ['car_pool', 'drivers', 'rides', 'movement', 'waybills', 'payments']
+
+
+# Все источники за days дней начиная с start_dt: main.car_pool, main.drivers, main.rides, main.movement,
+# путевые листы (строки для XML) и платежи (строки для CSV). Машина в поездке всегда покрыта путевым листом,
+# платежи приходят по части завершенных поездок с карт их клиентов.
+# sources - какие таблицы собрать (по умолчанию все): у каждой таблицы свой поток случайных чисел, поэтому
+# подмножество совпадает с полным набором при том же seed. rides, cars и drivers задают объемы вместо scale,
+# duplicate_share статусов movement повторяется с небольшим сдвигом времени (как повторная отправка источником)
+def generate(
+    scale: float = 1,
+    days: int = 1,
+    start_dt: datetime.datetime = datetime.datetime(2022, 11, 4),
+    seed: int = 0,
+    sources: list = None,
+    rides: int = None,
+    cars: int = None,
+    drivers: int = None,
+    duplicate_share: float = 0.0
+) -> dict:
+    sources = set(sources or SOURCES)
+    rng = dict(zip(SOURCES, map(np.random.default_rng, np.random.SeedSequence(seed).spawn(len(SOURCES)))))
+    n_cars = cars or max(1, int(HACKATHON_DAY['cars'] * scale))
+    n_drivers = drivers or max(1, int(HACKATHON_DAY['drivers'] * scale))
+    n_rides = rides or max(1, int(HACKATHON_DAY['rides'] * scale * days))
+    start = np.datetime64(start_dt, 's')
+    data = {}
+
+    plates = list(dict.fromkeys(plate_num(rng['car_pool']) for _ in range(n_cars * 2)))[:n_cars]
+    models = rng['car_pool'].integers(0, len(MODELS), len(plates))
+    if 'car_pool' in sources:
+        data['car_pool'] = pd.DataFrame({
+            'plate_num': plates,
+            'model': [MODELS[i] for i in models],
+            'revision_dt': (start - np.timedelta64(1, 'D')).astype('datetime64[D]'),
+            'register_dt': (start - np.timedelta64(30, 'D')).astype('datetime64[D]'),
+            'finished_flg': 'N',
+            'update_dt': start - rng['car_pool'].integers(3600, 86400, len(plates)).astype('timedelta64[s]')
+        })
+
+    if sources & {'drivers', 'waybills'}:
+        data['drivers'] = pd.DataFrame({
+            'driver_license': [license_num(i) for i in range(n_drivers)],
+            'first_name': _choice(rng['drivers'], FIRST_NAMES, n_drivers),
+            'last_name': [name + str(i) for i, name in enumerate(_choice(rng['drivers'], LAST_NAMES, n_drivers))],
+            'middle_name': _choice(rng['drivers'], MIDDLE_NAMES, n_drivers),
+            'driver_valid_to': np.datetime64('2030-01-01'),
+            'card_num': [card_num(10**9 + i) for i in range(n_drivers)],
+            'update_dt': start - rng['drivers'].integers(3600, 86400, n_drivers).astype('timedelta64[s]'),
+            'birth_dt': (np.datetime64('1970-01-01') + rng['drivers'].integers(0, 30 * 365, n_drivers).astype('timedelta64[D]'))
+        })
+
+    # Путевые листы: на каждую машину смены по 8 часов подряд, водитель случайный
+    if 'waybills' in sources:
+        drivers_df = data['drivers']
+        shifts = days * 3 + 1
+        shift_start = start - np.timedelta64(8, 'h') + (np.arange(shifts) * 8).astype('timedelta64[h]')
+        car_idx = np.repeat(np.arange(len(plates)), shifts)
+        shift_dt = np.tile(shift_start, len(plates))
+        driver_idx = rng['waybills'].integers(0, n_drivers, len(car_idx))
+        data['waybills'] = pd.DataFrame({
+            'number': ['{}-{:08d}'.format(LETTERS[i % len(LETTERS)], i) for i in range(len(car_idx))],
+            'issuedt': shift_dt - np.timedelta64(5, 'm'),
+            'car': [plates[i] for i in car_idx],
+            'model': [MODELS[i] for i in models[car_idx]],
+            'name': [
+                '{} {} {}'.format(last, first, middle) for last, first, middle in zip(
+                    drivers_df['last_name'].to_numpy()[driver_idx],
+                    drivers_df['first_name'].to_numpy()[driver_idx],
+                    drivers_df['middle_name'].to_numpy()[driver_idx]
+                )
+            ],
+            'license': drivers_df['driver_license'].to_numpy()[driver_idx],
+            'validto': '2030-01-01',
+            'start': shift_dt,
+            'stop': shift_dt + np.timedelta64(8, 'h')
+        })
+        if 'drivers' not in sources:
+            del data['drivers']
+
+    if not sources & {'rides', 'movement', 'payments'}:
+        return data
+
+    # Заказы равномерно по дням, клиентов в 5 раз меньше заказов. Адреса и расстояние - только для main.rides
+    client = rng['rides'].integers(0, max(1, n_rides // 5), n_rides)
+    ride_dt = np.sort(start + rng['rides'].integers(0, days * 86400, n_rides).astype('timedelta64[s]'))
+    price = rng['rides'].uniform(100, 2000, n_rides).round(2)
+    ride_id = np.arange(1, n_rides + 1, dtype=np.int64)
+    if 'rides' in sources:
+        data['rides'] = pd.DataFrame({
+            'ride_id': ride_id,
+            'dt': ride_dt,
+            'client_phone': [phone_num(c) for c in client],
+            'card_num': [card_num(c) for c in client],
+            'point_from': ['{}, {}'.format(street, house) for street, house in zip(
+                _choice(rng['rides'], STREETS, n_rides), rng['rides'].integers(1, 100, n_rides)
+            )],
+            'point_to': ['{}, {}'.format(street, house) for street, house in zip(
+                _choice(rng['rides'], STREETS, n_rides), rng['rides'].integers(1, 100, n_rides)
+            )],
+            'distance': rng['rides'].uniform(1, 40, n_rides).round(2),
+            'price': price
+        })
+
+    # Статусы: подача, начало и окончание, 10% заказов отменяются до начала
+    car = rng['movement'].integers(0, len(plates), n_rides)
+    ready = ride_dt + rng['movement'].integers(60, 600, n_rides).astype('timedelta64[s]')
+    begin = ready + rng['movement'].integers(60, 600, n_rides).astype('timedelta64[s]')
+    end = begin + rng['movement'].integers(300, 2400, n_rides).astype('timedelta64[s]')
+    cancelled = rng['movement'].random(n_rides) < 0.1
+    done = ~cancelled
+    if 'movement' in sources:
+        events = [
+            (ride_id, car, 'READY', ready),
+            (ride_id[done], car[done], 'BEGIN', begin[done]),
+            (ride_id[done], car[done], 'END', end[done]),
+            (ride_id[cancelled], car[cancelled], 'CANCEL', begin[cancelled])
+        ]
+        movement = pd.DataFrame({
+            'car_plate_num': np.asarray(plates, dtype=object)[np.concatenate([e[1] for e in events])],
+            'ride': np.concatenate([e[0] for e in events]),
+            'event': np.repeat([e[2] for e in events], [len(e[0]) for e in events]).astype(object),
+            'dt': np.concatenate([e[3] for e in events])
+        })
+        del events
+        if duplicate_share:
+            duplicates = movement.sample(frac=duplicate_share, random_state=rng['movement'])
+            duplicates['dt'] += rng['movement'].integers(1, 30, len(duplicates)).astype('timedelta64[s]')
+            movement = pd.concat([movement, duplicates], ignore_index=True)
+        movement = movement.sort_values('dt', kind='mergesort', ignore_index=True)
+        movement.insert(0, 'movement_id', np.arange(1, len(movement) + 1, dtype=np.int64))
+        data['movement'] = movement
+
+    # Платежи: часть завершенных поездок оплачивается с карты клиента через несколько минут после окончания
+    if 'payments' in sources:
+        paid = np.flatnonzero(done & (rng['payments'].random(n_rides) < HACKATHON_DAY['payments_share']))
+        data['payments'] = pd.DataFrame({
+            'transaction_dt': end[paid] + rng['payments'].integers(60, 3600, len(paid)).astype('timedelta64[s]'),
+            'card_num': [card_num(c) for c in client[paid]],
+            'transaction_amt': price[paid]
+        }).sort_values('transaction_dt', kind='mergesort', ignore_index=True)
+
+    return data
+
+
+# Табельный номер водителя, как его считает источник: md5(last_name || first_name || middle_name || birth_dt)
+def personnel_nums(drivers: pd.DataFrame) -> list:
+    keys = drivers['last_name'] + drivers['first_name'] + drivers['middle_name'] + pd.to_datetime(drivers['birth_dt']).dt.strftime('%Y-%m-%d')
+    return [hashlib.md5(key.encode('utf-8')).hexdigest() for key in keys]
+
+
+# Путевые листы набора в XML по одному на файл (формат, который разбирает waybill.xsl)
+def write_waybill_files(dir: str, waybills: pd.DataFrame) -> list:
+    os.makedirs(dir, exist_ok=True)
+    names = []
+    for row in waybills.itertuples(index=False):
+        name = 'waybill_{}.xml'.format(row.number)
+        with open(os.path.join(dir, name), 'w', encoding='utf-8') as file:
+            file.write(WAYBILL_TEMPLATE.format(
+                number=row.number,
+                issuedt=row.issuedt.isoformat(),
+                car=row.car,
+                model=row.model,
+                name=row.name,
+                license=row.license,
+                validto=row.validto,
+                start=row.start.isoformat(),
+                stop=row.stop.isoformat()
+            ))
+        names.append(name)
+    return names
+
+
+# Платежи набора в CSV с табуляцией, один файл на каждые hours часов (как выгрузки источника)
+def write_payment_files(dir: str, payments: pd.DataFrame, hours: int = 1) -> list:
+    os.makedirs(dir, exist_ok=True)
+    names = []
+    period = payments['transaction_dt'].dt.floor('{}h'.format(hours))
+    for start, rows in payments.groupby(period, sort=True):
+        name = 'payment_{}.csv'.format(start.strftime('%Y-%m-%d_%H-%M'))
+        pd.DataFrame({
+            'transaction_dt': rows['transaction_dt'].dt.strftime('%d.%m.%Y %H:%M:%S'),
+            'card_num': rows['card_num'].str.replace(' ', '', regex=False),
+            'transaction_amt': rows['transaction_amt']
+        }).to_csv(os.path.join(dir, name), sep='\t', header=False, index=False)
+        names.append(name)
+    return names
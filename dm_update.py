@@ -1,10 +1,19 @@
 import os
+import sys
+import argparse
 import datetime
 
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
 from loguru import logger
 
+from etl.db import create_pooled_engine
+from etl.metrics import StageMetrics
+from etl.marts import (
+    build_marts, clients_touched_since, date_range, ensure_work_tables, log_marts_batch, mart_plan_checks, marts_to_build,
+    release_touched
+)
+from etl.schema import check_plans
+
 # Загружаем credentials из переменных окружения
 load_dotenv()
 SOURCE_DB_URI = os.environ['SOURCE_DB_URI']
@@ -13,9 +22,26 @@ SOURCE_FTP_USER = os.environ['SOURCE_FTP_USER']
 SOURCE_FTP_PWD = os.environ['SOURCE_FTP_PWD']
 DWH_DB_URI = os.environ['DWH_DB_URI']
 
+# Режим перестроения витрин за произвольный период: --backfill-from 2022-11-01 --backfill-to 2022-11-30
+args = argparse.ArgumentParser(description='Data marts update')
+args.add_argument('--backfill-from', type=datetime.date.fromisoformat, default=None)
+args.add_argument('--backfill-to', type=datetime.date.fromisoformat, default=None)
+# Проверка планов запросов витрин за каждый строящийся день (отсечение партиций фактовых таблиц)
+args.add_argument('--check-plans', action='store_true')
+args = args.parse_args()
+
+# Файл для метрик этапов (*.json или Prometheus textfile), необязательный
+METRICS_FILE = os.environ.get('METRICS_FILE')
+
+# Количество витрин, строящихся одновременно (и размер пула соединений с хранилищем)
+MARTS_WORKERS = int(os.environ.get('MARTS_WORKERS', 4))
+
 # Время запуска скрипта
 update_start_dt = datetime.datetime.now()
 
+# Метрики по этапам запуска
+metrics = StageMetrics('dm_update', update_start_dt)
+
 # -----------------------------------------------------------------------
 # Data Marts - Обновление витрин данных для отчетности
 # -----------------------------------------------------------------------
@@ -24,170 +50,59 @@ update_start_dt = datetime.datetime.now()
 
 try:
 
-    # Создаем движок для соединения с БД хранилища данных
-    dwh_db_conn = create_engine(DWH_DB_URI, connect_args={'sslmode': 'require'})
-
-    logger.info('Updating Data Marts...')
-
-    ### 1. Выплата водителям
-    # Считаем информацию по выплатам из fact_rides
-    # Джойним с информацией о водителях из dim_drivers
-    dwh_db_conn.execute(
-        '''
-        INSERT INTO rep_drivers_payments
-        SELECT dd.personnel_num, dd.last_name, dd.first_name, dd.middle_name, dd.card_num, fr.amount, fr.report_dt
-        FROM
-        (
-            SELECT 
-                driver_pers_num,
-                SUM(distance_val) AS total_distance, 
-                SUM(price_amt) AS total_cash,
-                ROUND(SUM(price_amt) * 0.8 - 47.26 * 7 * SUM(distance_val) / 100 - 5 * SUM(distance_val), 2) AS amount,
-                ride_end_dt::date AS report_dt
-            FROM fact_rides
-            WHERE ride_end_dt::date = current_date - INTEGER '1' AND ride_start_dt IS NOT NULL --Только завершенные за вчера поездки
-            GROUP BY driver_pers_num, ride_end_dt::date
-        ) fr
-        JOIN 
-        (
-            SELECT 
-                personnel_num,
-                last_name,
-                first_name,
-                middle_name,
-                card_num,
-                current_date - INTEGER '1' AS report_dt
-            FROM dim_drivers
-            WHERE current_date - INTEGER '1' BETWEEN start_dt AND end_dt
-        ) dd
-        ON fr.driver_pers_num = dd.personnel_num;
-        '''
-    )
-
-    ### 2. Водители-нарушители
-    # 
-    dwh_db_conn.execute(
-        '''
-        INSERT INTO rep_drivers_violations
-        SELECT
-            q1.personnel_num, q1.ride, q1.speed,
-            COALESCE(q1.violations_cnt + q2.violations_cnt, q1.violations_cnt) AS violations_cnt
-        FROM
-        (
-            SELECT
-                driver_pers_num AS personnel_num,
-                ride_id AS ride,
-                ROUND(distance_val / (EXTRACT(EPOCH FROM ride_end_dt - ride_start_dt) / 3600), 2) AS speed,
-                ROW_NUMBER() OVER(PARTITION BY driver_pers_num ORDER BY ride_id) - 1 AS violations_cnt
-            FROM dwh_kazan.fact_rides
-            WHERE
-                ride_end_dt::date = current_date - INTEGER '1'
-                AND ride_start_dt IS NOT NULL
-                AND ROUND(distance_val / (EXTRACT(EPOCH FROM ride_end_dt - ride_start_dt) / 3600), 2) > 85
-        ) AS q1
-        LEFT JOIN
-        (
-            SELECT
-                personnel_num,
-                MAX(violations_cnt) + 1 AS violations_cnt
-            FROM dwh_kazan.rep_drivers_violations
-            GROUP BY personnel_num
-        ) AS q2
-        ON q1.personnel_num = q2.personnel_num;
-        '''
-    )
-
-    ### 3. Перерабатывающие водители
-    # Сначала считаем кумулятивную сумму рабочих часов по путевым листам со скользящим окном 24 часа
-    # Далее корректируем кумулятивную сумму: отсекаем то, что не вошло в 24ч интервал с момента начала предыдущей работы
-    # !некорректно считает сумму с >2 нарушениями подряд
-    dwh_db_conn.execute(
-        '''
-        INSERT INTO rep_drivers_overtime 
-        WITH wt AS
-        (
-            SELECT 
-                driver_pers_num,
-                work_end_dt - work_start_dt AS work_time,
-                SUM(work_end_dt - work_start_dt) OVER (PARTITION BY driver_pers_num ORDER BY work_start_dt RANGE INTERVAL '24 hours' PRECEDING) AS cum_work_time,
-                LAG(work_start_dt) OVER (PARTITION BY driver_pers_num ORDER BY work_start_dt RANGE INTERVAL '24 hours' PRECEDING) AS violation_period_start,
-                LAG(work_start_dt) OVER (PARTITION BY driver_pers_num ORDER BY work_start_dt RANGE INTERVAL '24 hours' PRECEDING) + INTERVAL '24 hour' - work_start_dt  AS violation_delta
-            FROM fact_waybills
-            WHERE work_start_dt::date > current_date - INTERVAL '2 day'
-        )
-        SELECT
-            driver_pers_num AS personnel_num,
-            CASE WHEN work_time > violation_delta THEN cum_work_time - work_time + violation_delta ELSE cum_work_time END AS total_work_time,
-            violation_period_start AS period_start
-        FROM wt
-        WHERE CASE WHEN work_time > violation_delta THEN cum_work_time - work_time + violation_delta ELSE cum_work_time END > '08:00:00'
-        AND violation_period_start::date = current_date - INTERVAL '1 day';       
-        '''
-    )
-
-    ### 4. “Знай своего клиента”
-    # Строим на основе dim_clients
-    # Подтягиваем информацию по поступившим платежам по каждой карте
-    # Подтягиваем информацию по поездкам и стоимости услуг для каждого номера и карты
-    # В итоге делаем UPSERT и обновляем измененные записи 
-    dwh_db_conn.execute(
-        '''
-        INSERT INTO rep_clients_hist
-        SELECT 
-            md5(dc.phone_num || dc.start_dt) AS client_id,
-            dc.phone_num,
-            COALESCE(frg.total_rides_cnt, 0) - COALESCE(frg.cancelled_cnt, 0) AS rides_cnt,
-            COALESCE(frg.cancelled_cnt, 0),
-            SUM(COALESCE(fp.paid_amt, 0)) OVER(PARTITION BY phone_num ORDER BY start_dt) AS spent_amt,
-            SUM(COALESCE(frg.total_amt, 0) - COALESCE(fp.paid_amt, 0)) OVER(PARTITION BY phone_num ORDER BY start_dt) AS debt_amt,
-            dc.start_dt,
-            dc.end_dt,
-            dc.deleted_flag
-        FROM dim_clients dc
-        LEFT JOIN
-        (
-            SELECT
-                SUBSTRING(card_num, 1, 4) || ' ' || SUBSTRING(card_num, 5, 4) || ' ' || SUBSTRING(card_num, 9, 4) || ' ' || SUBSTRING(card_num, 13, 4) AS card_num,
-                SUM(transaction_amt) AS paid_amt
-            FROM fact_payments
-            GROUP BY card_num
-        ) fp
-        ON dc.card_num = fp.card_num
-        LEFT JOIN
-        (
-            SELECT 
-                fr.client_phone_num,
-                dc.card_num,
-                COUNT(fr.ride_id) AS total_rides_cnt,
-                COUNT(CASE WHEN fr.ride_start_dt IS NULL THEN 1 ELSE NULL END) AS cancelled_cnt,
-                SUM(CASE WHEN fr.ride_start_dt IS NULL THEN NULL ELSE fr.price_amt END) AS total_amt
-            FROM fact_rides fr
-            JOIN dim_clients dc 
-            ON fr.client_phone_num = dc.phone_num AND (fr.ride_arrival_dt BETWEEN dc.start_dt AND dc.end_dt)
-            GROUP BY fr.client_phone_num, dc.card_num
-        ) frg
-        ON dc.phone_num = frg.client_phone_num AND dc.card_num = frg.card_num
-        ON CONFLICT ON CONSTRAINT rep_clients_hist_pk DO UPDATE
-        SET 
-            rides_cnt = EXCLUDED.rides_cnt, 
-            cancelled_cnt = EXCLUDED.cancelled_cnt, 
-            spent_amt = EXCLUDED.spent_amt, 
-            debt_amt = EXCLUDED.debt_amt,
-            end_dt = EXCLUDED.end_dt,
-            deleted_flag = EXCLUDED.deleted_flag;
-        '''
-    )
+    # Создаем движок с пулом соединений с БД хранилища данных
+    dwh_db_conn = create_pooled_engine(DWH_DB_URI, pool_size=MARTS_WORKERS)
+    ensure_work_tables(dwh_db_conn)
+
+    if args.backfill_from is not None:
+        # Перестраиваем витрины за указанный период по одному дню
+        # (клиенты - по времени событий с начала периода)
+        days = date_range(args.backfill_from, args.backfill_to or args.backfill_from)
+        phones = clients_touched_since(dwh_db_conn, datetime.datetime.combine(days[0], datetime.time()))
+        etl_until, touched = None, None
+    else:
+        # Строим витрины за дни, завершившиеся с прошлого успешного обновления, и за дни и клиентов,
+        # затронутых загрузками после построения
+        days, phones, etl_until, touched = marts_to_build(dwh_db_conn)
+
+    logger.info('Updating Data Marts for {} day(s), {} client(s)...', len(days), len(phones))
+
+    if args.check_plans:
+        with dwh_db_conn.connect() as conn:
+            for day in days:
+                for problem in check_plans(conn, mart_plan_checks(day)):
+                    logger.warning('Plan check failed: {}', problem)
+
+    # Витрины строятся параллельно, каждая за каждый день - в своей транзакции (удаление старого отчета + вставка нового).
+    # Ошибка одной витрины не останавливает остальные, но батч витрин не отмечается успешным
+    # и на следующем запуске дни перестраиваются заново
+    build_marts(dwh_db_conn, days, phones, workers=MARTS_WORKERS, metrics=metrics)
 
     # Время завершения и выполнения скрипта
     update_end_dt = datetime.datetime.now()
     update_duration = update_end_dt - update_start_dt
 
-    # TO-DO: Логгируем успешное выполнение в рабочую таблицу хранилища
+    # Логгируем успешное выполнение в рабочую таблицу хранилища
+    if etl_until is not None:
+        release_touched(dwh_db_conn, touched)
+        log_marts_batch(dwh_db_conn, etl_until, 'Success')
 
     logger.success("Script executed succesfully in {} seconds", update_duration.total_seconds())
 
 except Exception:
-    
-    # TO-DO: Логгируем неудачное выполнение в рабочую таблицу хранилища
 
-    logger.exception("Script executed with unexpected error")
\ No newline at end of file
+    # Логгируем неудачное выполнение в рабочую таблицу хранилища
+    log_marts_batch(dwh_db_conn, update_start_dt, 'Failure')
+
+    logger.exception("Script executed with unexpected error")
+    sys.exit(1)
+
+finally:
+
+    # Сохраняем метрики этапов в хранилище и в файл
+    try:
+        metrics.save(dwh_db_conn)
+        if METRICS_FILE:
+            metrics.write_textfile(METRICS_FILE)
+    except Exception:
+        logger.exception('Failed to save stage metrics')
@@ -1,16 +1,38 @@
 import os
+import sys
+import time
+import functools
+import argparse
 import pandas as pd
-import hashlib
 import datetime
-import pangres
 
 from dotenv import load_dotenv
-from ftplib import FTP_TLS
-from dateutil import parser
-from sqlalchemy import create_engine
 from sqlalchemy.sql import text
 from loguru import logger
 
+from etl.clients import known_client_cards, new_client_cards
+from etl.db import create_pooled_engine
+from etl.drivers_cache import DriversCache
+from etl.dtypes import concat_compact, use_arrow_strings
+from etl.extract import iter_sql_chunked, read_sql_chunked
+from etl.facts import build_fact_rides, build_fact_waybills
+from etl.ftp import FtpDownloader
+from etl.landing import LandingZone
+from etl.loader import copy_upsert
+from etl.marts import (
+    OVERTIME_WAYBILL_MAX, build_marts, date_range, ensure_work_tables, log_marts_batch, marts_to_build, release_touched,
+    touch_client_cards, touch_clients, touch_days
+)
+from etl.metrics import StageMetrics
+from etl.overtime import OVERTIME_WINDOW
+from etl.payments import iter_payments, load_payments
+from etl.rollup import refresh_agg_driver_day
+from etl.runner import BatchRunner
+from etl.schema import maintain_schema, migrate_schema
+from etl.scd2 import DIM_CARS, DIM_CLIENTS, DIM_DRIVERS, merge_scd2
+from etl.watermarks import PENDING_MAX_AGE, ensure_watermark_tables, load_watermarks, save_batch_state, split_pending
+from etl.waybills import WaybillStreamParser, empty_waybills
+
 # Загружаем credentials из переменных окружения
 load_dotenv()
 SOURCE_DB_URI = os.environ['SOURCE_DB_URI']
@@ -19,204 +41,328 @@ SOURCE_FTP_USER = os.environ['SOURCE_FTP_USER']
 SOURCE_FTP_PWD = os.environ['SOURCE_FTP_PWD']
 DWH_DB_URI = os.environ['DWH_DB_URI']
 
-# Время запуска скрипта
-etl_start_dt = datetime.datetime.now()
+# Количество параллельных сессий FTP
+FTP_WORKERS = int(os.environ.get('FTP_WORKERS', 4))
 
-# -----------------------------------------------------------------------
-# Incremental data load - Загружаем данные с последнего успешного запуска
-# -----------------------------------------------------------------------
+# Количество файлов путевых листов в одной задаче разбора (разбираются по мере скачивания)
+# и количество разобранных путевых листов, после которого они пишутся в зону приземления
+WAYBILLS_FILES_PER_TASK = int(os.environ.get('WAYBILLS_FILES_PER_TASK', 500))
+WAYBILLS_CHUNK_SIZE = int(os.environ.get('WAYBILLS_CHUNK_SIZE', 10000))
 
+# Размер пулов соединений с БД источника и хранилища (на все параллельные этапы запуска)
+SOURCE_POOL_SIZE = int(os.environ.get('SOURCE_POOL_SIZE', 4))
+DWH_POOL_SIZE = int(os.environ.get('DWH_POOL_SIZE', 2))
 
+# Количество строк платежей в одной пачке загрузки
+PAYMENTS_CHUNK_SIZE = int(os.environ.get('PAYMENTS_CHUNK_SIZE', 100000))
 
-try:
-    
-    ### EXTRACT
+# Количество строк, читаемых из БД источника за одну пачку
+SOURCE_CHUNK_SIZE = int(os.environ.get('SOURCE_CHUNK_SIZE', 50000))
 
-    # Создаем движок для соединения с БД источником
-    source_db_conn = create_engine(SOURCE_DB_URI, connect_args={'sslmode': 'require'})
+# Локальный кэш водителей источника
+DRIVERS_CACHE_PATH = os.environ.get('DRIVERS_CACHE_PATH', os.path.join(os.path.dirname(__file__), 'cache', 'drivers.sqlite'))
 
-    # Создаем движок для соединения с БД хранилища данных
-    dwh_db_conn = create_engine(DWH_DB_URI, connect_args={'sslmode': 'require'})
+# Файл для метрик этапов (*.json или Prometheus textfile), необязательный
+METRICS_FILE = os.environ.get('METRICS_FILE')
 
-    # Получаем время последнего успешного запуска
-    last_etl_dt = dwh_db_conn.execute(
-        '''
-        SELECT COALESCE(MAX(bd.loaded_until), '1900-01-01 00:00:00')
-        FROM dwh_kazan.work_batchdate AS bd
-        WHERE bd.status = 'Success'
-        '''
-    ).fetchone()[0]
-
-    # Путевые листы забираем с запасом +12 часов, поездки с запасом +2 часа
-    waybills_extract_dt = last_etl_dt - datetime.timedelta(hours=12)
-    rides_extract_dt =  last_etl_dt - datetime.timedelta(hours=2)
-
-    # Скачивание файлов из директории FTP сервера с указанного времени
-    def get_delta_items(dir: str, dt: datetime.datetime):
-        # Соединяемся по протоколу TLS
-        ftps = FTP_TLS(host=SOURCE_FTP_HOST, user=SOURCE_FTP_USER, passwd=SOURCE_FTP_PWD)
-        ftps.prot_p()
-        ftps.cwd('../' + dir)
-        items_to_extract = []
-        items = []
-        ftps.retrlines('LIST', items.append)
-        for item in items:
-            tokens = item.split(maxsplit = 9)
-            name = tokens[8]
-            timestamp_str = tokens[5] + " " + tokens[6] + " " + tokens[7]
-            timestamp = parser.parse(timestamp_str)
-            if timestamp > dt:
-                items_to_extract.append(name)
-        for item in items_to_extract:
-            with open(os.path.join(os.path.dirname(__file__), dir, item), 'wb') as file:
-                ftps.retrbinary('RETR ' + item, file.write)
-        ftps.quit()
-
-    # Качаем новые путевые листы и платежи
-    logger.info('Downloading files from FTP...')
-    get_delta_items('waybills', waybills_extract_dt)
-    get_delta_items('payments', last_etl_dt)
-
-    # Собираем датафрейм из новых путевых листов
-    waybills = pd.DataFrame()
-    waybills_dir = os.path.join(os.path.dirname(__file__), 'waybills')
-    xsl_file = xsl_file = os.path.join(os.path.dirname(__file__), 'waybill.xsl')
-    for file in sorted(os.listdir(waybills_dir)):
-        if file.endswith('.xml'):
-            waybills = pd.concat([waybills, (pd.read_xml(os.path.join(waybills_dir, file), stylesheet=xsl_file))], ignore_index=True)
-        else:
-            continue
-    # Переводим строки в datetime
-    waybills['issuedt'] = pd.to_datetime(waybills['issuedt'])
-    waybills['start'] = pd.to_datetime(waybills['start'])
-    waybills['stop'] = pd.to_datetime(waybills['stop'])
-
-    # Собираем датафрейм из новых платежей
-    payments = pd.DataFrame()
+# Директория контрольных точек батча (для продолжения после ошибки)
+STATE_DIR = os.environ.get('STATE_DIR', os.path.join(os.path.dirname(__file__), 'state'))
+
+# Зона приземления: скачанные путевые листы и платежи в Parquet по дням и срок их хранения
+LANDING_DIR = os.environ.get('LANDING_DIR', os.path.join(os.path.dirname(__file__), 'landing'))
+LANDING_RETENTION_DAYS = int(os.environ.get('LANDING_RETENTION_DAYS', 90))
+
+# Режим микробатчей: интервал опроса источников, ограничение строк статусов и заказов на один батч
+# (ограничивает память батча, остаток забирается следующими батчами) и число параллельно строящихся витрин
+MICROBATCH_INTERVAL_SEC = int(os.environ.get('MICROBATCH_INTERVAL_SEC', 300))
+MAX_BATCH_ROWS = int(os.environ.get('MAX_BATCH_ROWS', 0)) or None
+MARTS_WORKERS = int(os.environ.get('MARTS_WORKERS', 4))
+
+# Один батч (запуск по расписанию) или долгоживущий процесс, обрабатывающий батчи каждые --interval секунд:
+# движки БД, сессии FTP и кэш водителей остаются "теплыми", завершенные дни сразу уходят в витрины.
+# --migrate-schema - разовый перевод фактовых таблиц в партиционированные (без загрузки батча)
+args = argparse.ArgumentParser(description='DWH ETL')
+args.add_argument('--loop', action='store_true')
+args.add_argument('--migrate-schema', action='store_true')
+args.add_argument('--interval', type=int, default=MICROBATCH_INTERVAL_SEC)
+args.add_argument('--max-batch-rows', type=int, default=MAX_BATCH_ROWS)
+args = args.parse_args()
+
+# Строковые колонки храним в буферах Arrow, а не в object
+use_arrow_strings()
+
+# -----------------------------------------------------------------------
+# Incremental data load - Загружаем данные с последнего успешного запуска
+# -----------------------------------------------------------------------
+
+# Батч выполняется по этапам. Результаты этапов сохраняются в STATE_DIR,
+# поэтому после ошибки следующий запуск продолжит батч с упавшего этапа
+
+
+# Параметры и состояние одного батча. Этапы получают его явно первым аргументом:
+# в режиме микробатчей этап, выполняющийся дольше, не увидит параметров следующего батча
+class BatchContext:
+
+    def __init__(self, runner: BatchRunner, etl_start_dt: datetime.datetime, last_etl_dt: datetime.datetime, watermarks: dict):
+        self.runner = runner
+        self.etl_start_dt = etl_start_dt
+        self.last_etl_dt = last_etl_dt
+        self.watermarks = watermarks
+        # Файлы зоны приземления помечаются временем запуска батча
+        self.batch_id = etl_start_dt.strftime('%Y%m%dT%H%M%S')
+        # Запас по времени: для файлов FTP (уже загруженные отсекает манифест)
+        # и для поездок при первом запуске, пока нет водяных знаков
+        self.waybills_extract_dt = last_etl_dt - datetime.timedelta(hours=12)
+        self.rides_extract_dt = last_etl_dt - datetime.timedelta(hours=2)
+
+    # Этапы в виде func(stat), как их выполняет BatchRunner
+    def bind(self, stages: list) -> list:
+        return [(name, functools.partial(func, self)) for name, func in stages]
+
+
+
+### EXTRACT
+
+# Этапы извлечения независимы и выполняются одновременно: FTP и запросы к источнику перекрываются,
+# поэтому время извлечения определяется самым медленным источником, а не их суммой
+
+# Качаем новые путевые листы и сразу разбираем скачанные файлы в пуле процессов.
+# Водяной знак путевых листов - манифест FTP: уже загруженные файлы не качаем, путевые листы
+# прошлых батчей для поиска водителей берутся из fact_waybills.
+# Разобранные путевые листы пачками по WAYBILLS_CHUNK_SIZE пишутся в зону приземления, дальше батч читается оттуда
+def extract_waybills(batch: BatchContext, stat: dict):
+    landing.drop_batch('waybills', batch.batch_id)
+    with WaybillStreamParser(
+        on_frame=lambda waybills: landing.write('waybills', waybills, batch.batch_id),
+        files_per_task=WAYBILLS_FILES_PER_TASK,
+        chunk_size=WAYBILLS_CHUNK_SIZE
+    ) as parser:
+        files = ftp_downloader.get_delta_items('waybills', batch.waybills_extract_dt, on_file=parser.add)
+        stat['rows_out'] = parser.finish()
+    stat['rows_in'] = len(files)
+    stat['bytes'] = ftp_downloader.dir_bytes.get('waybills', 0)
+    # Файлы для манифеста FTP запоминаем до конца батча
+    batch.runner.remember('ftp_pending_waybills', ftp_downloader.pending.get('waybills', {}))
+
+
+# Качаем новые платежи и пачками переводим выписки в зону приземления
+def extract_payments(batch: BatchContext, stat: dict):
+    files = ftp_downloader.get_delta_items('payments', batch.last_etl_dt)
     payments_dir = os.path.join(os.path.dirname(__file__), 'payments')
-    for file in sorted(os.listdir(payments_dir)):
-        if file.endswith('.csv'):
-            payment = pd.read_csv(os.path.join(payments_dir, file), sep='\t', names = ['transaction_dt', 'card_num', 'transaction_amt'])
-            payments = pd.concat([payments, payment], ignore_index=True)
-        else:
-            continue
-    # Делаем уникальный id транзакции с помощью md5 хэша
-    payments['transaction_id'] = payments['transaction_dt'].astype(str) + payments['card_num'].astype(str)
-    payments['transaction_id'] = payments['transaction_id'].apply(lambda x: hashlib.md5(x.encode()).hexdigest())
-    # Переводим строки в datetime  
-    payments['transaction_dt'] = pd.to_datetime(payments['transaction_dt'], dayfirst=True)
-    payments = payments.set_index('transaction_id')
-
-    logger.info('Querying data from source DB...')
-
-    # Забираем новые поездки
-    rides = pd.read_sql(
-        'SELECT * FROM main.rides WHERE dt > %(dt)s', 
-        source_db_conn,
-        params={'dt': rides_extract_dt}
+    landing.drop_batch('payments', batch.batch_id)
+    stat['rows_in'] = len(files)
+    stat['rows_out'] = sum(
+        landing.write('payments', payments, batch.batch_id)
+        for payments in iter_payments(payments_dir, chunk_size=PAYMENTS_CHUNK_SIZE)
     )
+    stat['bytes'] = ftp_downloader.dir_bytes.get('payments', 0)
+    batch.runner.remember('ftp_pending_payments', ftp_downloader.pending.get('payments', {}))
+
+
+# Условие выборки новых строк источника: строго после водяного знака по id
+# (не больше --max-batch-rows строк по порядку id), а при первом запуске (водяного знака еще нет) -
+# по времени с запасом, как раньше
+def delta_filter(batch: BatchContext, source: str, id_col: str) -> tuple:
+    if source in batch.watermarks and batch.watermarks[source]['last_id'] is not None:
+        if args.max_batch_rows:
+            return (
+                '{0} > %(mark)s ORDER BY {0} LIMIT %(limit)s'.format(id_col),
+                {'mark': batch.watermarks[source]['last_id'], 'limit': args.max_batch_rows}
+            )
+        return '{} > %(mark)s'.format(id_col), {'mark': batch.watermarks[source]['last_id']}
+    return 'dt > %(mark)s', {'mark': batch.rides_extract_dt}
+
+
+# Источник уперся в ограничение батча: хранилище загружено только до последней прочитанной строки
+def remember_capped(batch: BatchContext, source: str, rows: int):
+    if args.max_batch_rows and rows >= args.max_batch_rows:
+        batch.runner.remember('capped_until_' + source, batch.runner.frame(source)['dt'].max().isoformat())
+
+
+# Забираем новые поездки. Пачки сразу пишутся в контрольную точку этапа, не собираясь в памяти
+def extract_rides(batch: BatchContext, stat: dict):
+    where, params = delta_filter(batch, 'rides', 'ride_id')
+    stat['rows_out'] = batch.runner.write_chunks('rides', iter_sql_chunked(
+        source_db_conn,
+        'SELECT * FROM main.rides WHERE ' + where,
+        name='main.rides',
+        params=params,
+        chunksize=SOURCE_CHUNK_SIZE,
+        source='rides'
+    ), source='rides')
+    remember_capped(batch, 'rides', stat['rows_out'])
+
+
+# Забираем новые статусы машин
+def strip_plates(chunk: pd.DataFrame) -> pd.DataFrame:
+    chunk['car_plate_num'] = chunk['car_plate_num'].str.strip()
+    return chunk
 
-    # Забираем новые статусы машин
-    movement = pd.read_sql(
-        'SELECT * FROM main.movement WHERE dt > %(dt)s', 
+
+def extract_movement(batch: BatchContext, stat: dict):
+    where, params = delta_filter(batch, 'movement', 'movement_id')
+    stat['rows_out'] = batch.runner.write_chunks('movement', iter_sql_chunked(
         source_db_conn,
-        params={'dt': rides_extract_dt},
+        'SELECT * FROM main.movement WHERE ' + where,
+        name='main.movement',
+        params=params,
+        chunksize=SOURCE_CHUNK_SIZE,
+        transform=strip_plates,
+        source='movement',
         index_col='movement_id'
-    )
-    movement['car_plate_num'] = movement['car_plate_num'].str.strip()
+    ), source='movement')
+    remember_capped(batch, 'movement', stat['rows_out'])
 
-    # Забираем ВСЕХ водителей, тк искать нужно по всем
-    drivers = pd.read_sql(
-        'SELECT md5(last_name || first_name || middle_name || birth_dt) AS personnel_num, * FROM main.drivers',
-        source_db_conn
-    )
 
+# Обновляем локальный кэш водителей изменениями из источника
+def extract_drivers(batch: BatchContext, stat: dict):
+    stat['rows_out'] = drivers_cache.refresh(source_db_conn, chunksize=SOURCE_CHUNK_SIZE)
 
 
-    ### TRANSFORM-LOAD (FACT)
-
-    logger.info('Updating fact tables...')
-
-    # Переводим информацию о времени статусов для каждой поездки в сводную таблицу
-    rides_time = movement.pivot(index='ride', columns='event', values='dt')
-    rides_time['END'] = rides_time['END'].fillna(rides_time['CANCEL'])
-    rides_time = rides_time.reindex(columns=['READY', 'BEGIN', 'END'])
-    rides_time = rides_time.rename(columns={'READY':'ride_arrival_dt', 'BEGIN':'ride_start_dt', 'END':'ride_end_dt'})
-
-    # Фильтруем статусы для того чтобы узнать завершенные поездки
-    rides_finish = movement.query("event == 'END' or event == 'CANCEL'")
-
-    # Получаем информацию по завершенным поездкам (кроме номера водителя)
-    fact_rides = rides_finish.merge(rides_time, how='left', on='ride')\
-        .merge(rides, how='left', left_on='ride', right_on='ride_id', suffixes=['_event', '_begin'])
-    # Убираем поездки по которым попала только частичная информация
-    fact_rides = fact_rides[fact_rides.client_phone.notna()]
-
-    # Подтягиваем информацию о водителях в путевые листы
-    fact_waybills = waybills.merge(drivers[['personnel_num', 'driver_license']], how='left', left_on='license', right_on='driver_license')
-    fact_waybills = fact_waybills.dropna()[['number', 'personnel_num', 'car', 'start', 'stop', 'issuedt']]
-    fact_waybills = fact_waybills.rename(columns={
-        'number':'waybill_num',
-        'personnel_num':'driver_pers_num',
-        'car':'car_plate_num',
-        'start':'work_start_dt',
-        'stop':'work_end_dt',
-        'issuedt':'issue_dt'
-    })
-    fact_waybills = fact_waybills.set_index('waybill_num')
-
-    # Ищем нужного водителя через путевые листы по номеру авто и времени. Добавляем в фактические поездки.
-    # Наверное можно сделать как-то более элегантно, но я не придумал как :)
-    fact_rides['driver_pers_num'] = ''
-    for idx in fact_rides.index:
-        fact_rides.loc[idx, 'driver_pers_num'] = fact_waybills[
-            (fact_rides.loc[idx, 'car_plate_num'] == fact_waybills['car_plate_num']) & 
-            (fact_rides.loc[idx, 'dt_begin'] >= fact_waybills['work_start_dt']) & 
-            (fact_rides.loc[idx, 'dt_begin'] <= fact_waybills['work_end_dt'])
-        ]['driver_pers_num'].values[0]
-    fact_rides = fact_rides[[
-        'ride', 'point_from', 'point_to', 'distance', 'price', 'client_phone', 'driver_pers_num', 
-        'car_plate_num', 'ride_arrival_dt', 'ride_start_dt', 'ride_end_dt']]
-    fact_rides = fact_rides.rename(columns={
-        'ride':'ride_id',
-        'point_from':'point_from_txt',
-        'point_to':'point_to_txt',
-        'distance':'distance_val',
-        'price':'price_amt',
-        'client_phone':'client_phone_num'
-    })
-    fact_rides = fact_rides.set_index('ride_id')
-
-    # Загружаем новые данные в фактовые таблицы методом UPSERT
-    pangres.upsert(
-        con=dwh_db_conn, 
-        df=fact_rides,
-        table_name='fact_rides',
-        if_row_exists='ignore',
-        schema='dwh_kazan'
-    )
-    pangres.upsert(
-        con=dwh_db_conn, 
-        df=fact_waybills,
-        table_name='fact_waybills',
-        if_row_exists='ignore',
-        schema='dwh_kazan'
+# Незавершенные поездки прошлого батча (статусы и заказы) из хранилища
+def extract_pending(batch: BatchContext, stat: dict):
+    pending_movement = read_sql_chunked(
+        dwh_db_conn,
+        'SELECT * FROM dwh_kazan.work_pending_movement',
+        name='work_pending_movement',
+        source='movement',
+        index_col='movement_id'
     )
-    pangres.upsert(
-        con=dwh_db_conn, 
-        df=payments,
-        table_name='fact_payments',
-        if_row_exists='ignore',
-        schema='dwh_kazan'
+    pending_rides = read_sql_chunked(
+        dwh_db_conn,
+        'SELECT * FROM dwh_kazan.work_pending_rides',
+        name='work_pending_rides',
+        source='rides'
     )
+    stat['rows_out'] = len(pending_rides)
+    return {'pending_movement': pending_movement, 'pending_rides': pending_rides}
+
+
 
+### TRANSFORM (FACT)
 
+def transform_fact_waybills(batch: BatchContext, stat: dict):
+    waybills = landing.read('waybills', batch=batch.batch_id)
+    if waybills is None:
+        waybills = empty_waybills()
+    stat['rows_in'] = len(waybills)
+    fact_waybills = build_fact_waybills(waybills, drivers_cache.license_lookup())
+    stat['rows_out'] = len(fact_waybills)
+    return {'fact_waybills': fact_waybills}
 
-    ### TRANSFORM-LOAD (DIM)
 
-    logger.info('Updating dimension tables...')
+# Путевые листы прошлых батчей, в рабочий период которых могут попасть поездки с first_dt по last_dt
+def loaded_waybills(first_dt: datetime.datetime, last_dt: datetime.datetime) -> pd.DataFrame:
+    return pd.read_sql(
+        '''
+        SELECT waybill_num, driver_pers_num, car_plate_num, work_start_dt, work_end_dt, issue_dt
+        FROM dwh_kazan.fact_waybills
+        WHERE work_start_dt >= %(min_start)s AND work_start_dt <= %(last_dt)s AND work_end_dt >= %(first_dt)s
+        ''',
+        dwh_db_conn,
+        params={'min_start': first_dt - OVERTIME_WAYBILL_MAX, 'first_dt': first_dt, 'last_dt': last_dt},
+        index_col='waybill_num'
+    )
 
-    ### dim_cars
+
+# Трансформация держит в памяти всю дельту батча: сборка поездок и поиск путевых листов работают по всем
+# статусам сразу, и по частям чекпоинта их не разбить (статусы одной поездки попадают в разные части).
+# Память ограничивает --max-batch-rows (MAX_BATCH_ROWS): не больше стольких строк rides и movement плюс
+# незавершенные поездки прошлого батча. Первый запуск без водяных знаков и запуск без ограничения
+# читают источник целиком
+def transform_fact_rides(batch: BatchContext, stat: dict):
+    # Новые статусы и заказы вместе с незавершенными поездками прошлого батча
+    movement = concat_compact([batch.runner.frame('pending_movement'), batch.runner.frame('movement')], 'movement')
+    movement = movement[~movement.index.duplicated(keep='last')]
+    rides = concat_compact([batch.runner.frame('pending_rides'), batch.runner.frame('rides')], 'rides', ignore_index=True)
+    rides = rides.drop_duplicates('ride_id', keep='last')
+    stat['rows_in'] = len(movement)
+
+    # Путевые листы батча и загруженные ранее, покрывающие время заказов
+    waybills = batch.runner.frame('fact_waybills')
+    if not rides.empty:
+        waybills = pd.concat([loaded_waybills(rides['dt'].min(), rides['dt'].max()), waybills])
+        waybills = waybills[~waybills.index.duplicated(keep='last')]
+
+    # Завершенные поездки с водителем, найденным через путевые листы по номеру авто и времени заказа
+    fact_rides, rides_without_driver = build_fact_rides(movement, rides, waybills)
+    if not rides_without_driver.empty:
+        logger.info('No waybill found yet for {} rides, retrying in the next batch', len(rides_without_driver))
+
+    # Незавершенные поездки и поездки без путевого листа переносим в следующий батч
+    pending_movement, pending_rides, expired = split_pending(movement, rides, fact_rides.index, batch.etl_start_dt - PENDING_MAX_AGE)
+    if expired:
+        logger.warning('Rides pending longer than {}, skipping them: {}', PENDING_MAX_AGE, expired)
+    stat['rows_out'] = len(fact_rides)
+    return {'fact_rides': fact_rides, 'next_pending_movement': pending_movement, 'next_pending_rides': pending_rides}
+
+
+
+### SCHEMA
+# Перед загрузкой: партиции на текущий период созданы, индексы под витрины на месте.
+# Непартиционированные таблицы батч не мигрирует сам - нужен явный запуск с --migrate-schema
+def load_schema(batch: BatchContext, stat: dict):
+    stat['rows_out'] = len(maintain_schema(dwh_db_conn, batch.etl_start_dt.date()))
+
+
+
+### LOAD (FACT)
+# Загружаем новые данные в фактовые таблицы через COPY + INSERT ... ON CONFLICT DO NOTHING.
+# Загрузка идемпотентна, поэтому упавший этап можно безопасно повторить
+
+# Дни и телефоны загруженных поездок отмечаются для перестроения витрин (поездка могла завершиться
+# в день, витрины которого уже построены)
+def load_fact_rides(batch: BatchContext, stat: dict):
+    fact_rides = batch.runner.frame('fact_rides')
+    stat['rows_in'] = len(fact_rides)
+    stat['rows_out'], _ = copy_upsert(dwh_db_conn, fact_rides, 'fact_rides')
+    touch_clients(dwh_db_conn, fact_rides['client_phone_num'].dropna().unique().tolist())
+
+
+# Дневной агрегат по водителям пересчитываем за дни, в которые завершились поездки батча.
+# Эти дни и более поздние, у которых сдвинулся счет нарушений, отмечаются для витрин
+def load_agg_driver_day(batch: BatchContext, stat: dict):
+    ride_end_dt = batch.runner.frame('fact_rides')['ride_end_dt'].dropna()
+    if ride_end_dt.empty:
+        stat['rows_out'] = 0
+        return
+    stat['rows_out'], shifted_days = refresh_agg_driver_day(dwh_db_conn, ride_end_dt.min().date(), ride_end_dt.max().date())
+    touch_days(dwh_db_conn, sorted(set(ride_end_dt.dt.date.unique()) | set(shifted_days)))
+
+
+# Дни, окна переработки которых захватывает путевой лист (окно начинается не раньше чем за OVERTIME_WINDOW до смены)
+def waybill_days(fact_waybills: pd.DataFrame) -> list:
+    spans = pd.DataFrame({
+        'first_day': (fact_waybills['work_start_dt'] - OVERTIME_WINDOW).dt.date,
+        'last_day': fact_waybills['work_end_dt'].dt.date
+    }).dropna().drop_duplicates()
+    return sorted({day for first_day, last_day in spans.itertuples(index=False) for day in date_range(first_day, last_day)})
+
+
+def load_fact_waybills(batch: BatchContext, stat: dict):
+    fact_waybills = batch.runner.frame('fact_waybills')
+    stat['rows_in'] = len(fact_waybills)
+    stat['rows_out'], _ = copy_upsert(dwh_db_conn, fact_waybills, 'fact_waybills')
+    touch_days(dwh_db_conn, waybill_days(fact_waybills))
+
+
+# Платежи батча читаем из зоны приземления и загружаем по файлам, не собирая все выписки в памяти.
+# Клиенты с картами из платежей отмечаются для витрины клиентов
+def load_fact_payments(batch: BatchContext, stat: dict):
+    stat['rows_in'], stat['rows_out'] = 0, 0
+    for payments in landing.iter_batch('payments', batch.batch_id):
+        inserted, _ = load_payments(dwh_db_conn, payments)
+        touch_client_cards(dwh_db_conn, payments['card_num'].dropna().unique().tolist())
+        stat['rows_in'] += len(payments)
+        stat['rows_out'] += inserted
+
+
+
+### TRANSFORM-LOAD (DIM)
+
+### dim_cars
+# Изменения автопарка забираем после собственного водяного знака (последний update_dt), при первом запуске - после last_etl_dt
+def load_dim_cars(batch: BatchContext, stat: dict):
     # Get car_pool updates
     updated_cars = pd.read_sql(
         '''
@@ -227,163 +373,274 @@ try:
             '9999-01-01 00:00:00' AS end_dt
         FROM main.car_pool
         WHERE update_dt > %(dt)s
-        ''', 
-        source_db_conn,
-        params={'dt': last_etl_dt}
-    )
-    updated_cars.plate_num = updated_cars.plate_num.str.strip()
-
-    # Upload car_pool updates to temp_table
-    updated_cars.to_sql('work_temp_table', con=dwh_db_conn, schema='dwh_kazan', index=False, if_exists='replace')
-
-    # Update end_dt for previously loaded rows
-    dwh_db_conn.execute(
-        '''
-        UPDATE dim_cars AS f
-        SET f.end_dt = t.start_dt - INTERVAL '1 second'
-        FROM work_temp_table AS t
-        WHERE f.plate_num = t.plate_num
-        AND f.end_dt = '9999-01-01 00:00:00'
-        AND t.revision_dt != f.revision_dt
-        '''
-    )
-
-    # Upload car_pool updates to target table
-    updated_cars.to_sql('dim_cars', con=dwh_db_conn, schema='dwh_kazan', index=False, if_exists='append')
-
-    ### dim_drivers
-    # Get drivers updates
-    updated_drivers = pd.read_sql(
-        '''
-        SELECT 
-            md5(last_name || first_name || middle_name || birth_dt) AS personnel_num,
-            update_dt AS start_dt,
-            last_name,
-            first_name,
-            middle_name,
-            birth_dt,
-            card_num,
-            driver_license AS driver_license_num,
-            driver_valid_to AS driver_license_dt,
-            '9999-01-01 00:00:00' AS end_dt
-        FROM main.drivers
-        WHERE update_dt > %(dt)s
-        ''', 
-        source_db_conn,
-        params={'dt': last_etl_dt}
-    )
-
-    # Upload drivers updates to temp_table
-    updated_drivers.to_sql('work_temp_table', con=dwh_db_conn, schema='dwh_kazan', index=False, if_exists='replace')
-
-    # Update end_dt for previously loaded rows
-    dwh_db_conn.execute(
-        '''
-        UPDATE dim_drivers AS f
-        SET f.end_dt = t.start_dt - INTERVAL '1 second'
-        FROM work_temp_table AS t
-        WHERE f.personnel_num = t.personnel_num
-        AND f.end_dt = '9999-01-01 00:00:00'
-        AND t.card_num != f.card_num
-        '''
-    )
-
-    # Upload drivers updates to target table
-    updated_drivers.to_sql('dim_drivers', con=dwh_db_conn, schema='dwh_kazan', index=False, if_exists='append')
-
-    ### dim_clients
-    # Get clients updates
-    updated_clients = pd.read_sql(
-        '''
-        SELECT
-            client_phone AS phone_num,
-            dt AS start_dt,
-            card_num,
-            LEAD(dt, 1, '9999-01-01 00:00:01') OVER(PARTITION BY client_phone ORDER BY dt) - INTERVAL '1 second' AS end_dt
-        FROM
-        (
-            SELECT 
-                client_phone,
-                card_num,
-                MIN(dt) AS dt
-            FROM main.rides
-            GROUP BY client_phone, card_num
-        ) AS cards
-        WHERE dt > %(dt)s
         ''',
         source_db_conn,
-        params={'dt': last_etl_dt}
-    )
-
-    # Upload drivers updates to temp_table
-    updated_clients.to_sql('work_temp_table', con=dwh_db_conn, schema='dwh_kazan', index=False, if_exists='replace')
-
-    # Update end_dt for previously loaded rows
-    dwh_db_conn.execute(
-        '''
-        UPDATE dim_clients AS f
-        SET f.end_dt = t.start_dt - INTERVAL '1 second'
-        FROM work_temp_table AS t
-        WHERE f.phone_num = t.phone_num
-        AND f.end_dt = '9999-01-01 00:00:00'
-        AND t.card_num != f.card_num
-        '''
-    )
-
-    # Upload clients updates to work_dim_clients table
-    updated_clients.to_sql('dim_clients', con=dwh_db_conn, schema='dwh_kazan', index=False, if_exists='append')
-
-    # Deduplicate dim_clients after adding new rows
-    dwh_db_conn.execute(
-        '''
-        DELETE
-        FROM dim_clients dc1
-        USING dim_clients dc2
-        WHERE dc1.ctid < dc2.ctid
-        AND dc1.phone_num = dc2.phone_num
-        AND dc1.start_dt = dc2.start_dt;
-        '''
-    )
-
-    # Время завершения и выполнения скрипта
-    etl_end_dt = datetime.datetime.now()
-    etl_duration = etl_end_dt - etl_start_dt
-
-    # Логгируем успешное выполнение в рабочую таблицу хранилища
-    dwh_db_conn.execute(
-        text("INSERT INTO dwh_kazan.work_batchdate (loaded_until, status) VALUES(:dt, :st)"),
-        {'dt': etl_start_dt, 'st': 'Success'}
-    )
-
-    logger.success("Script executed succesfully in {} seconds", etl_duration.total_seconds())
-
-
-
-except Exception:
-
-    # Логгируем неудачное выполнение в рабочую таблицу хранилища
-    dwh_db_conn.execute(
-        text("INSERT INTO dwh_kazan.work_batchdate (loaded_until, status) VALUES(:dt, :st)"),
-        {'dt': etl_start_dt, 'st': 'Failure'}
+        params={'dt': batch.watermarks.get('car_pool', {}).get('last_dt') or batch.last_etl_dt}
     )
-
-    logger.exception("Script executed with unexpected error")
-
-
-
-finally:
-
-    # Удаление всех файлов из директории с диска
-    def delete_all_files(dir: str):
-        path = os.path.join(os.path.dirname(__file__), dir)
-        filelist = [f for f in os.listdir(path) if os.path.isfile(os.path.join(path, f)) and not f.endswith('.gitkeep')]
-        for f in filelist:
-            os.remove(os.path.join(path, f))
-
-    # Удаляем все скачанные путевые листы и платежи с диска
-    logger.info('Cleaning downloadled files from disk...')
-    delete_all_files('waybills')
-    delete_all_files('payments')
-
-    # Дропаем временные таблицы в хранилище
-    dwh_db_conn.execute('DROP TABLE IF EXISTS work_temp_table')
\ No newline at end of file
+    updated_cars.plate_num = updated_cars.plate_num.str.strip()
+    if not updated_cars.empty:
+        batch.runner.remember('watermark_car_pool', updated_cars.start_dt.max().isoformat())
+
+    # Merge car_pool updates into dim_cars (SCD2)
+    stat['rows_in'] = len(updated_cars)
+    _, stat['rows_out'] = merge_scd2(dwh_db_conn, DIM_CARS, updated_cars)
+
+
+### dim_drivers
+def load_dim_drivers(batch: BatchContext, stat: dict):
+    # Get drivers updates (from local drivers cache)
+    updated_drivers = drivers_cache.changed_since(batch.last_etl_dt)
+
+    # Merge drivers updates into dim_drivers (SCD2)
+    stat['rows_in'] = len(updated_drivers)
+    _, stat['rows_out'] = merge_scd2(dwh_db_conn, DIM_DRIVERS, updated_drivers)
+
+
+### dim_clients
+# Новые пары (телефон, карта) берем из уже извлеченной пачки поездок и сверяем с известными
+# хранилищу парам этих телефонов, вместо GROUP BY по всей истории main.rides на источнике
+def load_dim_clients(batch: BatchContext, stat: dict):
+    rides = batch.runner.frame('rides')
+    known = known_client_cards(dwh_db_conn, rides['client_phone'].dropna().unique().tolist())
+    updated_clients = new_client_cards(rides, known)
+
+    # Merge clients updates into dim_clients (SCD2)
+    stat['rows_in'] = len(updated_clients)
+    _, stat['rows_out'] = merge_scd2(dwh_db_conn, DIM_CLIENTS, updated_clients)
+    touch_clients(dwh_db_conn, updated_clients['phone_num'].unique().tolist())
+
+
+# Этапы извлечения (выполняются параллельно)
+EXTRACT_STAGES = [
+    ('extract_waybills', extract_waybills),
+    ('extract_payments', extract_payments),
+    ('extract_rides', extract_rides),
+    ('extract_movement', extract_movement),
+    ('extract_drivers', extract_drivers),
+    ('extract_pending', extract_pending)
+]
+
+# Этапы трансформации и загрузки в порядке выполнения
+STAGES = [
+    ('transform_fact_waybills', transform_fact_waybills),
+    ('transform_fact_rides', transform_fact_rides),
+    ('load_schema', load_schema),
+    ('load_fact_rides', load_fact_rides),
+    ('load_agg_driver_day', load_agg_driver_day),
+    ('load_fact_waybills', load_fact_waybills),
+    ('load_fact_payments', load_fact_payments),
+    ('load_dim_cars', load_dim_cars),
+    ('load_dim_drivers', load_dim_drivers),
+    ('load_dim_clients', load_dim_clients)
+]
+
+
+# Новые водяные знаки источников по результатам батча (источник без новых строк сохраняет прежний)
+def batch_watermarks(batch: BatchContext) -> dict:
+    marks = dict(batch.watermarks)
+    movement = batch.runner.frame('movement')
+    if not movement.empty:
+        marks['movement'] = {'last_id': int(movement.index.max()), 'last_dt': movement['dt'].max().to_pydatetime()}
+    rides = batch.runner.frame('rides')
+    if not rides.empty:
+        marks['rides'] = {'last_id': int(rides['ride_id'].max()), 'last_dt': rides['dt'].max().to_pydatetime()}
+    car_pool_dt = batch.runner.recall('watermark_car_pool')
+    if car_pool_dt is not None:
+        marks['car_pool'] = {'last_id': None, 'last_dt': datetime.datetime.fromisoformat(car_pool_dt)}
+    return marks
+
+
+# Удаление всех файлов из директории с диска
+def delete_all_files(dir: str):
+    path = os.path.join(os.path.dirname(__file__), dir)
+    filelist = [f for f in os.listdir(path) if os.path.isfile(os.path.join(path, f)) and not f.startswith('.')]
+    for f in filelist:
+        os.remove(os.path.join(path, f))
+
+
+# Загружено до: время запуска батча, а если источник уперся в ограничение строк - время последней прочитанной строки
+def batch_loaded_until(batch: BatchContext) -> datetime.datetime:
+    capped = [batch.runner.recall('capped_until_' + source) for source in ['movement', 'rides']]
+    capped = [datetime.datetime.fromisoformat(dt) for dt in capped if dt is not None]
+    return min([batch.etl_start_dt] + capped)
+
+
+# Задержка батча: от самого раннего нового статуса в источнике до загрузки в хранилище
+def batch_latency_sec(batch: BatchContext):
+    movement = batch.runner.frame('movement')
+    if movement.empty:
+        return None
+    return round((datetime.datetime.now() - movement['dt'].min()).total_seconds(), 3)
+
+
+# Витрины за дни, завершенные загруженными батчами (в режиме микробатчей)
+def update_marts():
+    days, phones, etl_until, touched = marts_to_build(dwh_db_conn)
+    if not days and not phones:
+        return
+    marts_metrics = StageMetrics('dm_update', datetime.datetime.now())
+    try:
+        logger.info('Updating Data Marts for {} day(s), {} client(s)...', len(days), len(phones))
+        build_marts(dwh_db_conn, days, phones, workers=MARTS_WORKERS, metrics=marts_metrics)
+        release_touched(dwh_db_conn, touched)
+        log_marts_batch(dwh_db_conn, etl_until, 'Success')
+    except Exception:
+        log_marts_batch(dwh_db_conn, marts_metrics.batch_start_dt, 'Failure')
+        logger.exception('Data marts update failed')
+    finally:
+        save_metrics(marts_metrics)
+
+
+# Сохраняем метрики этапов в хранилище и в файл
+def save_metrics(batch_metrics: StageMetrics):
+    try:
+        batch_metrics.save(dwh_db_conn)
+        if METRICS_FILE:
+            batch_metrics.write_textfile(METRICS_FILE)
+    except Exception:
+        logger.exception('Failed to save stage metrics')
+
+
+# Один батч. Возвращает True при успехе
+def run_batch() -> bool:
+
+    # Время запуска батча и метрики по его этапам
+    etl_start_dt = datetime.datetime.now()
+    metrics = StageMetrics('dwh_etl', etl_start_dt)
+    ftp_downloader.dir_bytes = {}
+
+    try:
+
+        # Получаем время последнего успешного запуска
+        last_etl_dt = dwh_db_conn.execute(
+            '''
+            SELECT COALESCE(MAX(bd.loaded_until), '1900-01-01 00:00:00')
+            FROM dwh_kazan.work_batchdate AS bd
+            WHERE bd.status = 'Success'
+            '''
+        ).fetchone()[0]
+
+        # Начинаем новый батч или продолжаем незавершенный с его исходными параметрами
+        runner = BatchRunner(STATE_DIR, metrics=metrics)
+        params = runner.begin(etl_start_dt=etl_start_dt, last_etl_dt=last_etl_dt)
+        etl_start_dt = params['etl_start_dt']
+
+        # Водяные знаки источников, таблицы незавершенных поездок и отметок для витрин
+        ensure_watermark_tables(dwh_db_conn)
+        ensure_work_tables(dwh_db_conn)
+        batch = BatchContext(runner, etl_start_dt, params['last_etl_dt'], load_watermarks(dwh_db_conn))
+
+        with metrics.stage('batch') as batch_stat:
+            logger.info('Extracting data from FTP and source DB...')
+            runner.stages_parallel(batch.bind(EXTRACT_STAGES))
+
+            for stage_name, stage_func in batch.bind(STAGES):
+                runner.stage(stage_name, stage_func)
+
+            # Сохраняем водяные знаки и незавершенные поездки до отметки об успешном батче
+            save_batch_state(
+                dwh_db_conn,
+                batch_watermarks(batch),
+                runner.frame('next_pending_movement'),
+                runner.frame('next_pending_rides')
+            )
+
+            # Логгируем успешное выполнение в рабочую таблицу хранилища
+            dwh_db_conn.execute(
+                text("INSERT INTO dwh_kazan.work_batchdate (loaded_until, status) VALUES(:dt, :st)"),
+                {'dt': batch_loaded_until(batch), 'st': 'Success'}
+            )
+            batch_stat['rows_in'] = len(runner.frame('movement'))
+            batch_stat['rows_out'] = len(runner.frame('fact_rides'))
+            batch_stat['latency_sec'] = batch_latency_sec(batch)
+
+        # Время завершения и выполнения батча
+        etl_end_dt = datetime.datetime.now()
+        etl_duration = etl_end_dt - etl_start_dt
+
+        # Запоминаем скачанные файлы в манифесте только после успешной загрузки
+        ftp_downloader.pending = {
+            dir: runner.recall('ftp_pending_' + dir, {}) for dir in ['waybills', 'payments']
+        }
+        ftp_downloader.commit()
+
+        # Батч завершен: удаляем контрольные точки и скачанные путевые листы и платежи
+        # (они сохранены в зоне приземления), чистим партиции старше срока хранения
+        runner.finish()
+        logger.info('Cleaning downloadled files from disk...')
+        delete_all_files('waybills')
+        delete_all_files('payments')
+        landing.cleanup(LANDING_RETENTION_DAYS)
+
+        logger.success(
+            "Batch executed succesfully in {} seconds, latency {} seconds",
+            etl_duration.total_seconds(), batch_stat['latency_sec']
+        )
+        return True
+
+
+
+    except Exception:
+
+        # Логгируем неудачное выполнение в рабочую таблицу хранилища.
+        # Скачанные файлы и контрольные точки остаются на диске для продолжения батча
+        dwh_db_conn.execute(
+            text("INSERT INTO dwh_kazan.work_batchdate (loaded_until, status) VALUES(:dt, :st)"),
+            {'dt': etl_start_dt, 'st': 'Failure'}
+        )
+
+        logger.exception("Batch executed with unexpected error")
+        return False
+
+
+
+    finally:
+
+        # Сохраняем метрики этапов в хранилище и в файл
+        save_metrics(metrics)
+
+
+
+# Создаем движок с пулом соединений с БД источником
+source_db_conn = create_pooled_engine(SOURCE_DB_URI, pool_size=SOURCE_POOL_SIZE)
+
+# Создаем движок с пулом соединений с БД хранилища данных
+dwh_db_conn = create_pooled_engine(DWH_DB_URI, pool_size=max(DWH_POOL_SIZE, MARTS_WORKERS if args.loop else 0))
+
+# Зона приземления
+landing = LandingZone(LANDING_DIR)
+
+# Скачивание файлов из директорий FTP сервера несколькими параллельными сессиями
+# (в режиме микробатчей сессии остаются открытыми между батчами)
+ftp_downloader = FtpDownloader(
+    host=SOURCE_FTP_HOST,
+    user=SOURCE_FTP_USER,
+    passwd=SOURCE_FTP_PWD,
+    local_root=os.path.dirname(__file__),
+    workers=FTP_WORKERS,
+    keep_alive=args.loop
+)
+
+# Локальный кэш водителей источника
+drivers_cache = DriversCache(DRIVERS_CACHE_PATH)
+
+if args.migrate_schema:
+    logger.info('Partitioned fact tables: {}', migrate_schema(dwh_db_conn) or 'none, already partitioned')
+elif not args.loop:
+    # Код возврата для цепочки в glowbyte-etl-job.sh: при ошибке батча витрины не строятся
+    if not run_batch():
+        sys.exit(1)
+else:
+    # Микробатчи: следующий батч начинается через interval секунд после начала предыдущего
+    # (или сразу, если батч шел дольше). После успешного батча строим витрины за завершенные дни
+    logger.info('Running micro-batches every {} seconds', args.interval)
+    try:
+        while True:
+            started = time.monotonic()
+            if run_batch():
+                update_marts()
+            time.sleep(max(0, args.interval - (time.monotonic() - started)))
+    except KeyboardInterrupt:
+        logger.info('Micro-batch loop stopped')
+    finally:
+        ftp_downloader.close()
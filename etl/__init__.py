@@ -0,0 +1 @@
+# Вспомогательные компоненты ETL процесса (dwh_etl.py) и обновления витрин (dm_update.py)
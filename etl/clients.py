@@ -0,0 +1,35 @@
+import pandas as pd
+
+from sqlalchemy.sql import text
+
+from etl.scd2 import OPEN_END_DT
+
+
+# Пары (телефон, карта), уже известные хранилищу, только для телефонов из пачки поездок.
+# dim_clients хранит версию на каждую впервые увиденную пару, поиск идет по первичному ключу (phone_num, start_dt)
+def known_client_cards(engine, phones: list, schema: str = 'dwh_kazan') -> pd.DataFrame:
+    if not phones:
+        return pd.DataFrame(columns=['phone_num', 'card_num'])
+    return pd.read_sql(
+        text('SELECT DISTINCT phone_num, card_num FROM {}.dim_clients WHERE phone_num = ANY(:phones)'.format(schema)),
+        engine,
+        params={'phones': phones}
+    )
+
+
+# Новые версии dim_clients из пачки поездок: первое появление каждой пары (телефон, карта),
+# которой еще нет в хранилище. Конец версии - момент перед следующей новой парой того же телефона
+# (как LEAD по всей истории main.rides раньше), у последней - открытая версия
+def new_client_cards(rides: pd.DataFrame, known: pd.DataFrame) -> pd.DataFrame:
+    pairs = rides[['client_phone', 'card_num', 'dt']].dropna().astype({'client_phone': object, 'card_num': object})
+    pairs = pairs.groupby(['client_phone', 'card_num'], as_index=False, sort=False)['dt'].min()
+    pairs = pairs.rename(columns={'client_phone': 'phone_num', 'dt': 'start_dt'})
+
+    known = known.astype({'phone_num': object, 'card_num': object})
+    pairs = pairs.merge(known, how='left', on=['phone_num', 'card_num'], indicator=True)
+    pairs = pairs[pairs['_merge'] == 'left_only'].drop(columns='_merge')
+    pairs = pairs.sort_values(['phone_num', 'start_dt'], kind='mergesort', ignore_index=True)
+
+    next_dt = pairs.groupby('phone_num', sort=False)['start_dt'].shift(-1)
+    pairs['end_dt'] = (next_dt - pd.Timedelta(seconds=1)).astype(object).where(next_dt.notna(), OPEN_END_DT)
+    return pairs[['phone_num', 'start_dt', 'card_num', 'end_dt']]
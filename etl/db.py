@@ -0,0 +1,15 @@
+from sqlalchemy import create_engine
+
+
+# Один движок на базу с ограниченным пулом соединений на весь запуск.
+# Параллельные этапы берут соединения из пула, а не открывают новые SSL-сессии на каждый запрос.
+# pool_pre_ping проверяет соединение перед выдачей, чтобы не получить разорванное сервером
+def create_pooled_engine(uri: str, pool_size: int = 4, max_overflow: int = 0, **kwargs):
+    return create_engine(
+        uri,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_pre_ping=True,
+        connect_args={'sslmode': 'require'},
+        **kwargs
+    )
@@ -0,0 +1,116 @@
+import os
+import sqlite3
+import datetime
+
+import pandas as pd
+
+from etl.extract import read_sql_chunked
+
+
+DRIVERS_COLUMNS = [
+    'personnel_num', 'driver_license', 'last_name', 'first_name', 'middle_name',
+    'birth_dt', 'card_num', 'driver_valid_to', 'update_dt'
+]
+
+# Забираем только водителей, измененных после последней синхронизации
+DRIVERS_DELTA_SQL = '''
+    SELECT
+        md5(last_name || first_name || middle_name || birth_dt) AS personnel_num,
+        driver_license,
+        last_name,
+        first_name,
+        middle_name,
+        birth_dt,
+        card_num,
+        driver_valid_to,
+        update_dt
+    FROM main.drivers
+    WHERE update_dt > %(dt)s
+'''
+
+
+# Локальная копия main.drivers в SQLite, обновляемая инкрементально по update_dt.
+# Нужна для поиска табельного номера по водительскому удостоверению и для обновления dim_drivers
+# без полного чтения таблицы водителей из источника на каждом запуске
+class DriversCache:
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # Кэш используется из потоков параллельных этапов (но не из нескольких одновременно)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS drivers (
+                personnel_num TEXT PRIMARY KEY,
+                driver_license TEXT,
+                last_name TEXT,
+                first_name TEXT,
+                middle_name TEXT,
+                birth_dt TEXT,
+                card_num TEXT,
+                driver_valid_to TEXT,
+                update_dt TEXT
+            )
+            '''
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS drivers_license_idx ON drivers (driver_license)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS drivers_update_dt_idx ON drivers (update_dt)')
+        self.conn.commit()
+
+    # Время последнего изменения среди закэшированных водителей
+    def last_sync(self) -> datetime.datetime:
+        value = self.conn.execute('SELECT MAX(update_dt) FROM drivers').fetchone()[0]
+        return datetime.datetime.fromisoformat(value) if value else datetime.datetime(1900, 1, 1)
+
+    # Подтягиваем из источника изменения с момента последней синхронизации
+    def refresh(self, engine, chunksize: int = 50000) -> int:
+        delta = read_sql_chunked(
+            engine,
+            DRIVERS_DELTA_SQL,
+            name='main.drivers (delta)',
+            params={'dt': self.last_sync()},
+            chunksize=chunksize
+        )
+        if delta.empty:
+            return 0
+        for column in ['birth_dt', 'driver_valid_to', 'update_dt']:
+            delta[column] = pd.to_datetime(delta[column]).dt.strftime('%Y-%m-%dT%H:%M:%S.%f')
+        rows = delta[DRIVERS_COLUMNS].astype(object).where(delta[DRIVERS_COLUMNS].notna(), None)
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO drivers ({}) VALUES ({})'.format(
+                    ', '.join(DRIVERS_COLUMNS), ', '.join('?' * len(DRIVERS_COLUMNS))
+                ),
+                rows.itertuples(index=False, name=None)
+            )
+        return len(delta)
+
+    # Соответствие удостоверение -> табельный номер для путевых листов
+    def license_lookup(self) -> pd.DataFrame:
+        return pd.read_sql('SELECT personnel_num, driver_license FROM drivers', self.conn)
+
+    # Водители, измененные после dt, в формате dim_drivers (для SCD2)
+    def changed_since(self, dt: datetime.datetime) -> pd.DataFrame:
+        updated = pd.read_sql(
+            '''
+            SELECT
+                personnel_num,
+                update_dt AS start_dt,
+                last_name,
+                first_name,
+                middle_name,
+                birth_dt,
+                card_num,
+                driver_license AS driver_license_num,
+                driver_valid_to AS driver_license_dt,
+                '9999-01-01 00:00:00' AS end_dt
+            FROM drivers
+            WHERE update_dt > ?
+            ''',
+            self.conn,
+            params=[dt.strftime('%Y-%m-%dT%H:%M:%S.%f')],
+            parse_dates=['start_dt']
+        )
+        updated['birth_dt'] = pd.to_datetime(updated['birth_dt']).dt.date
+        updated['driver_license_dt'] = pd.to_datetime(updated['driver_license_dt']).dt.date
+        return updated
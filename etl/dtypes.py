@@ -0,0 +1,99 @@
+import pandas as pd
+
+from pandas.api.types import CategoricalDtype, union_categoricals
+
+from etl.rides import LIFECYCLE_EVENTS
+
+
+# Компактные типы колонок по источникам. Применяются сразу при чтении (SQL пачками, XML, CSV),
+# чтобы в памяти не копились object-строки:
+# - category - для повторяющихся значений (номера машин, модели, статусы);
+# - string - для уникальных строк (телефоны, карты, удостоверения, md5). При
+#   mode.string_storage = 'pyarrow' это непрерывный буфер Arrow вместо отдельного PyObject на значение
+STRING = 'string'
+CATEGORY = 'category'
+EVENT_DTYPE = CategoricalDtype(LIFECYCLE_EVENTS)
+
+SOURCE_DTYPES = {
+    'rides': {
+        'client_phone': STRING,
+        'card_num': STRING,
+        'point_from': STRING,
+        'point_to': STRING
+    },
+    'movement': {
+        'car_plate_num': CATEGORY,
+        'event': EVENT_DTYPE
+    },
+    'waybills': {
+        'number': STRING,
+        'model': CATEGORY,
+        'car': CATEGORY,
+        'name': STRING,
+        'license': STRING,
+        'validto': STRING
+    },
+    'payments': {
+        'transaction_dt_raw': STRING,
+        'card_num': STRING
+    }
+}
+
+
+# Строки в Arrow-буферах для dtype 'string' (в том числе при чтении контрольных точек из Parquet)
+def use_arrow_strings():
+    pd.set_option('mode.string_storage', 'pyarrow')
+
+
+# Категории всегда храним с object-значениями: из string-колонки (Arrow, контрольные точки Parquet)
+# astype('category') дает категории dtype string, а union_categoricals не склеивает категории разных dtype
+def object_categories(series: pd.Series) -> pd.Series:
+    categories = series.cat.categories
+    if categories.dtype == object:
+        return series
+    return pd.Series(
+        pd.Categorical.from_codes(series.cat.codes, categories=categories.astype(object), ordered=series.cat.ordered),
+        index=series.index,
+        name=series.name
+    )
+
+
+def compact(df: pd.DataFrame, source: str) -> pd.DataFrame:
+    dtypes = {column: dtype for column, dtype in SOURCE_DTYPES[source].items() if column in df.columns}
+    df = df.astype(dtypes, copy=False)
+    for column, dtype in dtypes.items():
+        if dtype == CATEGORY:
+            df[column] = object_categories(df[column])
+    return df
+
+
+# Категории без фиксированного набора значений - строками: так пачки одного источника
+# имеют одну схему Arrow (наборы категорий и разрядность кодов в пачках разные)
+def plain_categories(df: pd.DataFrame, source: str) -> pd.DataFrame:
+    dtypes = {
+        column: STRING for column, dtype in SOURCE_DTYPES[source].items()
+        if dtype == CATEGORY and column in df.columns
+    }
+    return df.astype(dtypes, copy=False)
+
+
+# Склейка пачек одного источника. Категории без фиксированного набора значений в пачках разные,
+# и pd.concat превратил бы такие колонки обратно в object, поэтому сначала приводим их к общему набору
+def concat_compact(chunks: list, source: str, **kwargs) -> pd.DataFrame:
+    for column, dtype in SOURCE_DTYPES[source].items():
+        if dtype != CATEGORY or column not in chunks[0].columns:
+            continue
+        for chunk in chunks:
+            chunk[column] = object_categories(chunk[column])
+        categories = union_categoricals([chunk[column] for chunk in chunks], ignore_order=True).categories
+        for chunk in chunks:
+            chunk[column] = chunk[column].cat.set_categories(categories)
+    return pd.concat(chunks, **kwargs)
+
+
+# Общий набор категорий для ключей соединения (merge и merge_asof требуют одинаковых категорий)
+def align_categories(*series: pd.Series) -> list:
+    if not any(isinstance(s.dtype, CategoricalDtype) for s in series):
+        return list(series)
+    categories = union_categoricals([object_categories(s.astype(CATEGORY)) for s in series], ignore_order=True).categories
+    return [s.astype(CategoricalDtype(categories)) for s in series]
@@ -0,0 +1,75 @@
+import time
+import resource
+
+import pandas as pd
+
+from loguru import logger
+
+from etl.dtypes import compact, concat_compact
+
+
+# Пиковое потребление памяти процессом за запуск (ru_maxrss в Linux - в килобайтах)
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Чтение результата запроса пачками через серверный (именованный) курсор:
+# при stream_results=True psycopg2 не тянет всю выборку в память клиента за раз
+def iter_sql(engine, sql: str, params: dict = None, chunksize: int = 50000, **kwargs):
+    with engine.connect().execution_options(stream_results=True) as conn:
+        for chunk in pd.read_sql(sql, conn, params=params, chunksize=chunksize, **kwargs):
+            yield chunk
+
+
+# Чтение таблицы источника пачками с обработкой каждой пачки (transform): генератор компактных пачек,
+# чтобы потребитель (контрольная точка этапа) мог записать каждую пачку, не собирая выборку в памяти.
+# source - имя источника в etl.dtypes: компактные типы применяются к каждой пачке сразу после чтения.
+# Пустая выборка дает одну пустую пачку со структурой результата.
+# Пишем в лог количество строк, скорость чтения и пиковое потребление памяти
+def iter_sql_chunked(
+    engine,
+    sql: str,
+    name: str,
+    params: dict = None,
+    chunksize: int = 50000,
+    transform=None,
+    source: str = None,
+    **kwargs
+):
+    start = time.perf_counter()
+    rows = 0
+    for chunk in iter_sql(engine, sql, params=params, chunksize=chunksize, **kwargs):
+        rows += len(chunk)
+        if transform is not None:
+            chunk = transform(chunk)
+        yield compact(chunk, source) if source is not None else chunk
+
+    if not rows:
+        # Пустая выборка: получаем только структуру результата
+        result = pd.read_sql('SELECT * FROM ({}) AS q LIMIT 0'.format(sql), engine, params=params, **kwargs)
+        if transform is not None:
+            result = transform(result)
+        yield compact(result, source) if source is not None else result
+
+    duration = time.perf_counter() - start
+    logger.info(
+        '{}: {} rows in {:.2f} s ({:.0f} rows/s), peak RSS {:.0f} MB',
+        name, rows, duration, rows / duration if duration else 0, peak_rss_mb()
+    )
+
+
+# То же одним DataFrame - для небольших выборок (кэш водителей, незавершенные поездки)
+def read_sql_chunked(
+    engine,
+    sql: str,
+    name: str,
+    params: dict = None,
+    chunksize: int = 50000,
+    transform=None,
+    source: str = None,
+    **kwargs
+) -> pd.DataFrame:
+    chunks = list(iter_sql_chunked(engine, sql, name, params, chunksize, transform, source, **kwargs))
+    if source is not None:
+        return concat_compact(chunks, source, ignore_index=kwargs.get('index_col') is None)
+    return pd.concat(chunks, ignore_index=kwargs.get('index_col') is None)
@@ -0,0 +1,49 @@
+import pandas as pd
+
+from etl.interval_join import assign_drivers
+from etl.rides import ride_lifecycle
+
+
+# Трансформации фактовых таблиц без обращений к БД и FTP (используются в dwh_etl.py и бенчмарках)
+
+### fact_waybills
+# Подтягиваем информацию о водителях в путевые листы (drivers - соответствие удостоверение -> табельный номер)
+def build_fact_waybills(waybills: pd.DataFrame, drivers: pd.DataFrame) -> pd.DataFrame:
+    fact_waybills = waybills.merge(drivers[['personnel_num', 'driver_license']], how='left', left_on='license', right_on='driver_license')
+    fact_waybills = fact_waybills.dropna()[['number', 'personnel_num', 'car', 'start', 'stop', 'issuedt']]
+    fact_waybills = fact_waybills.rename(columns={
+        'number':'waybill_num',
+        'personnel_num':'driver_pers_num',
+        'car':'car_plate_num',
+        'start':'work_start_dt',
+        'stop':'work_end_dt',
+        'issuedt':'issue_dt'
+    })
+    return fact_waybills.set_index('waybill_num')
+
+
+### fact_rides
+# Завершенные поездки с водителем из путевых листов. Возвращает (fact_rides, поездки без путевого листа)
+def build_fact_rides(movement: pd.DataFrame, rides: pd.DataFrame, fact_waybills: pd.DataFrame):
+    # Время подачи, начала и окончания завершенных поездок одним проходом по статусам
+    rides_time = ride_lifecycle(movement)
+
+    # Получаем информацию по завершенным поездкам (кроме номера водителя)
+    fact_rides = rides_time.merge(rides, how='left', left_on='ride', right_on='ride_id')
+    # Убираем поездки по которым попала только частичная информация
+    fact_rides = fact_rides[fact_rides.client_phone.notna()]
+
+    # Ищем нужного водителя через путевые листы по номеру авто и времени заказа. Добавляем в фактические поездки.
+    fact_rides, rides_without_driver = assign_drivers(fact_rides, fact_waybills, ride_dt_col='dt')
+    fact_rides = fact_rides[[
+        'ride', 'point_from', 'point_to', 'distance', 'price', 'client_phone', 'driver_pers_num',
+        'car_plate_num', 'ride_arrival_dt', 'ride_start_dt', 'ride_end_dt']]
+    fact_rides = fact_rides.rename(columns={
+        'ride':'ride_id',
+        'point_from':'point_from_txt',
+        'point_to':'point_to_txt',
+        'distance':'distance_val',
+        'price':'price_amt',
+        'client_phone':'client_phone_num'
+    })
+    return fact_rides.set_index('ride_id'), rides_without_driver
@@ -0,0 +1,206 @@
+import os
+import json
+import queue
+import datetime
+import threading
+
+from ftplib import FTP_TLS, all_errors, error_perm
+from concurrent.futures import ThreadPoolExecutor
+from dateutil import parser
+from loguru import logger
+
+
+MANIFEST_FILE = '.manifest.json'
+
+
+# Разбор времени из MLSD (RFC 3659): YYYYMMDDHHMMSS[.sss] в UTC -> локальное время без таймзоны,
+# чтобы сравнивать с loaded_until из work_batchdate
+def parse_mlsd_time(value: str) -> datetime.datetime:
+    timestamp = datetime.datetime.strptime(value[:14], '%Y%m%d%H%M%S')
+    return timestamp.replace(tzinfo=datetime.timezone.utc).astimezone().replace(tzinfo=None)
+
+
+# Параллельное скачивание файлов с FTP пулом из нескольких TLS сессий.
+# Локальный манифест (имя -> размер, время изменения) позволяет не качать повторно уже загруженные файлы.
+class FtpDownloader:
+
+    def __init__(
+        self,
+        host: str,
+        user: str,
+        passwd: str,
+        local_root: str,
+        remote_root: str = '..',
+        workers: int = 4,
+        port: int = 21,
+        ftp_class=FTP_TLS,
+        keep_alive: bool = False
+    ):
+        self.host = host
+        self.user = user
+        self.passwd = passwd
+        self.port = port
+        self.local_root = local_root
+        self.remote_root = remote_root
+        self.workers = max(1, workers)
+        self.ftp_class = ftp_class
+        # keep_alive: сессии не закрываются после скачивания, а переиспользуются следующими вызовами
+        # (для долгоживущего процесса, чтобы не проходить TLS-рукопожатие и логин на каждом батче)
+        self.keep_alive = keep_alive
+        self._idle = queue.LifoQueue()
+        self.dir_bytes = {}
+        self._lock = threading.Lock()
+        self.pending = {}
+
+    # Открываем сессию (или берем живую свободную) и переходим в нужную директорию
+    def connect(self, dir: str):
+        ftp = self._idle_session()
+        if ftp is None:
+            ftp = self.ftp_class()
+            ftp.connect(self.host, self.port)
+            ftp.login(self.user, self.passwd)
+            if isinstance(ftp, FTP_TLS):
+                ftp.prot_p()
+            ftp.home = ftp.pwd()
+        ftp.cwd(ftp.home)
+        ftp.cwd(self.remote_root + '/' + dir)
+        return ftp
+
+    # Свободная сессия, еще не закрытая сервером по таймауту
+    def _idle_session(self):
+        while True:
+            try:
+                ftp = self._idle.get_nowait()
+            except queue.Empty:
+                return None
+            try:
+                ftp.voidcmd('NOOP')
+                return ftp
+            except all_errors:
+                ftp.close()
+
+    # Сессия больше не нужна вызывающему: в режиме keep_alive возвращаем ее в пул
+    def release(self, ftp):
+        if self.keep_alive:
+            self._idle.put(ftp)
+            return
+        try:
+            ftp.quit()
+        except all_errors:
+            ftp.close()
+
+    # Закрываем все свободные сессии
+    def close(self):
+        while True:
+            try:
+                ftp = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                ftp.quit()
+            except all_errors:
+                ftp.close()
+
+    # Листинг директории: имя -> (размер, время изменения)
+    # Если сервер не поддерживает MLSD, разбираем LIST как раньше
+    def listing(self, ftp) -> dict:
+        items = {}
+        try:
+            for name, facts in ftp.mlsd(facts=['type', 'size', 'modify']):
+                if facts.get('type', 'file') != 'file':
+                    continue
+                items[name] = (int(facts.get('size', -1)), parse_mlsd_time(facts['modify']))
+        except error_perm:
+            lines = []
+            ftp.retrlines('LIST', lines.append)
+            for line in lines:
+                tokens = line.split(maxsplit=8)
+                if len(tokens) < 9 or tokens[0].startswith('d'):
+                    continue
+                items[tokens[8]] = (int(tokens[4]), parser.parse(' '.join(tokens[5:8])))
+        return items
+
+    def manifest_path(self, dir: str) -> str:
+        return os.path.join(self.local_root, dir, MANIFEST_FILE)
+
+    def load_manifest(self, dir: str) -> dict:
+        path = self.manifest_path(dir)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as file:
+            return json.load(file)
+
+    # Сохраняем в манифест файлы, скачанные в текущем запуске.
+    # Вызывается только после успешной загрузки в хранилище, иначе при падении файлы потеряются
+    def commit(self):
+        for dir, items in self.pending.items():
+            manifest = self.load_manifest(dir)
+            manifest.update(items)
+            path = self.manifest_path(dir)
+            with open(path + '.tmp', 'w') as file:
+                json.dump(manifest, file)
+            os.replace(path + '.tmp', path)
+        self.pending = {}
+
+    # Скачивание новых и измененных файлов директории, время изменения которых позже dt.
+    # skip_known=False качает и уже загруженные файлы (нужно, когда окно с запасом используется в трансформации).
+    # on_file(path) вызывается для каждого скачанного файла сразу после его загрузки
+    def get_delta_items(self, dir: str, dt: datetime.datetime, skip_known: bool = True, on_file=None) -> list:
+        ftp = self.connect(dir)
+        try:
+            items = self.listing(ftp)
+        finally:
+            self.release(ftp)
+
+        manifest = self.load_manifest(dir)
+        to_extract = {}
+        for name, (size, modified) in items.items():
+            known = manifest.get(name)
+            if skip_known and known == [size, modified.isoformat()]:
+                continue
+            if modified > dt:
+                to_extract[name] = [size, modified.isoformat()]
+
+        names = sorted(to_extract)
+        self.download(dir, names, on_file=on_file)
+        with self._lock:
+            self.pending.setdefault(dir, {}).update(to_extract)
+        logger.info('Downloaded {} of {} files from {}', len(names), len(items), dir)
+        return names
+
+    # Раздаем файлы из общей очереди ограниченному числу сессий
+    def download(self, dir: str, names: list, on_file=None):
+        if not names:
+            return
+        files = queue.Queue()
+        for name in names:
+            files.put(name)
+
+        def worker():
+            ftp = self.connect(dir)
+            try:
+                while True:
+                    try:
+                        name = files.get_nowait()
+                    except queue.Empty:
+                        break
+                    path = self.retrieve(ftp, dir, name)
+                    if on_file is not None:
+                        on_file(path)
+            finally:
+                self.release(ftp)
+
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(names))) as pool:
+            for future in [pool.submit(worker) for _ in range(min(self.workers, len(names)))]:
+                future.result()
+
+    # Пишем во временный файл и переименовываем, чтобы не оставить недокачанный файл
+    def retrieve(self, ftp, dir: str, name: str) -> str:
+        path = os.path.join(self.local_root, dir, name)
+        with open(path + '.part', 'wb') as file:
+            ftp.retrbinary('RETR ' + name, file.write)
+            size = file.tell()
+        os.replace(path + '.part', path)
+        with self._lock:
+            self.dir_bytes[dir] = self.dir_bytes.get(dir, 0) + size
+        return path
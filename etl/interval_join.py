@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+
+from etl.dtypes import align_categories
+
+
+# Сопоставление поездок с путевыми листами: для каждой поездки ищем путевой лист
+# на ту же машину, в рабочий период которого попадает время заказа (dt_begin).
+# Вместо перебора всех путевых листов для каждой поездки (O(rides * waybills))
+# используем сортировку + merge_asof по номеру машины, что дает O((n + m) log(n + m)).
+def assign_drivers(
+    rides: pd.DataFrame,
+    waybills: pd.DataFrame,
+    ride_dt_col: str = 'dt_begin',
+    plate_col: str = 'car_plate_num'
+):
+    # Поездки без времени или номера машины сопоставить невозможно
+    keyed_mask = (rides[ride_dt_col].notna() & rides[plate_col].notna()).to_numpy()
+    keyed = rides[keyed_mask]
+
+    left = keyed[[plate_col, ride_dt_col]].copy()
+    left['_pos'] = range(len(left))
+    left = left.sort_values(ride_dt_col, kind='mergesort')
+
+    right = waybills.reset_index(drop=True)[[plate_col, 'work_start_dt', 'work_end_dt', 'driver_pers_num']]
+    right = right.dropna(subset=[plate_col, 'work_start_dt']).sort_values('work_start_dt', kind='mergesort')
+    # Номера машин в поездках и путевых листах могут быть категориями с разным набором значений
+    left[plate_col], right[plate_col] = align_categories(left[plate_col], right[plate_col])
+    # Путевые листы одной машины могут пересекаться: максимальный конец среди всех листов,
+    # начавшихся не позже текущего, показывает, покрывает ли заказ какой-то более ранний лист
+    right['_cover_end'] = right.groupby(plate_col, observed=True)['work_end_dt'].cummax()
+
+    # Для каждой поездки берем последний путевой лист этой машины, начавшийся не позже заказа
+    matched = pd.merge_asof(
+        left,
+        right,
+        left_on=ride_dt_col,
+        right_on='work_start_dt',
+        by=plate_col,
+        direction='backward'
+    )
+    # Заказ должен попадать и в конец рабочего периода
+    in_period = matched[ride_dt_col] <= matched['work_end_dt']
+    matched['driver_pers_num'] = matched['driver_pers_num'].where(in_period)
+
+    # Последний лист закончился раньше заказа, но его покрывает более ранний длинный лист:
+    # для таких (редких) поездок ищем среди листов машины последний начавшийся, в период которого попадает заказ
+    covered = ~in_period & (matched[ride_dt_col] <= matched['_cover_end'])
+    if covered.any():
+        misses = matched.loc[covered, [plate_col, ride_dt_col, '_pos']]
+        candidates = misses.merge(right[[plate_col, 'work_start_dt', 'work_end_dt', 'driver_pers_num']], on=plate_col)
+        candidates = candidates[
+            (candidates[ride_dt_col] >= candidates['work_start_dt']) &
+            (candidates[ride_dt_col] <= candidates['work_end_dt'])
+        ]
+        found = candidates.sort_values('work_start_dt', kind='mergesort').groupby('_pos')['driver_pers_num'].last()
+        fallback = matched['_pos'].map(found)
+        matched['driver_pers_num'] = matched['driver_pers_num'].where(~covered, fallback)
+    matched = matched.sort_values('_pos')
+
+    drivers = np.full(len(rides), None, dtype=object)
+    drivers[keyed_mask] = matched['driver_pers_num'].to_numpy()
+    result = rides.copy()
+    result['driver_pers_num'] = drivers
+
+    # Поездки без путевого листа возвращаем отдельно, чтобы явно о них сообщить
+    no_driver = result['driver_pers_num'].isna()
+    return result[~no_driver], result[no_driver]
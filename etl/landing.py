@@ -0,0 +1,164 @@
+import os
+import json
+import shutil
+import datetime
+import threading
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from loguru import logger
+
+from etl.dtypes import compact, plain_categories
+
+
+MANIFEST_FILE = '_manifest.json'
+
+# Источники зоны приземления: колонка даты для партиционирования и ключ записи.
+# Категории пишутся строками (у частей батча разные наборы категорий), при чтении восстанавливаются.
+# Путевые листы перекачиваются с нахлестом, поэтому при чтении периода дубли по ключу схлопываются.
+# Ключ платежа - исходные строки, из которых в БД считается transaction_id
+LANDING_SOURCES = {
+    'waybills': {'date_col': 'start', 'key': ['number']},
+    'payments': {'date_col': 'transaction_dt', 'key': ['transaction_dt_raw', 'card_num']}
+}
+
+
+# Локальный архив сырых данных: каждый скачанный батч путевых листов и платежей
+# пишется в сжатый Parquet с партициями по дням: <root>/<source>/dt=YYYY-MM-DD/<batch>-<part>.parquet.
+# Манифест источника хранит файлы, батчи, строки и диапазон дат.
+# Повторная обработка периода - локальное чтение партиций вместо скачивания с FTP
+class LandingZone:
+
+    def __init__(self, root: str, compression: str = 'zstd'):
+        self.root = root
+        self.compression = compression
+        self._lock = threading.Lock()
+
+    def manifest_path(self, source: str) -> str:
+        return os.path.join(self.root, source, MANIFEST_FILE)
+
+    def load_manifest(self, source: str) -> list:
+        path = self.manifest_path(source)
+        if not os.path.exists(path):
+            return []
+        with open(path) as file:
+            return json.load(file)
+
+    def _save_manifest(self, source: str, manifest: list):
+        path = self.manifest_path(source)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w') as file:
+            json.dump(manifest, file, indent=1)
+        os.replace(path + '.tmp', path)
+
+    def _remove(self, source: str, entries: list):
+        for entry in entries:
+            path = os.path.join(self.root, source, entry['file'])
+            if os.path.exists(path):
+                os.remove(path)
+            partition = os.path.dirname(path)
+            if os.path.isdir(partition) and not os.listdir(partition):
+                os.rmdir(partition)
+
+    # Удаляем файлы батча (если этап приземления перезапускается после ошибки)
+    def drop_batch(self, source: str, batch: str):
+        with self._lock:
+            manifest = self.load_manifest(source)
+            self._remove(source, [entry for entry in manifest if entry['batch'] == batch])
+            self._save_manifest(source, [entry for entry in manifest if entry['batch'] != batch])
+
+    # Запись части батча: строки раскладываются по дневным партициям
+    def write(self, source: str, df: pd.DataFrame, batch: str) -> int:
+        if df.empty:
+            return 0
+        date_col = LANDING_SOURCES[source]['date_col']
+        days = df[date_col].dt.date
+        with self._lock:
+            manifest = self.load_manifest(source)
+            part = sum(entry['batch'] == batch for entry in manifest)
+            for day, rows in df.groupby(days, sort=True):
+                file = 'dt={}/{}-{:05d}.parquet'.format(day.isoformat(), batch, part)
+                path = os.path.join(self.root, source, file)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                pq.write_table(
+                    pa.Table.from_pandas(plain_categories(rows, source)), path + '.tmp', compression=self.compression
+                )
+                os.replace(path + '.tmp', path)
+                manifest.append({
+                    'file': file,
+                    'batch': batch,
+                    'day': day.isoformat(),
+                    'rows': len(rows),
+                    'min_dt': rows[date_col].min().isoformat(),
+                    'max_dt': rows[date_col].max().isoformat()
+                })
+                part += 1
+            self._save_manifest(source, manifest)
+        return len(df)
+
+    def _select(self, source: str, batch: str = None, first_day: datetime.date = None, last_day: datetime.date = None) -> list:
+        entries = self.load_manifest(source)
+        if batch is not None:
+            entries = [entry for entry in entries if entry['batch'] == batch]
+        if first_day is not None:
+            entries = [entry for entry in entries if entry['day'] >= first_day.isoformat()]
+        if last_day is not None:
+            entries = [entry for entry in entries if entry['day'] <= last_day.isoformat()]
+        return entries
+
+    def _read(self, source: str, entries: list, columns: list = None) -> pd.DataFrame:
+        tables = [
+            pq.read_table(os.path.join(self.root, source, entry['file']), columns=columns, memory_map=True)
+            for entry in entries
+        ]
+        return compact(pa.concat_tables(tables).to_pandas(split_blocks=True, self_destruct=True), source)
+
+    # Чтение батча или периода одним DataFrame (memory-mapped чтение Parquet, сборка через Arrow).
+    # При чтении нескольких батчей дубли по ключу источника схлопываются (берется последний батч).
+    # Если файлов нет, возвращается None
+    def read(
+        self,
+        source: str,
+        batch: str = None,
+        first_day: datetime.date = None,
+        last_day: datetime.date = None,
+        columns: list = None
+    ) -> pd.DataFrame:
+        entries = sorted(self._select(source, batch, first_day, last_day), key=lambda entry: entry['batch'])
+        if not entries:
+            return None
+        df = self._read(source, entries, columns)
+        key = LANDING_SOURCES[source]['key']
+        if batch is None:
+            keys = df.reset_index()[key] if key[0] in df.index.names else df[key]
+            df = df[~keys.duplicated(keep='last').to_numpy()]
+        return df
+
+    # Чтение батча по одному файлу (для загрузки пачками без сборки всего батча в памяти)
+    def iter_batch(self, source: str, batch: str):
+        for entry in self._select(source, batch):
+            yield self._read(source, [entry])
+
+    # Политика хранения: удаляем дневные партиции старше retention_days
+    def cleanup(self, retention_days: int, today: datetime.date = None) -> int:
+        oldest = ((today or datetime.date.today()) - datetime.timedelta(days=retention_days)).isoformat()
+        removed = 0
+        for source in LANDING_SOURCES:
+            source_dir = os.path.join(self.root, source)
+            if not os.path.isdir(source_dir):
+                continue
+            with self._lock:
+                manifest = self.load_manifest(source)
+                expired = [entry for entry in manifest if entry['day'] < oldest]
+                self._remove(source, expired)
+                self._save_manifest(source, [entry for entry in manifest if entry['day'] >= oldest])
+                # Партиции, которых нет в манифесте (например, после сбоя записи)
+                for partition in os.listdir(source_dir):
+                    if partition.startswith('dt=') and partition[3:] < oldest:
+                        shutil.rmtree(os.path.join(source_dir, partition), ignore_errors=True)
+            removed += len(expired)
+        if removed:
+            logger.info('Landing zone: removed {} files older than {}', removed, oldest)
+        return removed
@@ -0,0 +1,73 @@
+import io
+import time
+
+import pandas as pd
+
+from loguru import logger
+
+
+# Количество строк, сериализуемых в CSV за один проход COPY
+COPY_BATCH_ROWS = 100000
+
+
+def _columns(df: pd.DataFrame) -> str:
+    return ', '.join('"{}"'.format(column) for column in df.columns)
+
+
+# Потоковая передача DataFrame в таблицу через COPY FROM STDIN (CSV) пачками по COPY_BATCH_ROWS
+def copy_rows(cursor, df: pd.DataFrame, table: str):
+    sql = "COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')".format(table, _columns(df))
+    for start in range(0, len(df), COPY_BATCH_ROWS):
+        buffer = io.StringIO()
+        df.iloc[start:start + COPY_BATCH_ROWS].to_csv(buffer, header=False, index=False, na_rep='\\N')
+        buffer.seek(0)
+        cursor.copy_expert(sql, buffer)
+
+
+# Индекс DataFrame (первичный ключ, как в pangres) переносим в колонки
+def _with_index(df: pd.DataFrame) -> pd.DataFrame:
+    if any(name is not None for name in df.index.names):
+        return df.reset_index()
+    return df
+
+
+# Загрузка в фактовую таблицу: COPY в UNLOGGED таблицу-стейджинг и одна вставка
+# INSERT ... SELECT ... ON CONFLICT DO NOTHING в целевую (замена pangres.upsert(if_row_exists='ignore')).
+# Возвращает количество вставленных и пропущенных (уже существующих) строк
+def copy_upsert(engine, df: pd.DataFrame, table_name: str, schema: str = 'dwh_kazan'):
+    df = _with_index(df)
+    target = '{}.{}'.format(schema, table_name)
+    stage = '{}.work_stage_{}'.format(schema, table_name)
+    start = time.perf_counter()
+
+    with engine.begin() as conn:
+        cursor = conn.connection.cursor()
+        cursor.execute('CREATE UNLOGGED TABLE IF NOT EXISTS {} (LIKE {} INCLUDING DEFAULTS)'.format(stage, target))
+        cursor.execute('TRUNCATE {}'.format(stage))
+        copy_rows(cursor, df, stage)
+        cursor.execute(
+            'INSERT INTO {target} ({columns}) SELECT {columns} FROM {stage} ON CONFLICT DO NOTHING'.format(
+                target=target, columns=_columns(df), stage=stage
+            )
+        )
+        inserted = cursor.rowcount
+        cursor.execute('TRUNCATE {}'.format(stage))
+
+    skipped = len(df) - inserted
+    duration = time.perf_counter() - start
+    logger.info(
+        '{}: {} rows inserted, {} skipped in {:.2f} s ({:.0f} rows/s)',
+        table_name, inserted, skipped, duration, len(df) / duration if duration else 0
+    )
+    return inserted, skipped
+
+
+# Добавление строк через COPY прямо в таблицу (замена to_sql(if_exists='append')).
+# replace=True пересоздает таблицу по структуре DataFrame (замена to_sql(if_exists='replace'))
+def copy_append(engine, df: pd.DataFrame, table_name: str, schema: str = 'dwh_kazan', replace: bool = False) -> int:
+    df = _with_index(df)
+    if replace:
+        df.head(0).to_sql(table_name, con=engine, schema=schema, index=False, if_exists='replace')
+    with engine.begin() as conn:
+        copy_rows(conn.connection.cursor(), df, '{}.{}'.format(schema, table_name))
+    return len(df)
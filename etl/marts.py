@@ -0,0 +1,508 @@
+import datetime
+
+import pandas as pd
+
+from sqlalchemy.sql import text
+
+from etl.overtime import OVERTIME_WINDOW, overtime_violations
+from etl.rollup import REFRESH_DAYS_SQL, RIDE_SPEED_SQL, SPEED_LIMIT
+from etl.scheduler import SUCCESS, Job, run_jobs
+
+
+# Начало "бесконечной" версии - как в work_batchdate при первом запуске
+EPOCH_DT = datetime.datetime(1900, 1, 1)
+
+# Максимальная длительность одного путевого листа (для отсечения партиций fact_waybills по началу работы)
+OVERTIME_WAYBILL_MAX = datetime.timedelta(days=2)
+
+
+# -----------------------------------------------------------------------
+# Водяные знаки (watermarks) загрузки хранилища и обновления витрин
+# -----------------------------------------------------------------------
+
+def ensure_work_tables(conn):
+    conn.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS dwh_kazan.work_dm_batchdate (
+            loaded_until timestamp,
+            status varchar(10)
+        )
+        '''
+    )
+    conn.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS dwh_kazan.work_dm_touched_days (
+            report_dt date PRIMARY KEY,
+            touched_dt timestamp
+        )
+        '''
+    )
+    conn.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS dwh_kazan.work_dm_touched_clients (
+            phone_num varchar(18) PRIMARY KEY,
+            touched_dt timestamp
+        )
+        '''
+    )
+
+
+# До какого момента хранилище загружено последним успешным запуском ETL
+def etl_watermark(conn) -> datetime.datetime:
+    return conn.execute(
+        '''
+        SELECT COALESCE(MAX(bd.loaded_until), '1900-01-01 00:00:00')
+        FROM dwh_kazan.work_batchdate AS bd
+        WHERE bd.status = 'Success'
+        '''
+    ).fetchone()[0]
+
+
+# По какой момент загрузки хранилища витрины уже построены
+def marts_watermark(conn) -> datetime.datetime:
+    return conn.execute(
+        '''
+        SELECT COALESCE(MAX(bd.loaded_until), '1900-01-01 00:00:00')
+        FROM dwh_kazan.work_dm_batchdate AS bd
+        WHERE bd.status = 'Success'
+        '''
+    ).fetchone()[0]
+
+
+def log_marts_batch(conn, loaded_until: datetime.datetime, status: str):
+    conn.execute(
+        text("INSERT INTO dwh_kazan.work_dm_batchdate (loaded_until, status) VALUES(:dt, :st)"),
+        {'dt': loaded_until, 'st': status}
+    )
+
+
+# Завершенные дни, для которых нужно построить ежедневные витрины.
+# День считается завершенным, когда хранилище загружено до его конца.
+# При первом запуске строим только последний завершенный день (как раньше - current_date - 1)
+def days_to_build(marts_until: datetime.datetime, etl_until: datetime.datetime) -> list:
+    last_day = etl_until.date() - datetime.timedelta(days=1)
+    if marts_until <= EPOCH_DT:
+        first_day = last_day
+    else:
+        first_day = marts_until.date()
+    return date_range(first_day, last_day)
+
+
+# -----------------------------------------------------------------------
+# Затронутые загрузкой дни и клиенты. Поездка может загрузиться после того, как витрины за ее день
+# уже построены (незавершенные поездки и поездки без путевого листа ждут следующих батчей),
+# поэтому ETL отмечает дни и телефоны каждой загрузки фактов, а витрины перестраивают их,
+# не сравнивая время событий с водяным знаком загрузки.
+# Повторная отметка обновляет touched_dt, и после построения удаляются только прочитанные отметки
+# -----------------------------------------------------------------------
+
+def touch_days(engine, days: list):
+    if not days:
+        return
+    engine.execute(
+        text(
+            '''
+            INSERT INTO dwh_kazan.work_dm_touched_days (report_dt, touched_dt)
+            SELECT DISTINCT unnest(CAST(:days AS date[])), clock_timestamp()
+            ON CONFLICT (report_dt) DO UPDATE SET touched_dt = EXCLUDED.touched_dt
+            '''
+        ),
+        {'days': list(days)}
+    )
+
+
+def touch_clients(engine, phones: list):
+    if not phones:
+        return
+    engine.execute(
+        text(
+            '''
+            INSERT INTO dwh_kazan.work_dm_touched_clients (phone_num, touched_dt)
+            SELECT DISTINCT unnest(CAST(:phones AS varchar[])), clock_timestamp()
+            ON CONFLICT (phone_num) DO UPDATE SET touched_dt = EXCLUDED.touched_dt
+            '''
+        ),
+        {'phones': list(phones)}
+    )
+
+
+# Номер карты из платежа (16 цифр без пробелов) в формате dim_clients: группы по 4 цифры через пробел
+def client_card_num(card: str) -> str:
+    card = card.replace(' ', '')
+    return ' '.join(card[i:i + 4] for i in range(0, len(card), 4))
+
+
+# Клиенты по номерам карт из платежей (в fact_payments номер без пробелов, в dim_clients - с пробелами).
+# Номера приводим к формату dim_clients, чтобы сравнение шло по индексу dim_clients_card_idx
+def touch_client_cards(engine, cards: list):
+    if not cards:
+        return
+    engine.execute(
+        text(
+            '''
+            INSERT INTO dwh_kazan.work_dm_touched_clients (phone_num, touched_dt)
+            SELECT DISTINCT phone_num, clock_timestamp()
+            FROM dwh_kazan.dim_clients
+            WHERE card_num = ANY(CAST(:cards AS varchar[]))
+            ON CONFLICT (phone_num) DO UPDATE SET touched_dt = EXCLUDED.touched_dt
+            '''
+        ),
+        {'cards': [client_card_num(card) for card in cards]}
+    )
+
+
+def load_touched(conn) -> dict:
+    return {
+        'days': conn.execute('SELECT report_dt, touched_dt FROM dwh_kazan.work_dm_touched_days').fetchall(),
+        'clients': conn.execute('SELECT phone_num, touched_dt FROM dwh_kazan.work_dm_touched_clients').fetchall()
+    }
+
+
+# Снимаем отметки, по которым витрины построены (если после чтения отметка обновилась, она остается)
+def release_touched(conn, touched: dict):
+    for table, key, rows in [
+        ('work_dm_touched_days', 'report_dt', touched['days']),
+        ('work_dm_touched_clients', 'phone_num', touched['clients'])
+    ]:
+        if rows:
+            conn.execute(
+                text(
+                    '''
+                    DELETE FROM dwh_kazan.{table} AS t
+                    USING unnest(:keys, CAST(:touched AS timestamp[])) AS r(key, touched_dt)
+                    WHERE t.{key} = r.key AND t.touched_dt = r.touched_dt
+                    '''.format(table=table, key=key)
+                ),
+                {'keys': [row[0] for row in rows], 'touched': [row[1] for row in rows]}
+            )
+
+
+# Что строить при обычном обновлении: завершенные с прошлого обновления дни и завершенные дни,
+# затронутые загрузками после их построения; затронутые клиенты; водяной знак хранилища для отметки
+# об успехе и отметки, которые снимаются после построения.
+# При первом запуске старые отметки снимаются без перестроения (строится только последний день)
+def marts_to_build(conn) -> tuple:
+    etl_until = etl_watermark(conn)
+    marts_until = marts_watermark(conn)
+    days = set(days_to_build(marts_until, etl_until))
+    touched = load_touched(conn)
+    touched['days'] = [row for row in touched['days'] if row[0] < etl_until.date()]
+    if marts_until > EPOCH_DT:
+        days |= {row[0] for row in touched['days']}
+    phones = [row[0] for row in touched['clients']]
+    return sorted(days), phones, etl_until, touched
+
+
+def date_range(first_day: datetime.date, last_day: datetime.date) -> list:
+    return [first_day + datetime.timedelta(days=i) for i in range((last_day - first_day).days + 1)]
+
+
+# Отчетный день как полуинтервал [day, next_day): условие по самой колонке времени, а не по ::date,
+# чтобы работали индексы и отсечение партиций
+def day_range(day: datetime.date) -> dict:
+    return {'day': day, 'next_day': day + datetime.timedelta(days=1)}
+
+
+# -----------------------------------------------------------------------
+# Ежедневные витрины: каждая строится за один день report_dt.
+# Перед вставкой удаляем отчет за этот день, поэтому перестроение любого дня идемпотентно
+# -----------------------------------------------------------------------
+
+### 1. Выплата водителям
+# Выплаты считаем по дневному агрегату agg_driver_day (дистанция и выручка завершенных за день поездок)
+# Джойним с информацией о водителях из dim_drivers
+DRIVERS_PAYMENTS_SQL = '''
+            INSERT INTO rep_drivers_payments
+            SELECT
+                dd.personnel_num, dd.last_name, dd.first_name, dd.middle_name, dd.card_num,
+                ROUND(a.price_amt * 0.8 - 47.26 * 7 * a.distance_val / 100 - 5 * a.distance_val, 2) AS amount,
+                a.report_dt
+            FROM agg_driver_day a
+            JOIN
+            (
+                SELECT
+                    personnel_num,
+                    last_name,
+                    first_name,
+                    middle_name,
+                    card_num
+                FROM dim_drivers
+                WHERE :day BETWEEN start_dt AND end_dt
+            ) dd
+            ON a.personnel_num = dd.personnel_num
+            WHERE a.report_dt = :day;
+            '''
+
+
+def build_drivers_payments(conn, day: datetime.date):
+    conn.execute(text('DELETE FROM rep_drivers_payments WHERE report_dt = :day'), {'day': day})
+    return conn.execute(text(DRIVERS_PAYMENTS_SQL), day_range(day)).rowcount
+
+
+### 2. Водители-нарушители
+# Номер нарушения продолжает счет по нарушениям водителя за предыдущие дни -
+# накопленное число берем из agg_driver_day, а не пересчитываем по всей истории витрины
+VIOLATIONS_DELETE_SQL = '''
+            DELETE FROM rep_drivers_violations
+            WHERE ride IN (SELECT ride_id FROM fact_rides WHERE ride_end_dt >= :day AND ride_end_dt < :next_day)
+            '''
+
+VIOLATIONS_INSERT_SQL = '''
+            INSERT INTO rep_drivers_violations
+            SELECT
+                q1.personnel_num, q1.ride, q1.speed,
+                COALESCE(a.violations_before, 0) + q1.violations_cnt AS violations_cnt
+            FROM
+            (
+                SELECT
+                    driver_pers_num AS personnel_num,
+                    ride_id AS ride,
+                    {speed} AS speed,
+                    ROW_NUMBER() OVER(PARTITION BY driver_pers_num ORDER BY ride_id) - 1 AS violations_cnt
+                FROM dwh_kazan.fact_rides
+                WHERE
+                    ride_end_dt >= :day AND ride_end_dt < :next_day
+                    AND ride_start_dt IS NOT NULL
+                    AND {speed} > {limit}
+            ) AS q1
+            LEFT JOIN dwh_kazan.agg_driver_day AS a
+            ON a.personnel_num = q1.personnel_num AND a.report_dt = :day;
+            '''.format(speed=RIDE_SPEED_SQL, limit=SPEED_LIMIT)
+
+
+def build_drivers_violations(conn, day: datetime.date):
+    conn.execute(text(VIOLATIONS_DELETE_SQL), day_range(day))
+    return conn.execute(text(VIOLATIONS_INSERT_SQL), day_range(day)).rowcount
+
+
+### 3. Перерабатывающие водители
+# Точная наработка в каждом 24-часовом окне считается в etl.overtime по путевым листам,
+# начавшимся в отчетные дни (и захватывающим их), плюс сутки после для окон, переходящих через полночь
+# Путевые листы, начатые не раньше чем за OVERTIME_WAYBILL_MAX до периода: нижняя граница по work_start_dt
+# нужна, чтобы отсечь партиции fact_waybills (смена не длится дольше OVERTIME_WAYBILL_MAX)
+OVERTIME_WAYBILLS_SQL = '''
+            SELECT driver_pers_num, work_start_dt, work_end_dt
+            FROM fact_waybills
+            WHERE work_end_dt >= :first_day AND work_start_dt >= :min_start AND work_start_dt < :window_end
+            '''
+
+
+# Наработка передается секундами и приводится к interval в запросе
+# (to_sql записал бы timedelta64 как bigint наносекунд, а колонка total_work_time - interval)
+OVERTIME_INSERT_SQL = '''
+            INSERT INTO dwh_kazan.rep_drivers_overtime (personnel_num, total_work_time, period_start)
+            VALUES (:personnel_num, :seconds * interval '1 second', :period_start)
+            '''
+
+
+def overtime_params(first_day: datetime.date, last_day: datetime.date) -> dict:
+    return {
+        'first_day': first_day,
+        'min_start': first_day - OVERTIME_WAYBILL_MAX,
+        'window_end': last_day + datetime.timedelta(days=1) + OVERTIME_WINDOW
+    }
+
+
+def build_drivers_overtime_range(conn, first_day: datetime.date, last_day: datetime.date):
+    waybills = pd.read_sql(
+        text(OVERTIME_WAYBILLS_SQL),
+        conn,
+        params=overtime_params(first_day, last_day)
+    )
+    violations = overtime_violations(waybills)
+    period_day = violations['period_start'].dt.date
+    violations = violations[(period_day >= first_day) & (period_day <= last_day)]
+
+    conn.execute(
+        text('DELETE FROM rep_drivers_overtime WHERE period_start >= :first_day AND period_start < :next_day'),
+        {'first_day': first_day, 'next_day': last_day + datetime.timedelta(days=1)}
+    )
+    if not violations.empty:
+        conn.execute(
+            text(OVERTIME_INSERT_SQL),
+            [
+                {'personnel_num': personnel_num, 'seconds': seconds, 'period_start': period_start.to_pydatetime()}
+                for personnel_num, seconds, period_start in zip(
+                    violations['personnel_num'],
+                    violations['total_work_time'].dt.total_seconds(),
+                    violations['period_start']
+                )
+            ]
+        )
+    return len(violations)
+
+
+def build_drivers_overtime(conn, day: datetime.date):
+    return build_drivers_overtime_range(conn, day, day)
+
+
+DAILY_MARTS = {
+    'rep_drivers_payments': build_drivers_payments,
+    'rep_drivers_violations': build_drivers_violations,
+    'rep_drivers_overtime': build_drivers_overtime
+}
+
+
+# -----------------------------------------------------------------------
+# Историчная витрина
+# -----------------------------------------------------------------------
+
+### 4. “Знай своего клиента”
+# Строим на основе dim_clients только для затронутых клиентов (телефонов):
+# новые поездки, новые платежи по их картам или новые версии в dim_clients
+# Подтягиваем информацию по поступившим платежам по каждой карте
+# Подтягиваем информацию по поездкам и стоимости услуг для каждого номера и карты
+# В итоге делаем UPSERT и обновляем измененные записи
+
+# Клиенты, затронутые событиями после since (по времени событий - для перестроения периода, --backfill-from)
+def clients_touched_since(conn, since: datetime.datetime) -> list:
+    return [row[0] for row in conn.execute(
+        text(
+            '''
+            SELECT client_phone_num
+            FROM fact_rides
+            WHERE (ride_arrival_dt > :since OR ride_end_dt > :since) AND client_phone_num IS NOT NULL
+            UNION
+            SELECT phone_num
+            FROM dim_clients
+            WHERE start_dt > :since OR (end_dt > :since AND end_dt < '9999-01-01 00:00:00')
+            UNION
+            SELECT dc.phone_num
+            FROM fact_payments fp
+            JOIN dim_clients dc
+            ON dc.card_num = SUBSTRING(fp.card_num, 1, 4) || ' ' || SUBSTRING(fp.card_num, 5, 4) || ' ' || SUBSTRING(fp.card_num, 9, 4) || ' ' || SUBSTRING(fp.card_num, 13, 4)
+            WHERE fp.transaction_dt > :since
+            '''
+        ),
+        {'since': since}
+    )]
+
+
+def build_clients_hist(conn, phones: list):
+    if not phones:
+        return 0
+    return conn.execute(
+        text(
+            '''
+            INSERT INTO rep_clients_hist
+            WITH touched AS
+            (
+                SELECT DISTINCT unnest(CAST(:phones AS varchar[])) AS phone_num
+            ),
+            touched_clients AS
+            (
+                SELECT dc.*
+                FROM dim_clients dc
+                JOIN touched t
+                ON dc.phone_num = t.phone_num
+            )
+            SELECT
+                md5(dc.phone_num || dc.start_dt) AS client_id,
+                dc.phone_num,
+                COALESCE(frg.total_rides_cnt, 0) - COALESCE(frg.cancelled_cnt, 0) AS rides_cnt,
+                COALESCE(frg.cancelled_cnt, 0),
+                SUM(COALESCE(fp.paid_amt, 0)) OVER(PARTITION BY phone_num ORDER BY start_dt) AS spent_amt,
+                SUM(COALESCE(frg.total_amt, 0) - COALESCE(fp.paid_amt, 0)) OVER(PARTITION BY phone_num ORDER BY start_dt) AS debt_amt,
+                dc.start_dt,
+                dc.end_dt,
+                dc.deleted_flag
+            FROM touched_clients dc
+            LEFT JOIN
+            (
+                SELECT
+                    SUBSTRING(card_num, 1, 4) || ' ' || SUBSTRING(card_num, 5, 4) || ' ' || SUBSTRING(card_num, 9, 4) || ' ' || SUBSTRING(card_num, 13, 4) AS card_num,
+                    SUM(transaction_amt) AS paid_amt
+                FROM fact_payments
+                WHERE card_num IN (SELECT REPLACE(card_num, ' ', '') FROM touched_clients)
+                GROUP BY card_num
+            ) fp
+            ON dc.card_num = fp.card_num
+            LEFT JOIN
+            (
+                SELECT
+                    fr.client_phone_num,
+                    dc.card_num,
+                    COUNT(fr.ride_id) AS total_rides_cnt,
+                    COUNT(CASE WHEN fr.ride_start_dt IS NULL THEN 1 ELSE NULL END) AS cancelled_cnt,
+                    SUM(CASE WHEN fr.ride_start_dt IS NULL THEN NULL ELSE fr.price_amt END) AS total_amt
+                FROM fact_rides fr
+                JOIN touched_clients dc
+                ON fr.client_phone_num = dc.phone_num AND (fr.ride_arrival_dt BETWEEN dc.start_dt AND dc.end_dt)
+                GROUP BY fr.client_phone_num, dc.card_num
+            ) frg
+            ON dc.phone_num = frg.client_phone_num AND dc.card_num = frg.card_num
+            ON CONFLICT ON CONSTRAINT rep_clients_hist_pk DO UPDATE
+            SET
+                rides_cnt = EXCLUDED.rides_cnt,
+                cancelled_cnt = EXCLUDED.cancelled_cnt,
+                spent_amt = EXCLUDED.spent_amt,
+                debt_amt = EXCLUDED.debt_amt,
+                end_dt = EXCLUDED.end_dt,
+                deleted_flag = EXCLUDED.deleted_flag;
+            '''
+        ),
+        {'phones': list(phones)}
+    ).rowcount
+
+
+# -----------------------------------------------------------------------
+# Граф построения витрин
+# -----------------------------------------------------------------------
+
+# Витрины независимы друг от друга и читают только загруженные ETL факты, измерения и agg_driver_day,
+# поэтому строятся параллельно, в том числе разные дни одной витрины.
+# Каждая задача выполняется в своей транзакции на соединении из пула engine
+def mart_job_name(mart_name: str, day: datetime.date = None) -> str:
+    return mart_name if day is None else '{} {}'.format(mart_name, day)
+
+
+def mart_jobs(engine, days: list, phones: list) -> list:
+    def daily(build_mart, day):
+        def func(stat: dict):
+            with engine.begin() as conn:
+                stat['rows_out'] = build_mart(conn, day)
+        return func
+
+    def clients_hist(stat: dict):
+        with engine.begin() as conn:
+            stat['rows_in'] = len(phones)
+            stat['rows_out'] = build_clients_hist(conn, phones)
+
+    jobs = []
+    for mart_name, build_mart in DAILY_MARTS.items():
+        for day in days:
+            jobs.append(Job(mart_job_name(mart_name, day), daily(build_mart, day)))
+    jobs.append(Job(mart_job_name('rep_clients_hist'), clients_hist))
+    return jobs
+
+
+# Построение всех витрин параллельными задачами. Ошибка одной витрины не останавливает остальные,
+# но в конце поднимается исключение со списком непостроенных
+def build_marts(engine, days: list, phones: list, workers: int = 4, metrics=None):
+    status = run_jobs(mart_jobs(engine, days, phones), workers=workers, metrics=metrics)
+    failed = sorted(name for name, job_status in status.items() if job_status != SUCCESS)
+    if failed:
+        raise RuntimeError('Data marts not built: {}'.format(', '.join(failed)))
+
+
+# -----------------------------------------------------------------------
+# Проверка планов: запросы ежедневных витрин за день читают только партиции этого дня
+# -----------------------------------------------------------------------
+
+# Список проверок для etl.schema.check_plans
+def mart_plan_checks(day: datetime.date) -> list:
+    overtime = overtime_params(day, day)
+    return [
+        # Витрина платежей читает только agg_driver_day, fact_rides за день сканирует его пересчет
+        (
+            'agg_driver_day (rep_drivers_payments)',
+            REFRESH_DAYS_SQL.format(schema='dwh_kazan', speed=RIDE_SPEED_SQL, limit=SPEED_LIMIT),
+            {'first_day': day, 'next_day': day + datetime.timedelta(days=1)}, 'fact_rides', day, day
+        ),
+        ('rep_drivers_violations (delete)', VIOLATIONS_DELETE_SQL, day_range(day), 'fact_rides', day, day),
+        ('rep_drivers_violations', VIOLATIONS_INSERT_SQL, day_range(day), 'fact_rides', day, day),
+        (
+            'rep_drivers_overtime', OVERTIME_WAYBILLS_SQL, overtime, 'fact_waybills',
+            overtime['min_start'], overtime['window_end'] - datetime.timedelta(days=1)
+        )
+    ]
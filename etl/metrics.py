@@ -0,0 +1,110 @@
+import os
+import json
+import time
+import datetime
+import contextlib
+
+import pandas as pd
+
+from loguru import logger
+
+from etl.extract import peak_rss_mb
+
+
+METRICS_COLUMNS = [
+    'job', 'batch_start_dt', 'stage', 'started_dt', 'duration_sec',
+    'rows_in', 'rows_out', 'bytes', 'latency_sec', 'peak_rss_mb', 'status'
+]
+
+
+# Сбор метрик по этапам запуска: время, строки на входе и выходе, скачанные байты, пиковая память.
+# Сохраняются в dwh_kazan.work_stage_metrics и (опционально) в JSON или Prometheus textfile
+class StageMetrics:
+
+    def __init__(self, job: str, batch_start_dt: datetime.datetime):
+        self.job = job
+        self.batch_start_dt = batch_start_dt
+        self.records = []
+
+    # Замер одного этапа. Внутри блока можно заполнить stat['rows_in'], stat['rows_out'], stat['bytes'],
+    # stat['latency_sec'] (задержка от события в источнике до загрузки в хранилище)
+    @contextlib.contextmanager
+    def stage(self, name: str, rows_in: int = None):
+        stat = {'rows_in': rows_in, 'rows_out': None, 'bytes': None, 'latency_sec': None}
+        started_dt = datetime.datetime.now()
+        start = time.perf_counter()
+        status = 'Success'
+        try:
+            yield stat
+        except Exception:
+            status = 'Failure'
+            raise
+        finally:
+            record = dict(
+                job=self.job,
+                batch_start_dt=self.batch_start_dt,
+                stage=name,
+                started_dt=started_dt,
+                duration_sec=round(time.perf_counter() - start, 3),
+                peak_rss_mb=round(peak_rss_mb(), 1),
+                status=status,
+                **stat
+            )
+            self.records.append(record)
+            logger.debug(
+                'Stage {}: {} s, rows {} -> {}, peak RSS {} MB',
+                name, record['duration_sec'], record['rows_in'], record['rows_out'], record['peak_rss_mb']
+            )
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self.records, columns=METRICS_COLUMNS)
+
+    def save(self, engine, schema: str = 'dwh_kazan'):
+        engine.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS {}.work_stage_metrics (
+                job varchar(32),
+                batch_start_dt timestamp,
+                stage varchar(64),
+                started_dt timestamp,
+                duration_sec numeric(12, 3),
+                rows_in bigint,
+                rows_out bigint,
+                bytes bigint,
+                peak_rss_mb numeric(12, 1),
+                status varchar(10)
+            )
+            '''.format(schema)
+        )
+        engine.execute(
+            'ALTER TABLE {}.work_stage_metrics ADD COLUMN IF NOT EXISTS latency_sec numeric(12, 3)'.format(schema)
+        )
+        self.to_frame().to_sql('work_stage_metrics', con=engine, schema=schema, index=False, if_exists='append')
+
+    # Файл метрик: *.json - список записей, иначе формат Prometheus textfile collector
+    def write_textfile(self, path: str):
+        if path.endswith('.json'):
+            with open(path, 'w') as file:
+                json.dump(self.records, file, default=str, indent=2)
+            return
+
+        lines = []
+        for metric, field in [
+            ('etl_stage_duration_seconds', 'duration_sec'),
+            ('etl_stage_rows_in', 'rows_in'),
+            ('etl_stage_rows_out', 'rows_out'),
+            ('etl_stage_bytes', 'bytes'),
+            ('etl_stage_latency_seconds', 'latency_sec'),
+            ('etl_stage_peak_rss_megabytes', 'peak_rss_mb')
+        ]:
+            lines.append('# TYPE {} gauge'.format(metric))
+            for record in self.records:
+                if record[field] is None:
+                    continue
+                lines.append('{}{{job="{}",stage="{}",status="{}"}} {}'.format(
+                    metric, record['job'], record['stage'], record['status'], record[field]
+                ))
+        with open(path + '.tmp', 'w') as file:
+            file.write('\n'.join(lines) + '\n')
+        # Атомарная замена, чтобы node_exporter не прочитал недописанный файл
+        os.replace(path + '.tmp', path)
@@ -0,0 +1,74 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+
+# Длина скользящего окна и допустимая наработка в нем
+OVERTIME_WINDOW = datetime.timedelta(hours=24)
+OVERTIME_LIMIT = datetime.timedelta(hours=8)
+
+
+# Объединяем пересекающиеся и смежные путевые листы водителя в непрерывные периоды работы,
+# чтобы одно и то же время не считалось дважды
+def merge_work_periods(waybills: pd.DataFrame) -> pd.DataFrame:
+    periods = waybills[['driver_pers_num', 'work_start_dt', 'work_end_dt']].dropna()
+    periods = periods.sort_values(['driver_pers_num', 'work_start_dt'], kind='mergesort').reset_index(drop=True)
+    if periods.empty:
+        return periods
+
+    start = periods['work_start_dt'].to_numpy('datetime64[s]').astype(np.int64)
+    end = periods['work_end_dt'].to_numpy('datetime64[s]').astype(np.int64)
+    driver = periods['driver_pers_num'].to_numpy()
+
+    # Максимальный конец работы среди предыдущих путевых листов того же водителя
+    reach = pd.Series(end).groupby(driver, sort=False).cummax().shift(1).to_numpy()
+    new_driver = np.r_[True, driver[1:] != driver[:-1]]
+    new_period = new_driver | (start > np.nan_to_num(reach, nan=-np.inf))
+
+    return pd.DataFrame({
+        'driver_pers_num': driver[new_period],
+        'start': start[new_period],
+        'end': np.maximum.reduceat(end, np.flatnonzero(new_period))
+    })
+
+
+# Нарушения режима труда: для каждого начала периода работы считаем точную наработку
+# в окне [начало, начало + 24ч) и отбираем окна, где она больше 8 часов.
+# Сортировка + бинарный поиск по префиксным суммам: O(n log n) по числу путевых листов
+def overtime_violations(
+    waybills: pd.DataFrame,
+    window: datetime.timedelta = OVERTIME_WINDOW,
+    limit: datetime.timedelta = OVERTIME_LIMIT
+) -> pd.DataFrame:
+    periods = merge_work_periods(waybills)
+    if periods.empty:
+        return pd.DataFrame({
+            'personnel_num': pd.Series(dtype=object),
+            'total_work_time': pd.Series(dtype='timedelta64[ns]'),
+            'period_start': pd.Series(dtype='datetime64[ns]')
+        })
+
+    window_s = int(window.total_seconds())
+    start = periods['start'].to_numpy()
+    end = periods['end'].to_numpy()
+    driver_code = pd.factorize(periods['driver_pers_num'])[0].astype(np.int64)
+
+    # Периоды уже отсортированы по (водитель, начало): общий ключ позволяет искать границу окна
+    # одним searchsorted сразу для всех водителей
+    offset = start.min()
+    span = int(end.max() - offset) + window_s + 1
+    key = driver_code * span + (start - offset)
+    last = np.searchsorted(key, key + window_s, side='left') - 1
+
+    # Наработка = сумма длительностей периодов, начавшихся в окне, минус выход последнего из них за окно
+    prefix = np.r_[0, np.cumsum(end - start)]
+    worked = prefix[last + 1] - prefix[np.arange(len(start))]
+    worked -= np.maximum(0, end[last] - (start + window_s))
+
+    violation = worked > int(limit.total_seconds())
+    return pd.DataFrame({
+        'personnel_num': periods['driver_pers_num'].to_numpy()[violation],
+        'total_work_time': pd.to_timedelta(worked[violation], unit='s'),
+        'period_start': pd.to_datetime(start[violation], unit='s')
+    })
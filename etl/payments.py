@@ -0,0 +1,98 @@
+import os
+import time
+
+import pandas as pd
+
+from loguru import logger
+
+from etl.dtypes import compact
+from etl.loader import copy_rows
+
+
+PAYMENTS_COLUMNS = ['transaction_dt', 'card_num', 'transaction_amt']
+
+# Явные типы колонок: дату и номер карты читаем строками, т.к. из исходных строк считается md5
+# (исходная строка даты остается в transaction_dt_raw)
+PAYMENTS_DTYPES = {'transaction_dt': str, 'card_num': str, 'transaction_amt': 'float64'}
+
+# Формат даты в выписках (раньше определялся через dayfirst=True)
+PAYMENTS_DT_FORMAT = os.environ.get('PAYMENTS_DT_FORMAT', '%d.%m.%Y %H:%M:%S')
+
+
+# Уникальный id транзакции - md5 от строки даты и номера карты, как и раньше (совместимо с fact_payments).
+# Считается в БД при вставке из стейджинга, а не по строке в Python
+TRANSACTION_ID_SQL = 'md5(transaction_dt_raw || card_num)'
+
+
+def _transform(payments: pd.DataFrame) -> pd.DataFrame:
+    payments['transaction_dt_raw'] = payments['transaction_dt']
+    payments['transaction_dt'] = pd.to_datetime(payments['transaction_dt'], format=PAYMENTS_DT_FORMAT)
+    return compact(payments, 'payments')
+
+
+def list_payment_files(payments_dir: str) -> list:
+    return [os.path.join(payments_dir, file) for file in sorted(os.listdir(payments_dir)) if file.endswith('.csv')]
+
+
+# Чтение всех выписок директории пачками не больше chunk_size строк.
+# Мелкие файлы склеиваются в одну пачку, большие читаются по частям, так что память не растет с числом файлов
+def iter_payments(payments_dir: str, chunk_size: int = 100000):
+    buffer = []
+    buffered = 0
+    for path in list_payment_files(payments_dir):
+        reader = pd.read_csv(
+            path,
+            sep='\t',
+            names=PAYMENTS_COLUMNS,
+            dtype=PAYMENTS_DTYPES,
+            chunksize=chunk_size
+        )
+        for chunk in reader:
+            buffer.append(chunk)
+            buffered += len(chunk)
+            if buffered >= chunk_size:
+                yield _transform(pd.concat(buffer, ignore_index=True))
+                buffer = []
+                buffered = 0
+    if buffer:
+        yield _transform(pd.concat(buffer, ignore_index=True))
+
+
+# Загрузка пачки платежей: COPY сырых строк в UNLOGGED стейджинг и одна вставка в fact_payments,
+# transaction_id считается в INSERT ... SELECT. Возвращает количество вставленных и пропущенных строк
+def load_payments(engine, payments: pd.DataFrame, schema: str = 'dwh_kazan'):
+    stage = '{}.work_stage_payments_raw'.format(schema)
+    start = time.perf_counter()
+
+    with engine.begin() as conn:
+        cursor = conn.connection.cursor()
+        cursor.execute(
+            '''
+            CREATE UNLOGGED TABLE IF NOT EXISTS {} (
+                transaction_dt_raw text,
+                transaction_dt timestamp,
+                card_num text,
+                transaction_amt numeric(7, 2)
+            )
+            '''.format(stage)
+        )
+        cursor.execute('TRUNCATE {}'.format(stage))
+        copy_rows(cursor, payments[['transaction_dt_raw', 'transaction_dt', 'card_num', 'transaction_amt']], stage)
+        cursor.execute(
+            '''
+            INSERT INTO {schema}.fact_payments (transaction_id, card_num, transaction_amt, transaction_dt)
+            SELECT {id_sql}, card_num, transaction_amt, transaction_dt
+            FROM {stage}
+            ON CONFLICT DO NOTHING
+            '''.format(schema=schema, id_sql=TRANSACTION_ID_SQL, stage=stage)
+        )
+        inserted = cursor.rowcount
+        cursor.execute('TRUNCATE {}'.format(stage))
+
+    skipped = len(payments) - inserted
+    duration = time.perf_counter() - start
+    logger.info(
+        'fact_payments: {} rows inserted, {} skipped in {:.2f} s ({:.0f} rows/s)',
+        inserted, skipped, duration, len(payments) / duration if duration else 0
+    )
+    return inserted, skipped
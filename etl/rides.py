@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+
+
+# Статусы поездки в main.movement. Порядок задает коды категорий и колонки матрицы событий
+LIFECYCLE_EVENTS = ['READY', 'BEGIN', 'END', 'CANCEL']
+READY, BEGIN, END, CANCEL = range(len(LIFECYCLE_EVENTS))
+
+NAT = np.iinfo(np.int64).min
+
+
+# Жизненный цикл завершенных поездок по потоку статусов машин: время подачи, начала и окончания
+# (окончание - END, а если его нет - CANCEL) и номер машины из завершающего статуса.
+# Вместо pivot + двух merge - один проход: коды поездки и статуса, сортировка по (поездка, статус, время)
+# и по одной позиции строки на пару (поездка, статус). Копируются только целочисленные массивы,
+# а не весь movement. Повторы статуса и статусы не по порядку не ломают сборку:
+# берется самый ранний по времени, при равном времени - первый по порядку строк
+def ride_lifecycle(
+    movement: pd.DataFrame,
+    ride_col: str = 'ride',
+    event_col: str = 'event',
+    dt_col: str = 'dt',
+    plate_col: str = 'car_plate_num'
+) -> pd.DataFrame:
+    key, rides = pd.factorize(movement[ride_col], sort=True)
+    event_code = pd.Categorical(movement[event_col], categories=LIFECYCLE_EVENTS).codes
+    dt = movement[dt_col].to_numpy('datetime64[ns]').view(np.int64)
+
+    # Ключ пары (поездка, статус) считаем на месте в массиве кодов поездок
+    valid = (key >= 0) & (event_code >= 0) & (dt != NAT)
+    key *= len(LIFECYCLE_EVENTS)
+    key += event_code
+
+    # Неизвестные статусы, пустые поездки и время пропускаем (ключ -1 уходит в начало сортировки)
+    key[~valid] = -1
+    del valid, event_code
+    pos = np.lexsort((dt, key))
+    key = key[pos]
+    first = np.r_[True, key[1:] != key[:-1]] & (key >= 0)
+
+    # Позиция строки с самым ранним временем для каждой пары (поездка, статус), -1 - статуса не было
+    event_pos = np.full(len(rides) * len(LIFECYCLE_EVENTS), -1, dtype=np.int64)
+    event_pos[key[first]] = pos[first]
+    event_pos = event_pos.reshape(len(rides), len(LIFECYCLE_EVENTS))
+    del pos, key, first
+
+    finish_pos = np.where(event_pos[:, END] >= 0, event_pos[:, END], event_pos[:, CANCEL])
+    finished = finish_pos >= 0
+    event_pos, finish_pos = event_pos[finished], finish_pos[finished]
+
+    def event_dt(positions: np.ndarray) -> np.ndarray:
+        return np.where(positions >= 0, dt[positions], NAT).view('datetime64[ns]')
+
+    return pd.DataFrame({
+        ride_col: rides[finished],
+        plate_col: movement[plate_col].array.take(finish_pos),
+        'ride_arrival_dt': event_dt(event_pos[:, READY]),
+        'ride_start_dt': event_dt(event_pos[:, BEGIN]),
+        'ride_end_dt': event_dt(finish_pos)
+    })
@@ -0,0 +1,109 @@
+import datetime
+
+from loguru import logger
+from sqlalchemy.sql import text
+
+
+# Скорость поездки (км/ч) и порог нарушения - общие для агрегата и витрины нарушений.
+# Поездки нулевой длительности не считаются нарушением (раньше запрос падал на делении на ноль)
+RIDE_SPEED_SQL = 'ROUND(distance_val / NULLIF(EXTRACT(EPOCH FROM ride_end_dt - ride_start_dt) / 3600, 0), 2)'
+SPEED_LIMIT = 85
+
+
+# -----------------------------------------------------------------------
+# Дневной агрегат по водителям agg_driver_day: завершенные поездки, дистанция, выручка,
+# максимальная скорость, нарушения за день и накопленное число нарушений до этого дня.
+# Обновляется после каждой загрузки fact_rides только за дни, попавшие в батч
+# -----------------------------------------------------------------------
+
+def ensure_agg_table(conn, schema: str = 'dwh_kazan'):
+    conn.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS {}.agg_driver_day (
+            personnel_num varchar(32),
+            report_dt date,
+            rides_cnt integer,
+            distance_val numeric(12, 2),
+            price_amt numeric(12, 2),
+            max_speed numeric(7, 2),
+            violations_cnt integer,
+            violations_before integer,
+            PRIMARY KEY (personnel_num, report_dt)
+        )
+        '''.format(schema)
+    )
+
+
+# Дни [first_day, last_day] пересчитываются из fact_rides целиком (по диапазону ride_end_dt - читаются только их партиции)
+REFRESH_DAYS_SQL = '''
+    INSERT INTO {schema}.agg_driver_day
+    SELECT
+        driver_pers_num,
+        ride_end_dt::date,
+        COUNT(*),
+        SUM(distance_val),
+        SUM(price_amt),
+        MAX({speed}),
+        COUNT(*) FILTER (WHERE {speed} > {limit}),
+        0
+    FROM {schema}.fact_rides
+    WHERE ride_end_dt >= :first_day AND ride_end_dt < :next_day AND ride_start_dt IS NOT NULL
+    GROUP BY driver_pers_num, ride_end_dt::date
+'''
+
+# Накопленные нарушения с first_day: база - последняя строка водителя до first_day (по первичному ключу),
+# дальше нарастающий итог по строкам агрегата, а не по истории поездок.
+# Возвращает дни, в которых накопленное число изменилось (их витрина нарушений устарела)
+RUNNING_VIOLATIONS_SQL = '''
+    UPDATE {schema}.agg_driver_day AS a
+    SET violations_before = r.violations_before
+    FROM
+    (
+        SELECT
+            cur.personnel_num,
+            cur.report_dt,
+            COALESCE(base.violations_total, 0)
+                + COALESCE(SUM(cur.violations_cnt) OVER (
+                    PARTITION BY cur.personnel_num ORDER BY cur.report_dt
+                    ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+                ), 0) AS violations_before
+        FROM {schema}.agg_driver_day AS cur
+        LEFT JOIN LATERAL
+        (
+            SELECT prev.violations_before + prev.violations_cnt AS violations_total
+            FROM {schema}.agg_driver_day AS prev
+            WHERE prev.personnel_num = cur.personnel_num AND prev.report_dt < :first_day
+            ORDER BY prev.report_dt DESC
+            LIMIT 1
+        ) AS base ON TRUE
+        WHERE cur.report_dt >= :first_day
+    ) AS r
+    WHERE a.personnel_num = r.personnel_num
+        AND a.report_dt = r.report_dt
+        AND a.violations_before IS DISTINCT FROM r.violations_before
+    RETURNING a.report_dt
+'''
+
+
+# Пересчет агрегата за дни батча. Если агрегат пуст (первый запуск), строим его по всей истории fact_rides.
+# Возвращает количество строк агрегата за пересчитанные дни и более поздние дни, у которых сдвинулось
+# накопленное число нарушений
+def refresh_agg_driver_day(engine, first_day: datetime.date, last_day: datetime.date, schema: str = 'dwh_kazan') -> tuple:
+    with engine.begin() as conn:
+        ensure_agg_table(conn, schema)
+        if conn.execute('SELECT NOT EXISTS (SELECT 1 FROM {}.agg_driver_day)'.format(schema)).scalar():
+            first_fact_dt = conn.execute('SELECT MIN(ride_end_dt) FROM {}.fact_rides'.format(schema)).scalar()
+            if first_fact_dt is not None:
+                first_day = min(first_day, first_fact_dt.date())
+        params = {'first_day': first_day, 'next_day': last_day + datetime.timedelta(days=1)}
+        conn.execute(
+            text('DELETE FROM {}.agg_driver_day WHERE report_dt >= :first_day AND report_dt < :next_day'.format(schema)),
+            params
+        )
+        rows = conn.execute(
+            text(REFRESH_DAYS_SQL.format(schema=schema, speed=RIDE_SPEED_SQL, limit=SPEED_LIMIT)), params
+        ).rowcount
+        shifted = conn.execute(text(RUNNING_VIOLATIONS_SQL.format(schema=schema)), params).fetchall()
+    shifted_days = sorted({row[0] for row in shifted if row[0] > last_day})
+    logger.info('agg_driver_day: {} rows for {} - {}', rows, first_day, last_day)
+    return rows, shifted_days
@@ -0,0 +1,141 @@
+import os
+import json
+import shutil
+import threading
+import datetime
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+
+from etl.dtypes import compact, plain_categories
+
+
+CHECKPOINT_FILE = 'checkpoint.json'
+
+
+# Запуск батча по именованным этапам с сохранением контрольных точек.
+# После каждого успешного этапа его результаты (DataFrame) пишутся в Parquet, а имя этапа - в checkpoint.json.
+# Если батч упал, следующий запуск продолжает его с упавшего этапа с теми же параметрами,
+# не перекачивая файлы и не перечитывая источник
+class BatchRunner:
+
+    def __init__(self, state_dir: str, metrics=None):
+        self.state_dir = state_dir
+        self.metrics = metrics
+        self.frames = {}
+        self._lock = threading.RLock()
+        os.makedirs(state_dir, exist_ok=True)
+        self.state = self._load_state()
+
+    @property
+    def checkpoint_path(self) -> str:
+        return os.path.join(self.state_dir, CHECKPOINT_FILE)
+
+    def _load_state(self) -> dict:
+        if not os.path.exists(self.checkpoint_path):
+            return {}
+        with open(self.checkpoint_path) as file:
+            return json.load(file)
+
+    def _save_state(self):
+        with self._lock:
+            with open(self.checkpoint_path + '.tmp', 'w') as file:
+                json.dump(self.state, file, default=str, indent=2)
+            os.replace(self.checkpoint_path + '.tmp', self.checkpoint_path)
+
+    # Параметры батча (время запуска, водяные знаки). При возобновлении берутся из контрольной точки
+    def begin(self, **params) -> dict:
+        if self.state:
+            logger.warning(
+                'Resuming unfinished batch {}, completed stages: {}',
+                self.state['params'], ', '.join(self.state['completed']) or '-'
+            )
+            return {key: datetime.datetime.fromisoformat(value) for key, value in self.state['params'].items()}
+        self.state = {'params': {key: value.isoformat() for key, value in params.items()}, 'completed': []}
+        self._save_state()
+        return params
+
+    # Небольшие значения (не DataFrame), которые нужно пронести через возобновление батча
+    def remember(self, key: str, value):
+        with self._lock:
+            self.state.setdefault('values', {})[key] = value
+            self._save_state()
+
+    def recall(self, key: str, default=None):
+        return self.state.get('values', {}).get(key, default)
+
+    def _frame_path(self, key: str) -> str:
+        return os.path.join(self.state_dir, key + '.parquet')
+
+    # Результат этапа: из памяти или из контрольной точки предыдущего запуска
+    def frame(self, key: str) -> pd.DataFrame:
+        if key not in self.frames:
+            frame = pd.read_parquet(self._frame_path(key))
+            source = self.state.get('sources', {}).get(key)
+            self.frames[key] = compact(frame, source) if source is not None else frame
+        return self.frames[key]
+
+    # Результат этапа пачками (генератор DataFrame источника source): каждая пачка сразу дописывается
+    # в Parquet контрольной точки, так что память этапа не растет с объемом выборки.
+    # Весь результат читает уже следующий этап через frame(). Возвращает количество строк
+    def write_chunks(self, key: str, chunks, source: str) -> int:
+        path = self._frame_path(key)
+        writer = None
+        rows = 0
+        try:
+            for chunk in chunks:
+                table = pa.Table.from_pandas(
+                    plain_categories(chunk, source),
+                    schema=writer.schema if writer is not None else None,
+                    preserve_index=chunk.index.name is not None
+                )
+                if writer is None:
+                    writer = pq.ParquetWriter(path + '.tmp', table.schema)
+                writer.write_table(table)
+                rows += len(chunk)
+        finally:
+            if writer is not None:
+                writer.close()
+        os.replace(path + '.tmp', path)
+        with self._lock:
+            self.frames.pop(key, None)
+            self.state.setdefault('sources', {})[key] = source
+            self._save_state()
+        return rows
+
+    # Выполнение этапа: func(stat) возвращает словарь DataFrame (или None), которые сохраняются в Parquet.
+    # Уже выполненные в прошлом запуске этапы пропускаются
+    def stage(self, name: str, func):
+        if name in self.state['completed']:
+            logger.info('Stage {} already completed, skipping', name)
+            return
+        if self.metrics is not None:
+            with self.metrics.stage(name) as stat:
+                outputs = func(stat)
+        else:
+            outputs = func({})
+        for key, frame in (outputs or {}).items():
+            frame.to_parquet(self._frame_path(key))
+            self.frames[key] = frame
+        with self._lock:
+            self.state['completed'].append(name)
+            self._save_state()
+
+    # Независимые этапы выполняются одновременно в потоках (I/O: FTP, запросы к БД).
+    # Каждый этап сохраняет свою контрольную точку, поэтому при ошибке одного из них
+    # успешно завершенные не повторяются. Ошибка пробрасывается после завершения всей группы
+    def stages_parallel(self, stages: list, workers: int = None):
+        with ThreadPoolExecutor(max_workers=workers or len(stages)) as pool:
+            futures = [pool.submit(self.stage, name, func) for name, func in stages]
+        for future in futures:
+            future.result()
+
+    # Батч завершен: удаляем контрольную точку и промежуточные результаты
+    def finish(self):
+        shutil.rmtree(self.state_dir, ignore_errors=True)
+        self.state = {}
+        self.frames = {}
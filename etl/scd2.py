@@ -0,0 +1,116 @@
+import time
+
+import pandas as pd
+
+from loguru import logger
+
+from etl.loader import copy_rows
+
+
+# Признак открытой (текущей) версии в таблицах измерений
+OPEN_END_DT = '9999-01-01 00:00:00'
+
+
+# Описание измерения SCD2: бизнес-ключ и атрибуты, изменение которых порождает новую версию
+class Scd2Dimension:
+
+    def __init__(self, table: str, business_key: list, tracked_columns: list, schema: str = 'dwh_kazan'):
+        self.table = table
+        self.business_key = business_key
+        self.tracked_columns = tracked_columns
+        self.schema = schema
+
+    @property
+    def target(self) -> str:
+        return '{}.{}'.format(self.schema, self.table)
+
+    @property
+    def work_table(self) -> str:
+        return 'work_scd2_{}'.format(self.table)
+
+
+DIM_CARS = Scd2Dimension('dim_cars', business_key=['plate_num'], tracked_columns=['revision_dt'])
+DIM_DRIVERS = Scd2Dimension('dim_drivers', business_key=['personnel_num'], tracked_columns=['card_num'])
+DIM_CLIENTS = Scd2Dimension('dim_clients', business_key=['phone_num'], tracked_columns=['card_num'])
+
+
+def _join(alias_left: str, alias_right: str, columns: list) -> str:
+    return ' AND '.join('{0}.{2} = {1}.{2}'.format(alias_left, alias_right, column) for column in columns)
+
+
+def _merge_sql(dim: Scd2Dimension, columns: list) -> str:
+    key = ', '.join(dim.business_key)
+    column_list = ', '.join(columns)
+    return '''
+        WITH src AS (
+            -- В пачке одна строка на (ключ, начало версии)
+            SELECT DISTINCT ON ({key}, start_dt) {columns}
+            FROM {work}
+            ORDER BY {key}, start_dt
+        ),
+        new_rows AS (
+            -- Новые версии: такой версии еще нет и текущая версия отличается по отслеживаемым атрибутам
+            SELECT s.*
+            FROM src AS s
+            WHERE NOT EXISTS (
+                SELECT 1 FROM {target} AS f
+                WHERE {key_join} AND f.start_dt = s.start_dt
+            )
+            AND NOT EXISTS (
+                SELECT 1 FROM {target} AS f
+                WHERE {key_join} AND f.end_dt = '{open_dt}' AND {same_tracked}
+            )
+        ),
+        closed AS (
+            -- Закрываем текущие версии моментом перед началом первой новой версии
+            UPDATE {target} AS f
+            SET end_dt = n.start_dt - INTERVAL '1 second'
+            FROM (SELECT {key}, MIN(start_dt) AS start_dt FROM new_rows GROUP BY {key}) AS n
+            WHERE {key_join_n} AND f.end_dt = '{open_dt}' AND f.start_dt < n.start_dt
+            RETURNING 1
+        ),
+        inserted AS (
+            INSERT INTO {target} ({columns})
+            SELECT {columns} FROM new_rows
+            RETURNING 1
+        )
+        SELECT (SELECT COUNT(*) FROM closed), (SELECT COUNT(*) FROM inserted)
+    '''.format(
+        key=key,
+        columns=column_list,
+        work=dim.work_table,
+        target=dim.target,
+        open_dt=OPEN_END_DT,
+        key_join=_join('f', 's', dim.business_key),
+        key_join_n=_join('f', 'n', dim.business_key),
+        same_tracked=' AND '.join(
+            'f.{0} IS NOT DISTINCT FROM s.{0}'.format(column) for column in dim.tracked_columns
+        )
+    )
+
+
+# Слияние пачки изменений в измерение SCD2 одной транзакцией:
+# COPY во временную таблицу с индексом, затем один запрос закрывает старые версии и вставляет новые.
+# Повторная загрузка тех же версий ничего не меняет, поэтому дедупликация после вставки не нужна
+def merge_scd2(engine, dim: Scd2Dimension, updates: pd.DataFrame):
+    start = time.perf_counter()
+    columns = list(updates.columns)
+
+    with engine.begin() as conn:
+        cursor = conn.connection.cursor()
+        cursor.execute(
+            'CREATE TEMP TABLE {} (LIKE {} INCLUDING DEFAULTS) ON COMMIT DROP'.format(dim.work_table, dim.target)
+        )
+        copy_rows(cursor, updates, dim.work_table)
+        cursor.execute(
+            'CREATE INDEX ON {} ({}, start_dt)'.format(dim.work_table, ', '.join(dim.business_key))
+        )
+        cursor.execute('ANALYZE {}'.format(dim.work_table))
+        cursor.execute(_merge_sql(dim, columns))
+        closed, inserted = cursor.fetchone()
+
+    logger.info(
+        '{}: {} versions closed, {} inserted from {} rows in {:.2f} s',
+        dim.table, closed, inserted, len(updates), time.perf_counter() - start
+    )
+    return closed, inserted
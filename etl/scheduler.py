@@ -0,0 +1,38 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from loguru import logger
+
+
+SUCCESS, FAILURE = 'Success', 'Failure'
+
+
+# Задача: имя и функция func(stat)
+class Job:
+
+    def __init__(self, name: str, func):
+        self.name = name
+        self.func = func
+
+
+# Выполнение независимых задач в пуле потоков. Ошибка задачи не останавливает остальные.
+# Время и статус каждой задачи пишутся в StageMetrics. Возвращает статусы задач по именам
+def run_jobs(jobs: list, workers: int = 4, metrics=None) -> dict:
+
+    def execute(job: Job):
+        if metrics is None:
+            return job.func({})
+        with metrics.stage(job.name) as stat:
+            return job.func(stat)
+
+    status = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        running = {pool.submit(execute, job): job for job in jobs}
+        for future in as_completed(running):
+            job = running[future]
+            try:
+                future.result()
+                status[job.name] = SUCCESS
+            except Exception:
+                status[job.name] = FAILURE
+                logger.exception('Job {} failed', job.name)
+    return status
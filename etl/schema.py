@@ -0,0 +1,244 @@
+import json
+import datetime
+
+from loguru import logger
+from sqlalchemy.sql import text
+
+
+# -----------------------------------------------------------------------
+# Структура фактовых таблиц хранилища: помесячные партиции по дате и индексы под витрины
+# -----------------------------------------------------------------------
+
+# Фактовые таблицы: бизнес-ключ и колонка даты, по которой нарезаются партиции.
+# Первичный ключ партиционированной таблицы обязан включать колонку партиционирования,
+# поэтому он расширяется до (ключ, дата) - дата факта для ключа не меняется, так что ON CONFLICT работает как раньше
+FACT_PARTITIONS = {
+    'fact_rides': {'key': 'ride_id', 'date_col': 'ride_end_dt'},
+    'fact_waybills': {'key': 'waybill_num', 'date_col': 'work_start_dt'},
+    'fact_payments': {'key': 'transaction_id', 'date_col': 'transaction_dt'}
+}
+
+# Индексы под фильтры и соединения витрин (на партиционированной таблице создаются во всех партициях)
+INDEXES = {
+    'fact_rides_driver_end_idx': ('fact_rides', ['driver_pers_num', 'ride_end_dt']),
+    'fact_rides_client_arrival_idx': ('fact_rides', ['client_phone_num', 'ride_arrival_dt']),
+    'fact_waybills_driver_start_idx': ('fact_waybills', ['driver_pers_num', 'work_start_dt']),
+    'fact_waybills_end_idx': ('fact_waybills', ['work_end_dt']),
+    'fact_payments_card_dt_idx': ('fact_payments', ['card_num', 'transaction_dt']),
+    'dim_clients_phone_period_idx': ('dim_clients', ['phone_num', 'start_dt', 'end_dt']),
+    'dim_clients_card_idx': ('dim_clients', ['card_num']),
+    'dim_drivers_period_idx': ('dim_drivers', ['personnel_num', 'start_dt', 'end_dt'])
+}
+
+# Сколько месяцев вперед держим готовые партиции, чтобы загрузка не попадала в партицию по умолчанию
+MONTHS_AHEAD = 2
+
+
+def month_start(dt) -> datetime.date:
+    return datetime.date(dt.year, dt.month, 1)
+
+
+def next_month(day: datetime.date) -> datetime.date:
+    return datetime.date(day.year + day.month // 12, day.month % 12 + 1, 1)
+
+
+def partition_name(table: str, month: datetime.date) -> str:
+    return '{}_p{:%Y%m}'.format(table, month)
+
+
+def default_partition_name(table: str) -> str:
+    return '{}_default'.format(table)
+
+
+def is_partitioned(conn, table: str, schema: str = 'dwh_kazan') -> bool:
+    return conn.execute(
+        text(
+            '''
+            SELECT COUNT(*)
+            FROM pg_partitioned_table pt
+            JOIN pg_class c ON c.oid = pt.partrelid
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = :schema AND c.relname = :table
+            '''
+        ),
+        {'schema': schema, 'table': table}
+    ).scalar() > 0
+
+
+def list_partitions(conn, table: str, schema: str = 'dwh_kazan') -> list:
+    return [row[0] for row in conn.execute(
+        text(
+            '''
+            SELECT c.relname
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+            JOIN pg_namespace n ON n.oid = p.relnamespace
+            WHERE n.nspname = :schema AND p.relname = :table
+            ORDER BY c.relname
+            '''
+        ),
+        {'schema': schema, 'table': table}
+    )]
+
+
+# Партиция за месяц. Строки этого месяца, попавшие в партицию по умолчанию, переносятся в новую:
+# создаем ее отдельной таблицей, переносим строки и только потом присоединяем
+def create_month_partition(conn, table: str, month: datetime.date, schema: str = 'dwh_kazan') -> bool:
+    name = partition_name(table, month)
+    if name in list_partitions(conn, table, schema):
+        return False
+    date_col = FACT_PARTITIONS[table]['date_col']
+    params = {'lower': month, 'upper': next_month(month)}
+    conn.execute('CREATE TABLE {s}.{name} (LIKE {s}.{table} INCLUDING DEFAULTS)'.format(s=schema, name=name, table=table))
+    if default_partition_name(table) in list_partitions(conn, table, schema):
+        conn.execute(
+            text(
+                '''
+                WITH moved AS (
+                    DELETE FROM {s}.{default}
+                    WHERE {col} >= :lower AND {col} < :upper
+                    RETURNING *
+                )
+                INSERT INTO {s}.{name} SELECT * FROM moved
+                '''.format(s=schema, default=default_partition_name(table), col=date_col, name=name)
+            ),
+            params
+        )
+    conn.execute(
+        text(
+            'ALTER TABLE {s}.{table} ATTACH PARTITION {s}.{name} FOR VALUES FROM (:lower) TO (:upper)'.format(
+                s=schema, table=table, name=name
+            )
+        ),
+        params
+    )
+    return True
+
+
+# Переводим обычную фактовую таблицу в партиционированную (разовая миграция).
+# Старая таблица переименовывается, новая создается по ее структуре с партициями на весь диапазон данных
+# и партицией по умолчанию, строки переносятся одной вставкой, старая таблица удаляется
+def partition_table(conn, table: str, schema: str = 'dwh_kazan'):
+    key, date_col = FACT_PARTITIONS[table]['key'], FACT_PARTITIONS[table]['date_col']
+    old = '{}_unpartitioned'.format(table)
+    conn.execute('ALTER TABLE {s}.{table} RENAME TO {old}'.format(s=schema, table=table, old=old))
+    conn.execute('ALTER TABLE {s}.{old} DROP CONSTRAINT IF EXISTS {table}_pkey'.format(s=schema, old=old, table=table))
+    conn.execute(
+        '''
+        CREATE TABLE {s}.{table} (
+            LIKE {s}.{old} INCLUDING DEFAULTS,
+            PRIMARY KEY ({key}, {date_col})
+        ) PARTITION BY RANGE ({date_col})
+        '''.format(s=schema, table=table, old=old, key=key, date_col=date_col)
+    )
+    conn.execute('CREATE TABLE {s}.{default} PARTITION OF {s}.{table} DEFAULT'.format(
+        s=schema, default=default_partition_name(table), table=table
+    ))
+
+    first_dt, last_dt = conn.execute('SELECT MIN({col}), MAX({col}) FROM {s}.{old}'.format(col=date_col, s=schema, old=old)).fetchone()
+    if first_dt is not None:
+        month = month_start(first_dt)
+        while month <= month_start(last_dt):
+            create_month_partition(conn, table, month, schema)
+            month = next_month(month)
+
+    rows = conn.execute('INSERT INTO {s}.{table} SELECT * FROM {s}.{old}'.format(s=schema, table=table, old=old)).rowcount
+    conn.execute('DROP TABLE {s}.{old}'.format(s=schema, old=old))
+    logger.info('{}: partitioned by {} ({} rows moved)', table, date_col, rows)
+
+
+# Партиции на месяцы от первого дня since до месяца until + MONTHS_AHEAD
+def ensure_partitions(conn, table: str, since: datetime.date, until: datetime.date, schema: str = 'dwh_kazan') -> list:
+    created = []
+    month = month_start(since)
+    last = month_start(until)
+    for _ in range(MONTHS_AHEAD):
+        last = next_month(last)
+    while month <= last:
+        if create_month_partition(conn, table, month, schema):
+            created.append(partition_name(table, month))
+        month = next_month(month)
+    return created
+
+
+def ensure_indexes(conn, schema: str = 'dwh_kazan'):
+    for name, (table, columns) in INDEXES.items():
+        conn.execute('CREATE INDEX IF NOT EXISTS {} ON {}.{} ({})'.format(name, schema, table, ', '.join(columns)))
+
+
+# Разовая миграция: непартиционированные фактовые таблицы переводятся в партиционированные.
+# Запускается явно (dwh_etl.py --migrate-schema), а не внутри батча: она переносит всю историю таблиц.
+# Каждая таблица - в своей транзакции. Возвращает мигрированные таблицы
+def migrate_schema(engine, schema: str = 'dwh_kazan') -> list:
+    migrated = []
+    for table in FACT_PARTITIONS:
+        with engine.begin() as conn:
+            if not is_partitioned(conn, table, schema):
+                partition_table(conn, table, schema)
+                migrated.append(table)
+    return migrated
+
+
+# Поддержка структуры перед загрузкой батча: партиции с прошлого месяца (загрузка идет с нахлестом)
+# на MONTHS_AHEAD вперед и индексы. Более старые опоздавшие строки попадают в партицию по умолчанию.
+# Если таблица еще не партиционирована, батч останавливается до явной миграции
+def maintain_schema(engine, today: datetime.date, schema: str = 'dwh_kazan') -> list:
+    created = []
+    previous_month = month_start(month_start(today) - datetime.timedelta(days=1))
+    for table in FACT_PARTITIONS:
+        with engine.begin() as conn:
+            if not is_partitioned(conn, table, schema):
+                raise RuntimeError('{}.{} is not partitioned, run dwh_etl.py --migrate-schema first'.format(schema, table))
+            created += ensure_partitions(conn, table, previous_month, today, schema)
+    with engine.begin() as conn:
+        ensure_indexes(conn, schema)
+    if created:
+        logger.info('Created partitions: {}', created)
+    return created
+
+
+# -----------------------------------------------------------------------
+# Проверка планов запросов витрин через EXPLAIN: запрос за день должен читать
+# только партиции этого дня (и партицию по умолчанию), а не всю таблицу
+# -----------------------------------------------------------------------
+
+def explain(conn, sql: str, params: dict = None) -> dict:
+    plan = conn.execute(text('EXPLAIN (FORMAT JSON) ' + sql), params or {}).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Plan']
+
+
+# Все узлы плана, читающие таблицы: (тип узла, таблица)
+def scanned_relations(plan: dict) -> list:
+    relations = []
+    if 'Relation Name' in plan:
+        relations.append((plan['Node Type'], plan['Relation Name']))
+    for child in plan.get('Plans', []):
+        relations.extend(scanned_relations(child))
+    return relations
+
+
+# Партиции table, которые план читает сверх партиций периода [first_day, last_day] и партиции по умолчанию
+def extra_partitions(plan: dict, table: str, first_day: datetime.date, last_day: datetime.date) -> list:
+    allowed = {default_partition_name(table)}
+    month = month_start(first_day)
+    while month <= month_start(last_day):
+        allowed.add(partition_name(table, month))
+        month = next_month(month)
+    return sorted({
+        relation for _, relation in scanned_relations(plan)
+        if relation.startswith(table + '_') and relation not in allowed
+    })
+
+
+# Проверка списка запросов [(имя, sql, параметры, таблица, первый день, последний день)].
+# Возвращает описания нарушений, пустой список - все запросы отсекают лишние партиции
+def check_plans(conn, checks: list) -> list:
+    problems = []
+    for name, sql, params, table, first_day, last_day in checks:
+        extra = extra_partitions(explain(conn, sql, params), table, first_day, last_day)
+        if extra:
+            problems.append('{}: reads {} partitions outside {} - {}: {}'.format(name, table, first_day, last_day, extra))
+    return problems
@@ -0,0 +1,117 @@
+import datetime
+
+import pandas as pd
+
+from sqlalchemy.sql import text
+
+from etl.loader import copy_rows
+
+
+# -----------------------------------------------------------------------
+# Водяные знаки источников и незавершенные поездки между батчами.
+# Каждый источник извлекается ровно со своего водяного знака (последний id или update_dt),
+# а поездки без завершающего статуса (или еще без путевого листа) переносятся в следующий батч
+# через work_pending_* вместо повторного чтения окна с запасом
+# -----------------------------------------------------------------------
+
+# Сколько держим незавершенную поездку (по последнему событию), прежде чем отказаться от нее
+PENDING_MAX_AGE = datetime.timedelta(days=2)
+
+PENDING_MOVEMENT_COLUMNS = ['movement_id', 'car_plate_num', 'ride', 'event', 'dt']
+PENDING_RIDES_COLUMNS = ['ride_id', 'dt', 'client_phone', 'card_num', 'point_from', 'point_to', 'distance', 'price']
+
+
+def ensure_watermark_tables(conn, schema: str = 'dwh_kazan'):
+    conn.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS {}.work_source_watermark (
+            source varchar(32) PRIMARY KEY,
+            last_id bigint,
+            last_dt timestamp,
+            updated_dt timestamp
+        )
+        '''.format(schema)
+    )
+    conn.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS {}.work_pending_movement (
+            movement_id bigint PRIMARY KEY,
+            car_plate_num varchar(9),
+            ride bigint,
+            event varchar(6),
+            dt timestamp
+        )
+        '''.format(schema)
+    )
+    conn.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS {}.work_pending_rides (
+            ride_id bigint PRIMARY KEY,
+            dt timestamp,
+            client_phone varchar(18),
+            card_num varchar(19),
+            point_from varchar(200),
+            point_to varchar(200),
+            distance numeric(5, 2),
+            price numeric(7, 2)
+        )
+        '''.format(schema)
+    )
+
+
+# Водяные знаки по источникам: {source: {'last_id': ..., 'last_dt': ...}}. Источника нет - первый запуск
+def load_watermarks(conn, schema: str = 'dwh_kazan') -> dict:
+    rows = conn.execute('SELECT source, last_id, last_dt FROM {}.work_source_watermark'.format(schema))
+    return {source: {'last_id': last_id, 'last_dt': last_dt} for source, last_id, last_dt in rows}
+
+
+# Завершенный батч: новые водяные знаки и незавершенные поездки сохраняются одной транзакцией
+def save_batch_state(
+    engine,
+    watermarks: dict,
+    pending_movement: pd.DataFrame,
+    pending_rides: pd.DataFrame,
+    schema: str = 'dwh_kazan'
+):
+    with engine.begin() as conn:
+        for source, mark in watermarks.items():
+            conn.execute(
+                text(
+                    '''
+                    INSERT INTO {}.work_source_watermark (source, last_id, last_dt, updated_dt)
+                    VALUES (:source, :last_id, :last_dt, now())
+                    ON CONFLICT (source) DO UPDATE
+                    SET last_id = EXCLUDED.last_id, last_dt = EXCLUDED.last_dt, updated_dt = EXCLUDED.updated_dt
+                    '''.format(schema)
+                ),
+                {'source': source, 'last_id': mark.get('last_id'), 'last_dt': mark.get('last_dt')}
+            )
+        cursor = conn.connection.cursor()
+        for table, df, columns in [
+            ('work_pending_movement', pending_movement, PENDING_MOVEMENT_COLUMNS),
+            ('work_pending_rides', pending_rides, PENDING_RIDES_COLUMNS)
+        ]:
+            cursor.execute('TRUNCATE {}.{}'.format(schema, table))
+            copy_rows(cursor, df[columns], '{}.{}'.format(schema, table))
+
+
+# Поездки, которые переходят в следующий батч: без завершающего статуса или без найденного водителя.
+# done_rides - id поездок, попавших в fact_rides. Поездки, последнее событие которых старше cutoff, отбрасываются.
+# Возвращает (статусы, заказы, id отброшенных поездок)
+def split_pending(movement: pd.DataFrame, rides: pd.DataFrame, done_rides, cutoff: datetime.datetime) -> tuple:
+    movement = movement.reset_index()
+    open_movement = movement[~movement['ride'].isin(done_rides)]
+    open_rides = rides[~rides['ride_id'].isin(done_rides)]
+
+    last_seen = pd.concat([
+        open_movement.groupby('ride', observed=True)['dt'].max(),
+        open_rides.set_index('ride_id')['dt']
+    ]).groupby(level=0).max()
+    keep = last_seen.index[last_seen >= cutoff]
+    expired = last_seen.index[last_seen < cutoff]
+
+    return (
+        open_movement[open_movement['ride'].isin(keep)][PENDING_MOVEMENT_COLUMNS],
+        open_rides[open_rides['ride_id'].isin(keep)][PENDING_RIDES_COLUMNS],
+        expired.tolist()
+    )
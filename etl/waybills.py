@@ -0,0 +1,146 @@
+import os
+import threading
+
+import pandas as pd
+
+from lxml import etree
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from etl.dtypes import compact, concat_compact
+
+
+# Колонки в том же порядке и с теми же именами, что отдает waybill.xsl
+WAYBILL_COLUMNS = ['issuedt', 'number', 'model', 'car', 'name', 'license', 'validto', 'start', 'stop']
+
+# Пути до значений внутри элемента waybill (аналог select в waybill.xsl)
+WAYBILL_PATHS = {
+    'model': 'model',
+    'car': 'car',
+    'name': 'driver/name',
+    'license': 'driver/license',
+    'validto': 'driver/validto',
+    'start': 'period/start',
+    'stop': 'period/stop'
+}
+
+
+def _text(value):
+    return value.strip() if value is not None else None
+
+
+# Потоковый разбор одного или нескольких файлов в колонки (без XSLT и без промежуточных DataFrame)
+def parse_waybill_files(paths: list) -> dict:
+    columns = {column: [] for column in WAYBILL_COLUMNS}
+    for path in paths:
+        for _, elem in etree.iterparse(path, events=('end',), tag='waybill'):
+            columns['issuedt'].append(_text(elem.get('issuedt')))
+            columns['number'].append(_text(elem.get('number')))
+            for column, xpath in WAYBILL_PATHS.items():
+                columns[column].append(_text(elem.findtext(xpath)))
+            # Освобождаем память под уже разобранные элементы
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+    return columns
+
+
+def _to_frame(columns: dict) -> pd.DataFrame:
+    waybills = pd.DataFrame(columns, columns=WAYBILL_COLUMNS)
+    # Переводим строки в datetime
+    waybills['issuedt'] = pd.to_datetime(waybills['issuedt'])
+    waybills['start'] = pd.to_datetime(waybills['start'])
+    waybills['stop'] = pd.to_datetime(waybills['stop'])
+    return compact(waybills, 'waybills')
+
+
+def empty_waybills() -> pd.DataFrame:
+    return _to_frame({column: [] for column in WAYBILL_COLUMNS})
+
+
+def list_waybill_files(waybills_dir: str) -> list:
+    return [os.path.join(waybills_dir, file) for file in sorted(os.listdir(waybills_dir)) if file.endswith('.xml')]
+
+
+# Разбор путевых листов по мере их скачивания: файлы копятся пачками по files_per_task
+# и сразу уходят в пул процессов, не дожидаясь окончания загрузки всей директории.
+# Готовые части забираются по мере завершения и копятся не больше chunk_size строк, после чего
+# отдаются в on_frame (например, запись в зону приземления) - память не растет с числом файлов.
+# Без on_frame части копятся для result(). add() можно вызывать из нескольких потоков (колбэк FtpDownloader)
+class WaybillStreamParser:
+
+    def __init__(self, on_frame=None, workers: int = None, files_per_task: int = 500, chunk_size: int = 10000):
+        self.on_frame = on_frame
+        self.files_per_task = files_per_task
+        self.chunk_size = chunk_size
+        self.pool = ProcessPoolExecutor(max_workers=workers)
+        self.futures = set()
+        self.batch = []
+        self.buffer = {column: [] for column in WAYBILL_COLUMNS}
+        self.buffered = 0
+        self.rows = 0
+        self.frames = []
+        self._lock = threading.Lock()
+
+    def add(self, path: str):
+        if not path.endswith('.xml'):
+            return
+        with self._lock:
+            self.batch.append(path)
+            if len(self.batch) >= self.files_per_task:
+                self.futures.add(self.pool.submit(parse_waybill_files, self.batch))
+                self.batch = []
+            self._collect([future for future in self.futures if future.done()])
+
+    # Забираем результаты завершенных задач в буфер, полный буфер отдаем
+    def _collect(self, done):
+        for future in done:
+            self.futures.discard(future)
+            part = future.result()
+            for column in WAYBILL_COLUMNS:
+                self.buffer[column].extend(part[column])
+            self.buffered += len(part['number'])
+            if self.buffered >= self.chunk_size:
+                self._flush()
+
+    def _flush(self):
+        if not self.buffered:
+            return
+        frame = _to_frame(self.buffer)
+        self.buffer = {column: [] for column in WAYBILL_COLUMNS}
+        self.rows += self.buffered
+        self.buffered = 0
+        if self.on_frame is not None:
+            self.on_frame(frame)
+        else:
+            self.frames.append(frame)
+
+    # Дожидаемся разбора всех добавленных файлов и отдаем остаток. Возвращает количество путевых листов
+    def finish(self) -> int:
+        with self._lock:
+            if self.batch:
+                self.futures.add(self.pool.submit(parse_waybill_files, self.batch))
+                self.batch = []
+            self._collect(as_completed(list(self.futures)))
+            self._flush()
+        return self.rows
+
+    # Все путевые листы одним DataFrame (без on_frame)
+    def result(self) -> pd.DataFrame:
+        self.finish()
+        if not self.frames:
+            return empty_waybills()
+        return concat_compact(self.frames, 'waybills', ignore_index=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.pool.shutdown(cancel_futures=True)
+
+
+# Все путевые листы директории одним DataFrame через WaybillStreamParser (порядок строк - по мере разбора)
+def read_waybills(waybills_dir: str, chunk_size: int = 10000, workers: int = None, files_per_task: int = 500) -> pd.DataFrame:
+    with WaybillStreamParser(workers=workers, files_per_task=files_per_task, chunk_size=chunk_size) as parser:
+        for path in list_waybill_files(waybills_dir):
+            parser.add(path)
+        return parser.result()
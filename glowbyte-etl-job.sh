@@ -1,4 +1,6 @@
 #!/bin/bash
 source /home/edd-ign/Code/Projects/glowbyte-hack-2022/glowbyte/bin/activate
+# Витрины строятся только после успешного батча: оба скрипта при ошибке завершаются с кодом 1,
+# и код возврата задания - код последнего выполненного шага
 python /home/edd-ign/Code/Projects/glowbyte-hack-2022/dwh_etl.py &&
 python /home/edd-ign/Code/Projects/glowbyte-hack-2022/dm_update.py
\ No newline at end of file
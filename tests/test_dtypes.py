@@ -0,0 +1,35 @@
+import pytest
+
+pd = pytest.importorskip('pandas')
+pytest.importorskip('pyarrow')
+
+from etl.dtypes import compact, concat_compact, use_arrow_strings
+from etl.runner import BatchRunner
+
+
+def movement_frame(plates: list, first_id: int) -> pd.DataFrame:
+    return pd.DataFrame({
+        'movement_id': range(first_id, first_id + len(plates)),
+        'car_plate_num': plates,
+        'ride': range(len(plates)),
+        'event': ['READY'] * len(plates),
+        'dt': pd.Timestamp('2022-11-01')
+    }).set_index('movement_id')
+
+
+# Контрольная точка (категории из string[pyarrow]) склеивается с пачкой, прочитанной из SQL (категории из object)
+def test_concat_checkpoint_with_sql_frame(tmp_path):
+    use_arrow_strings()
+    runner = BatchRunner(str(tmp_path))
+    runner.begin(etl_start_dt=pd.Timestamp('2022-11-02').to_pydatetime())
+    chunks = [compact(movement_frame(['A001AA', 'B002BB'], 1), 'movement'), compact(movement_frame(['C003CC'], 3), 'movement')]
+    assert runner.write_chunks('movement', iter(chunks), source='movement') == 3
+
+    checkpoint = runner.frame('movement')
+    pending = compact(movement_frame(['A001AA', 'D004DD'], 10), 'movement')
+    movement = concat_compact([pending, checkpoint], 'movement')
+
+    assert len(movement) == 5
+    assert movement['car_plate_num'].dtype == 'category'
+    assert sorted(movement['car_plate_num'].cat.categories) == ['A001AA', 'B002BB', 'C003CC', 'D004DD']
+    assert movement.loc[3, 'car_plate_num'] == 'C003CC'
@@ -0,0 +1,42 @@
+import os
+import datetime
+
+import pytest
+
+pytest.importorskip('pandas')
+sqlalchemy = pytest.importorskip('sqlalchemy')
+
+from etl.marts import build_drivers_overtime
+
+
+# Тесты с БД выполняются только при заданном TEST_DB_URI: схема dwh_kazan в этой базе пересоздается
+TEST_DB_URI = os.environ.get('TEST_DB_URI')
+
+
+@pytest.fixture
+def dwh():
+    if not TEST_DB_URI:
+        pytest.skip('TEST_DB_URI is not set')
+    from benchmarks.stand import create_dwh
+    engine = sqlalchemy.create_engine(TEST_DB_URI)
+    create_dwh(engine)
+    yield engine
+    engine.dispose()
+
+
+def test_overtime_violation_is_written_as_interval(dwh):
+    day = datetime.date(2022, 11, 1)
+    with dwh.begin() as conn:
+        conn.execute('SET search_path TO dwh_kazan')
+        conn.execute(
+            '''
+            INSERT INTO fact_waybills (waybill_num, driver_pers_num, car_plate_num, work_start_dt, work_end_dt, issue_dt)
+            VALUES
+                ('W1', 'D1', 'A001AA', '2022-11-01 06:00', '2022-11-01 12:00', '2022-11-01 05:00'),
+                ('W2', 'D1', 'A001AA', '2022-11-01 14:00', '2022-11-01 19:30', '2022-11-01 13:00')
+            '''
+        )
+        assert build_drivers_overtime(conn, day) == 1
+
+    rows = dwh.execute('SELECT personnel_num, total_work_time, period_start FROM dwh_kazan.rep_drivers_overtime').fetchall()
+    assert rows == [('D1', datetime.timedelta(hours=11, minutes=30), datetime.datetime(2022, 11, 1, 6))]